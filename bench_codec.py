@@ -0,0 +1,92 @@
+# coding=utf-8
+# Compara os codecs do protocolo: vazão de encode/decode e bytes por mensagem.
+#
+#   python bench_codec.py
+#   python bench_codec.py --iterations 50000 --content-size 512 --json resultados.json
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime
+
+import chat
+
+
+def sample_messages(content_size):
+    host_id = str(uuid.uuid4())
+    return {
+        'discovery': {
+            'type': 'discovery',
+            'host_ip': '192.168.0.10',
+            'chat_port': chat.CHAT_PORT,
+            'host_id': host_id,
+            'host_name': 'Anfitrião',
+            'rooms': [chat.DEFAULT_ROOM, 'jogos']
+        },
+        'request_name': {'type': 'request_name', 'data': host_id},
+        'name_intro': {'type': 'name_intro', 'id': str(uuid.uuid4()), 'name': 'Convidado'},
+        'chat_message': {
+            'type': 'chat_message',
+            'sender_id': str(uuid.uuid4()),
+            'room': chat.DEFAULT_ROOM,
+            'content': ('mensagem de teste ' * (content_size // 18 + 1))[:content_size],
+            'timestamp': datetime.now().isoformat()
+        },
+    }
+
+
+def measure(codec, message_obj, iterations):
+    encode = codec.encode
+    decode = codec.decode
+
+    payload = encode(message_obj)
+    # Toda amostra cabe no esquema: se um codec cair fora, a amostra está
+    # errada e a comparação não vale nada.
+    if payload is None:
+        raise AssertionError(f"{codec.name} não codifica {message_obj['type']}")
+    if decode(payload) != message_obj:
+        raise AssertionError(f"{codec.name} não preserva {message_obj['type']}")
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        encode(message_obj)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(payload)
+    decode_time = time.perf_counter() - start
+
+    return {
+        'bytes': len(payload),
+        'encode_per_s': iterations / encode_time,
+        'decode_per_s': iterations / decode_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos codecs do chat")
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--content-size', type=int, default=64,
+                        help="tamanho do texto das chat_message")
+    parser.add_argument('--json', metavar='ARQUIVO', help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'mensagem':<14} {'codec':<8} {'bytes':>7} {'encode/s':>12} {'decode/s':>12}")
+    for message_type, message_obj in sample_messages(args.content_size).items():
+        results[message_type] = {}
+        for codec in chat.CODECS.values():
+            result = measure(codec, message_obj, args.iterations)
+            results[message_type][codec.name] = result
+            print(f"{message_type:<14} {codec.name:<8} {result['bytes']:>7} "
+                  f"{result['encode_per_s']:>12,.0f} {result['decode_per_s']:>12,.0f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'iterations': args.iterations, 'content_size': args.content_size, 'results': results}, f, indent=2)
+        print(f"Resultados gravados em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+# coding=utf-8
+# Carga sintética contra o servidor de chat em loopback.
+#
+# O servidor roda num processo próprio (com a saída descartada e o histórico
+# num arquivo temporário) e os pares sintéticos falam o protocolo do
+# ChatClient a partir de outros processos: handshake name_intro e depois
+# chat_message na taxa e tamanho pedidos. Cada mensagem leva no conteúdo o
+# instante de envio (relógio monotônico, comum aos processos), e quem recebe
+# calcula a latência ponta a ponta do fan-out.
+#
+#   python bench_server.py
+#   python bench_server.py --engines threads,asyncio --codecs json,binary --clients 10,50,200 --json bench.json
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import selectors
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from array import array
+from datetime import datetime
+
+import chat
+
+CONNECT_TIMEOUT = 10.0
+DRAIN_TIME = 1.0
+
+
+def rss_bytes(pid='self'):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Sem /proc só há o pico de memória (em KiB no Linux) deste processo.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if pid == 'self' else 0
+
+
+def cpu_seconds(pid='self'):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        if pid != 'self':
+            return 0.0
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+
+def server_main(engine, port, overflow, flush_delay, workers, conn):
+    # Redireciona o descritor, não só sys.stdout, para calar também os workers.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    history_dir = tempfile.mkdtemp(prefix='bench-chat-')
+    chat.HISTORY = chat.HistoryStore(os.path.join(history_dir, 'history.db'))
+
+    class BenchServer(chat.SERVER_ENGINES[engine]):
+        # Sem console: o servidor só para quando o harness mandar.
+        def _handle_user_input(self):
+            pass
+
+    options = {'workers': workers} if engine == 'workers' else {}
+    # A carga gerada passa de propósito dos limites contra inundação.
+    server = BenchServer('127.0.0.1', port, port + 1, query_port=port + 2, overflow_policy=overflow,
+                         flush_delay=flush_delay, client_rate=(0, 0), room_rate=(0, 0), **options)
+    server.start()
+    conn.send(server.running)
+    while True:
+        command = conn.recv()
+        if command == 'mark':
+            # No modo multiprocesso o servidor inclui os workers.
+            pids = ['self'] + [process.pid for process in getattr(server, 'workers', ())]
+            conn.send({'cpu': sum(cpu_seconds(pid) for pid in pids), 'rss': sum(rss_bytes(pid) for pid in pids)})
+        elif command == 'stop':
+            server.stop()
+            chat.HISTORY.close()
+            conn.send(True)
+            break
+
+
+class Peer:
+    __slots__ = ('index', 'sock', 'decoder', 'codec', 'compressor', 'outbox', 'ready', 'next_send', 'writing')
+
+    def __init__(self, index, sock):
+        self.index = index
+        self.sock = sock
+        self.decoder = chat.FrameDecoder()
+        self.codec = chat.JSON_CODEC
+        self.compressor = None
+        self.outbox = bytearray()
+        self.ready = False
+        self.next_send = 0.0
+        self.writing = False
+
+
+def peer_main(port, first_index, count, codec_name, compression, rate, size, duration, connected, go, results):
+    selector = selectors.DefaultSelector()
+    peers = []
+    for index in range(first_index, first_index + count):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=CONNECT_TIMEOUT)
+        sock.setblocking(False)
+        peer = Peer(index, sock)
+        intro = {
+            'type': 'name_intro',
+            'id': str(uuid.uuid4()),
+            'name': f"bench-{index}",
+            'codecs': [codec_name],
+            'compression': ['zlib'] if compression else [],
+        }
+        peer.outbox += chat.encode_frame(intro)
+        peers.append(peer)
+        selector.register(sock, selectors.EVENT_READ, peer)
+
+    sender_id = str(uuid.uuid4())
+    latencies = array('d')
+    received = 0
+    sent = 0
+    errors = 0
+
+    def flush(peer):
+        nonlocal errors
+        try:
+            written = peer.sock.send(peer.outbox)
+        except BlockingIOError:
+            written = 0
+        except OSError:
+            errors += 1
+            written = len(peer.outbox)
+        del peer.outbox[:written]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if peer.outbox else selectors.EVENT_READ
+        if peer.writing != bool(peer.outbox):
+            peer.writing = bool(peer.outbox)
+            selector.modify(peer.sock, events, peer)
+
+    def pump(timeout, measuring):
+        nonlocal received, errors
+        for key, mask in selector.select(timeout):
+            peer = key.data
+            if mask & selectors.EVENT_WRITE:
+                flush(peer)
+            if not mask & selectors.EVENT_READ:
+                continue
+            try:
+                data = peer.sock.recv(chat.RECV_SIZE)
+            except BlockingIOError:
+                continue
+            except OSError:
+                data = b''
+            if not data:
+                errors += 1
+                peer.ready = False
+                selector.unregister(peer.sock)
+                continue
+            now = time.monotonic()
+            for message_obj in peer.decoder.messages(data):
+                message_type = message_obj['type']
+                if message_type == 'chat_message':
+                    received += 1
+                    if measuring:
+                        latencies.append(now - float(message_obj['content'].split(' ', 1)[0]))
+                elif message_type == 'request_name':
+                    peer.codec = chat.choose_codec(message_obj.get('codecs'))
+                    if 'zlib' in message_obj.get('compression', ()) and compression:
+                        peer.compressor = chat.FrameCompressor()
+                elif message_type == 'room_list':
+                    peer.ready = True
+
+    for peer in peers:
+        flush(peer)
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while not all(peer.ready for peer in peers) and time.monotonic() < deadline:
+        pump(0.1, False)
+    connected.put(sum(peer.ready for peer in peers))
+
+    while not go.is_set():
+        pump(0.05, False)
+    start = time.monotonic()
+    stop_sending = start + duration
+    interval = 1.0 / rate if rate > 0 else 0.0
+    for peer in peers:
+        # Espalha os primeiros envios para os pares não dispararem juntos.
+        peer.next_send = start + random.uniform(0, interval)
+    padding = 'x' * size
+
+    while True:
+        now = time.monotonic()
+        if now >= stop_sending + DRAIN_TIME:
+            break
+        if now < stop_sending:
+            for peer in peers:
+                # Com --rate 0 cada par envia o mais rápido que o servidor aceitar.
+                if peer.ready and now >= peer.next_send and (interval or not peer.outbox):
+                    message_obj = {
+                        'type': 'chat_message',
+                        'sender_id': sender_id,
+                        'content': f"{time.monotonic():.6f} {padding}",
+                        'timestamp': datetime.now().isoformat(),
+                        'room': chat.DEFAULT_ROOM,
+                    }
+                    frame = chat.encode_frame(message_obj, peer.codec)
+                    if peer.compressor is not None:
+                        frame = peer.compressor.compress_frame(frame)
+                    peer.outbox += frame
+                    flush(peer)
+                    sent += 1
+                    peer.next_send += interval
+            next_send = min(peer.next_send for peer in peers)
+            timeout = max(0.0, min(next_send, stop_sending) - time.monotonic())
+        else:
+            timeout = max(0.0, stop_sending + DRAIN_TIME - now)
+        pump(timeout, True)
+
+    for peer in peers:
+        peer.sock.close()
+    results.put({'sent': sent, 'received': received, 'errors': errors, 'latencies': latencies})
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run(engine, codec_name, client_count, args):
+    port = random.randint(20000, 60000)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=server_main, args=(engine, port, args.overflow, args.flush_ms / 1000, args.workers, child_conn))
+    server.start()
+    if not parent_conn.recv():
+        server.join()
+        raise RuntimeError(f"servidor {engine} não iniciou na porta {port}")
+    if engine == 'workers':
+        # Os workers importam o módulo do zero antes de aceitar conexões.
+        time.sleep(args.worker_startup)
+
+    def mark():
+        parent_conn.send('mark')
+        return parent_conn.recv()
+
+    idle = mark()
+    processes_count = max(1, min(args.procs, client_count))
+    connected = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    go = multiprocessing.Event()
+    peers = []
+    first = 0
+    for i in range(processes_count):
+        count = client_count // processes_count + (1 if i < client_count % processes_count else 0)
+        peers.append(multiprocessing.Process(target=peer_main, args=(
+            port, first, count, codec_name, args.compression, args.rate, args.size,
+            args.duration, connected, go, results)))
+        first += count
+    for process in peers:
+        process.start()
+    ready = sum(connected.get() for _ in peers)
+
+    loaded = mark()
+    go.set()
+    started = time.monotonic()
+    time.sleep(args.duration)
+    finished = mark()
+    elapsed = time.monotonic() - started
+
+    peer_results = [results.get() for _ in peers]
+    for process in peers:
+        process.join()
+    parent_conn.send('stop')
+    parent_conn.recv()
+    server.join()
+
+    sent = sum(result['sent'] for result in peer_results)
+    received = sum(result['received'] for result in peer_results)
+    latencies = sorted(value for result in peer_results for value in result['latencies'])
+    expected = sent * (ready - 1)
+    return {
+        'engine': engine,
+        'codec': codec_name,
+        'compression': args.compression,
+        'flush_ms': args.flush_ms,
+        'workers': args.workers if engine == 'workers' else 1,
+        'clients': client_count,
+        'connected': ready,
+        'rate_per_client': args.rate,
+        'size': args.size,
+        'duration_s': elapsed,
+        'sent': sent,
+        'received': received,
+        'delivery_ratio': received / expected if expected else None,
+        'sent_per_s': sent / elapsed,
+        'delivered_per_s': received / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'latency_max_ms': latencies[-1] * 1000 if latencies else None,
+        'latency_mean_ms': statistics.fmean(latencies) * 1000 if latencies else None,
+        'server_cpu_percent': (finished['cpu'] - loaded['cpu']) / elapsed * 100,
+        'server_rss_bytes': finished['rss'],
+        'rss_per_connection_bytes': (loaded['rss'] - idle['rss']) / ready if ready else None,
+        'errors': sum(result['errors'] for result in peer_results),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de carga do servidor de chat")
+    parser.add_argument('--engines', default='threads', help=f"motores a comparar ({', '.join(chat.SERVER_ENGINES)})")
+    parser.add_argument('--codecs', default='json', help=f"codecs a comparar ({', '.join(chat.CODECS)})")
+    parser.add_argument('--clients', default='10,50', help="lista de quantidades de clientes")
+    parser.add_argument('--rate', type=float, default=5.0, help="mensagens por segundo de cada cliente (0 = sem limite)")
+    parser.add_argument('--size', type=int, default=64, help="bytes de texto em cada mensagem")
+    parser.add_argument('--duration', type=float, default=10.0, help="segundos medidos por execução")
+    parser.add_argument('--procs', type=int, default=os.cpu_count() or 1, help="processos geradores de carga")
+    parser.add_argument('--overflow', choices=chat.OVERFLOW_POLICIES, default=chat.OVERFLOW_POLICY)
+    parser.add_argument('--compression', action='store_true', help="negocia compressão zlib")
+    parser.add_argument('--flush-ms', type=float, default=chat.WRITE_FLUSH_DELAY * 1000,
+                        help="prazo de micro-lote das escritas do servidor")
+    parser.add_argument('--workers', type=int, default=chat.WORKER_COUNT, help="processos do motor 'workers'")
+    parser.add_argument('--worker-startup', type=float, default=1.0, help="segundos de espera pelos workers")
+    parser.add_argument('--json', metavar='ARQUIVO', help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    rows = []
+    print(f"{'motor':<8} {'codec':<7} {'clientes':>8} {'env/s':>9} {'entr/s':>10} {'p50 (ms)':>9} "
+          f"{'p99 (ms)':>9} {'CPU %':>6} {'KiB/conexão':>12}")
+    for engine in args.engines.split(','):
+        for codec_name in args.codecs.split(','):
+            for client_count in (int(n) for n in args.clients.split(',')):
+                row = run(engine, codec_name, client_count, args)
+                rows.append(row)
+                p50 = f"{row['latency_p50_ms']:.2f}" if row['latency_p50_ms'] is not None else '-'
+                p99 = f"{row['latency_p99_ms']:.2f}" if row['latency_p99_ms'] is not None else '-'
+                per_conn = f"{row['rss_per_connection_bytes'] / 1024:.1f}" if row['rss_per_connection_bytes'] is not None else '-'
+                print(f"{engine:<8} {codec_name:<7} {row['connected']:>4}/{client_count:<4}"
+                      f"{row['sent_per_s']:>9.0f} {row['delivered_per_s']:>10.0f} {p50:>9} {p99:>9} "
+                      f"{row['server_cpu_percent']:>6.1f} {per_conn:>12}")
+
+    if args.json:
+        meta = {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'runs': rows}, f, indent=2)
+        print(f"Resultados gravados em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# coding=utf-8
+# Mede o tempo de abertura do chat até o menu, de fora do processo: no
+# executável one-file do PyInstaller isso inclui descompactar o pacote, que o
+# relatório interno (--startup-report) não enxerga. Cada rodada usa uma pasta
+# temporária com um user_data.json pronto, então nada é perguntado.
+#
+#   python bench_startup.py
+#   python bench_startup.py --cmd dist/chat --runs 10 --budget-ms 800 --json abertura.json
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import chat
+
+
+def run_once(command):
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, chat.USER_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'id': str(uuid.uuid4()), 'name': 'bench'}, f)
+        report_path = os.path.join(workdir, 'startup.json')
+        start = time.perf_counter()
+        subprocess.run(command + ['--startup-report', report_path, '--exit-after-startup'], cwd=workdir,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+        wall_ms = (time.perf_counter() - start) * 1000
+        with open(report_path, encoding='utf-8') as f:
+            report = json.load(f)
+    return wall_ms, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempo de abertura do chat")
+    parser.add_argument('--cmd', help="comando que abre o chat (padrão: este Python com chat.py)")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=chat.STARTUP_BUDGET_MS,
+                        help="orçamento para a mediana do tempo total; acima dele o script sai com erro")
+    parser.add_argument('--json', metavar='ARQUIVO', help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    if args.cmd:
+        command = shlex.split(args.cmd)
+    else:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat.py')]
+
+    walls = []
+    phases = {}
+    for _ in range(args.runs):
+        wall_ms, report = run_once(command)
+        walls.append(wall_ms)
+        for phase, elapsed in report['phases_ms'].items():
+            phases.setdefault(phase, []).append(elapsed)
+        phases.setdefault('(dentro do processo)', []).append(report['total_ms'])
+
+    print(f"{'fase':<22} {'mediana (ms)':>12} {'max (ms)':>10}")
+    for phase, values in phases.items():
+        print(f"{phase:<22} {statistics.median(values):>12.1f} {max(values):>10.1f}")
+    median_wall = statistics.median(walls)
+    print(f"{'total (de fora)':<22} {median_wall:>12.1f} {max(walls):>10.1f}")
+    within = median_wall <= args.budget_ms
+    print(f"Orçamento de {args.budget_ms:g} ms: {'ok' if within else 'ESTOURADO'}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'command': command,
+                'runs': args.runs,
+                'budget_ms': args.budget_ms,
+                'wall_ms': walls,
+                'phases_ms': phases,
+            }, f, indent=2)
+        print(f"Resultados gravados em {args.json}")
+    sys.exit(0 if within else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,220 @@
 # coding=utf-8
+import time
+STARTED_AT = time.perf_counter()
+
 import socket
+import sys
 import threading
 import json
-import uuid
+import importlib
 import os
-import time
-from datetime import datetime
+import collections
+import atexit
+import mmap
+import struct
+import random
+import signal
+import zlib
+from array import array
+from datetime import datetime, timedelta
+
+
+class LazyModule:
+    # Adia o import de um subsistema até o primeiro uso. O menu não precisa de
+    # asyncio, sqlite3, multiprocessing nem uuid, e juntos eles são a maior
+    # parte do tempo de import. No primeiro acesso o módulo de verdade
+    # substitui o proxy no namespace, então os acessos seguintes não pagam nada.
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._name] = module
+        return getattr(module, attr)
+
+# Ao empacotar com PyInstaller estes módulos precisam estar em hiddenimports
+# (veja chat.spec), já que a análise não enxerga imports adiados.
+LAZY_MODULES = ('asyncio', 'sqlite3', 'multiprocessing', 'uuid')
+asyncio = LazyModule('asyncio')
+sqlite3 = LazyModule('sqlite3')
+multiprocessing = LazyModule('multiprocessing')
+uuid = LazyModule('uuid')
 
 CHAT_PORT = 12345
 DISCOVERY_PORT = 12346
+QUERY_PORT = 12347
 BUFFER_SIZE = 1024
+RECV_SIZE = 65536
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+LISTEN_BACKLOG = 128
+
+# Fila de saída por cliente. Quando enche, a política decide o que fazer:
+# 'drop_oldest' descarta a mensagem mais antiga, 'disconnect' derruba o
+# cliente lento e 'backpressure' segura quem envia até abrir espaço.
+SEND_QUEUE_SIZE = 256
+OVERFLOW_POLICY = 'drop_oldest'
+OVERFLOW_POLICIES = ('drop_oldest', 'disconnect', 'backpressure')
+BACKPRESSURE_TIMEOUT = 2.0
+# Cada escritor junta até WRITE_BATCH_FRAMES frames (ou WRITE_BATCH_BYTES) da
+# fila numa única chamada sendmsg. Com WRITE_FLUSH_DELAY > 0 ele espera até
+# esse tempo por mais frames antes de escrever, trocando alguns
+# milissegundos de latência por vazão em salas movimentadas.
+WRITE_BATCH_FRAMES = 64
+WRITE_BATCH_BYTES = 256 * 1024
+WRITE_FLUSH_DELAY = 0.0
+
+# Batimentos: o host manda ping a quem está quieto há HEARTBEAT_INTERVAL
+# segundos e derruba quem passar de HEARTBEAT_TIMEOUT sem sinal de vida (ou
+# quem conectou e nunca terminou o handshake). Uma única roda de tempo, com
+# TIMER_WHEEL_SLOTS posições de HEARTBEAT_TICK segundos, acompanha todas as
+# conexões. O keepalive do TCP é opcional e cobre clientes antigos, que não
+# respondem ping.
+HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_TIMEOUT = 30.0
+HEARTBEAT_TICK = 0.5
+TIMER_WHEEL_SLOTS = 128
+TCP_KEEPALIVE = False
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+# Proteção contra inundação. Cada conexão tem um balde de fichas para
+# mensagens e outro para bytes, e cada sala tem os seus, divididos por quem
+# fala nela; cabem rajadas de até RATE_BURST segundos de tráfego. Quem passa
+# do limite é estrangulado: o host para de ler dele pelo tempo que falta para
+# pagar o excesso, e o TCP segura o resto. Uma rajada (colar um log, reenviar
+# o que ficou pendente numa reconexão) só atrasa. É desconectado quem segue à
+# frente do limite até a espera acumulada, sem nenhuma mensagem passar
+# direto, somar RATE_MAX_DEBT segundos. Frames de clientes acima de
+# CLIENT_MAX_FRAME_SIZE são recusados pelo cabeçalho, antes de qualquer
+# decodificação. Taxa 0 desliga.
+CLIENT_MESSAGE_RATE = 10.0
+CLIENT_BYTE_RATE = 64 * 1024
+ROOM_MESSAGE_RATE = 50.0
+ROOM_BYTE_RATE = 256 * 1024
+RATE_BURST = 3.0
+RATE_MAX_DEBT = 30.0
+CLIENT_MAX_FRAME_SIZE = 256 * 1024
+
+# A busca termina ao achar DISCOVERY_EARLY_HOSTS hosts ou após DISCOVERY_WAIT_MS.
+DISCOVERY_EARLY_HOSTS = 1
+DISCOVERY_WAIT_MS = 5000
+
+# Modo multiprocesso ('--engine workers'): WORKER_COUNT processos aceitam
+# conexões no mesmo socket de escuta, e as mensagens das salas passam por um
+# barramento local (pares de sockets Unix) onde o processo principal numera
+# cada uma e a repassa a todos os workers. O principal não decodifica as
+# mensagens que repassa: só numera e põe na fila de saída de cada worker
+# (até BUS_QUEUE_SIZE frames; um worker tão atrasado assim é desligado).
+WORKER_COUNT = os.cpu_count() or 1
+BUS_QUEUE_SIZE = 65536
+
+# Um mesmo host atende várias salas na mesma porta; quem não escolhe cai na padrão.
+DEFAULT_ROOM = 'geral'
+ROOM_NAME_MAX = 32
+
+# O host numera as mensagens de cada sala e guarda as últimas
+# REPLAY_BUFFER_SIZE, já codificadas. Um cliente que cai tenta voltar sozinho
+# ao mesmo host (espera exponencial com jitter) e recebe só o que perdeu; quem
+# entra numa sala recebe as últimas HISTORY_SYNC_SIZE (ou menos, se pedir).
+REPLAY_BUFFER_SIZE = 256
+HISTORY_SYNC_SIZE = 50
+RECONNECT_ATTEMPTS = 6
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8.0
+RECONNECT_TIMEOUT = 3.0
+
+# Beacons saem rápido quando o host começa e vão espaçando exponencialmente
+# enquanto a sala fica parada. Alguém entrar/sair só volta o espaçamento ao
+# mínimo a partir do próximo beacon; só uma mudança no conteúdo (sala nova)
+# antecipa o envio, e nunca a menos de BEACON_MIN_INTERVAL do anterior. Quem
+# procura um chat não precisa esperar o próximo beacon: manda uma consulta em
+# QUERY_PORT e os hosts respondem direto (unicast).
+BEACON_MIN_INTERVAL = 0.5
+BEACON_MAX_INTERVAL = 16.0
+BEACON_BACKOFF = 2.0
+# Hosts somem do registro de descoberta se ficarem este tempo sem beacon. Um
+# host parado só manda um a cada BEACON_MAX_INTERVAL, então o prazo cobre
+# três deles: perder um ou dois datagramas não tira o host da lista.
+DISCOVERY_TTL = 3 * BEACON_MAX_INTERVAL
+# Datagramas são lidos inteiros (um recvfrom menor que o datagrama corta o
+# resto). O host anuncia no máximo DISCOVERY_MAX_ROOMS salas e mantém o
+# beacon abaixo de DISCOVERY_MAX_BYTES para caber num pacote sem fragmentar;
+# a lista completa chega ao conectar.
+DATAGRAM_SIZE = 65535
+DISCOVERY_MAX_ROOMS = 24
+DISCOVERY_MAX_BYTES = 1200
+
+# Cada mensagem TCP vai precedida do tamanho do payload (4 bytes, big-endian)
+# e de um byte de flags; os bits baixos dizem qual codec gerou o payload.
+FRAME_HEADER = struct.Struct('!IB')
+FLAG_CODEC_MASK = 0x0F
+FLAG_COMPRESSED = 0x80
+# Frames de FLAG_FILE_CHUNK não passam por codec nem compressão: o payload é
+# FILE_CHUNK_HEADER (transferência, destinatário, offset, CRC32) seguido dos
+# bytes do arquivo, e o host repassa o frame como chegou.
+FLAG_FILE_CHUNK = 0x40
+FILE_CHUNK_HEADER = struct.Struct('!16s16sQI')
+# Só no barramento do modo multiprocesso: mensagem de sala com cabeçalho de
+# rota (número na sala, endereço de quem mandou, worker de origem, codec,
+# tamanhos da sala e do nome) seguido da sala, do nome e da mensagem já
+# codificada. O processo principal só reescreve o número.
+FLAG_BUS_ROUTED = 0x20
+BUS_ROUTE = struct.Struct('!Q4sHBBBB')
+BUS_SEQ = struct.Struct('!Q')
+BUS_NO_ORIGIN = 255
+
+# Frames a partir deste tamanho são comprimidos com zlib quando os dois lados
+# anunciam suporte no handshake. O contexto zlib dura a sessão inteira, então
+# nomes de campos e textos repetidos entre mensagens também comprimem.
+COMPRESSION_ENABLED = True
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+
+# Arquivos vão em pedaços de FILE_CHUNK_SIZE, lidos do disco via mmap. Quem
+# oferece anuncia na sala (file_offer), cada interessado aceita dizendo quantos
+# bytes já tem (file_accept) e recebe um fluxo próprio a partir dali; cada
+# pedaço é confirmado (file_ack) e no máximo FILE_WINDOW ficam sem
+# confirmação, então mensagens de texto passam entre eles. Pedaço corrompido
+# ou perdido faz o recebedor pedir de novo a partir do último byte bom.
+FILE_CHUNK_SIZE = 64 * 1024
+FILE_WINDOW = 8
+FILE_ACK_TIMEOUT = 15.0
+DOWNLOAD_DIR = 'recebidos'
+
+# Saída no terminal: as threads de rede só enfileiram linhas, e uma thread
+# própria as escreve, juntando numa única escrita tudo o que se acumulou. Se
+# o terminal (ou o arquivo para onde a saída foi redirecionada) não der
+# conta, ficam no máximo CONSOLE_QUEUE_SIZE linhas na fila: as mais antigas
+# são descartadas e o total descartado é avisado.
+CONSOLE_QUEUE_SIZE = 1000
+
+# Métricas de execução (contadores e histogramas). Desligadas custam um teste
+# de atributo nos caminhos quentes. Ligadas, ficam disponíveis em
+# 127.0.0.1:METRICS_PORT (texto ou JSON) e, se pedido, num arquivo regravado
+# a cada METRICS_DUMP_INTERVAL segundos.
+METRICS_ENABLED = False
+METRICS_PORT = 12348
+METRICS_DUMP_INTERVAL = 10.0
+# No modo multiprocesso cada worker manda seus números ao processo principal
+# a cada METRICS_WORKER_INTERVAL segundos (só com as métricas ligadas).
+METRICS_WORKER_INTERVAL = 1.0
+SAMPLER_INTERVAL = 0.005
+SAMPLER_TOP = 15
+
+# Orçamento para a abertura até o menu (imports, dados do usuário, IP local,
+# escuta de descoberta). Com --startup-report o tempo de cada fase é mostrado
+# e, se pedido, gravado em JSON; bench_startup.py mede o executável inteiro.
+STARTUP_BUDGET_MS = 250
+
+# Ordem de preferência ao negociar o codec no handshake.
+PREFERRED_CODECS = ('binary', 'json')
+DISCOVERY_CODEC = 'binary'
 
 USER_FILE = 'user_data.json'
 
+USER_DATA = None
+
 def load_user_data():
     if os.path.exists(USER_FILE):
         try:
@@ -23,291 +225,3118 @@ def load_user_data():
             os.remove(USER_FILE)
             return None
         except Exception as e:
-            print(f"Erro ao carregar dados do usuário: {e}")
-            return None
-    return None
+            print(f"Erro ao carregar dados do usuário: {e}")
+            return None
+    return None
+
+def save_user_data(user_id, user_name, local_ip=None):
+    global USER_DATA
+    USER_DATA = {'id': user_id, 'name': user_name}
+    if local_ip is not None:
+        USER_DATA['local_ip'] = local_ip
+    try:
+        with open(USER_FILE, 'w', encoding='utf-8') as f:
+            json.dump(USER_DATA, f)
+    except Exception as e:
+        print(f"Erro ao salvar dados do usuário: {e}")
+
+MY_ID = None
+MY_NAME = None
+
+class ConsoleWriter:
+    def __init__(self, max_lines=CONSOLE_QUEUE_SIZE, stream=None):
+        self.max_lines = max_lines
+        # Sem stream fixo, usa o sys.stdout da hora da escrita.
+        self.stream = stream
+        self.lines = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.writing = False
+        self.thread = None
+
+    def write(self, text):
+        with self.cond:
+            if len(self.lines) >= self.max_lines:
+                self.lines.popleft()
+                self.dropped += 1
+            self.lines.append(text)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            elif not self.writing:
+                self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+                while not self.lines:
+                    self.cond.wait()
+                self.writing = True
+                lines = list(self.lines)
+                self.lines.clear()
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                lines.insert(0, f"({dropped} linha(s) não mostrada(s): o terminal não acompanhou)")
+            stream = self.stream or sys.stdout
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+            if METRICS.enabled:
+                METRICS.incr(console_writes=1, console_lines=len(lines), console_dropped=dropped)
+
+    def flush(self, timeout=2.0):
+        # Espera a fila esvaziar; usado antes do menu e na saída do programa.
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.lines and not self.writing, timeout)
+
+CONSOLE = ConsoleWriter()
+atexit.register(CONSOLE.flush)
+
+def show(text):
+    CONSOLE.write(text)
+
+CONTACTS = {}
+CONTACTS_LOCK = threading.Lock()
+
+def remember_contact(contact_id, name):
+    with CONTACTS_LOCK:
+        if contact_id in CONTACTS:
+            return False
+        CONTACTS[contact_id] = name
+        return True
+
+class FrameError(ValueError):
+    pass
+
+class CodecError(ValueError):
+    pass
+
+class JSONCodec:
+    name = 'json'
+    codec_id = 0
+
+    def encode(self, message_obj):
+        return json.dumps(message_obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, payload):
+        message_obj = json.loads(payload)
+        if not isinstance(message_obj, dict):
+            raise CodecError("Mensagem JSON não é um objeto")
+        return message_obj
+
+class BinaryCodec:
+    # Formato compacto: 1 byte com o tipo da mensagem, UUIDs em 16 bytes,
+    # timestamps como microssegundos desde 1970 (int64) e textos com prefixo
+    # de tamanho. Campos fora do esquema vão num apêndice JSON no final.
+    # Mensagens que não cabem no esquema (UUID ou timestamp fora do padrão,
+    # tipos desconhecidos) são codificadas em JSON por encode_payload.
+    name = 'binary'
+    codec_id = 1
+
+    EPOCH = datetime(1970, 1, 1)
+    SCHEMAS = {
+        'discovery': (1, (('host_ip', 'ip'), ('chat_port', 'port'), ('host_id', 'uuid'), ('host_name', 'str'))),
+        'request_name': (2, (('data', 'uuid'),)),
+        'name_intro': (3, (('id', 'uuid'), ('name', 'str'))),
+        'chat_message': (4, (('sender_id', 'uuid'), ('timestamp', 'time'), ('room', 'str'), ('content', 'text'))),
+    }
+    TYPES_BY_TAG = {tag: (message_type, fields) for message_type, (tag, fields) in SCHEMAS.items()}
+
+    SHORT_LEN = struct.Struct('!H')
+    LONG_LEN = struct.Struct('!I')
+    PORT = struct.Struct('!H')
+    TIME = struct.Struct('!q')
+
+    def encode(self, message_obj):
+        schema = self.SCHEMAS.get(message_obj.get('type'))
+        if schema is None:
+            return None
+        tag, fields = schema
+        parts = [bytes((tag,))]
+        try:
+            for field, kind in fields:
+                parts.append(self._pack(kind, message_obj[field]))
+        except (KeyError, TypeError, ValueError, OSError, struct.error):
+            return None
+        known = {'type'}
+        known.update(field for field, _ in fields)
+        extra = {key: value for key, value in message_obj.items() if key not in known}
+        parts.append(self._pack('text', json.dumps(extra, separators=(',', ':')) if extra else ''))
+        return b''.join(parts)
+
+    def _pack(self, kind, value):
+        # Valor de tipo errado vira ValueError e a mensagem cai para JSON.
+        if kind != 'port' and not isinstance(value, str):
+            raise ValueError(value)
+        if kind == 'uuid':
+            # Só UUIDs na forma canônica (minúsculas, com hífens) voltam iguais.
+            if len(value) != 36 or value[8] != '-' or value[13] != '-' or value[18] != '-' or value[23] != '-' or value != value.lower():
+                raise ValueError(value)
+            return bytes.fromhex(value.replace('-', ''))
+        if kind == 'time':
+            moment = datetime.fromisoformat(value)
+            if moment.tzinfo is not None or moment.isoformat() != value:
+                raise ValueError(value)
+            return self.TIME.pack((moment - self.EPOCH) // timedelta(microseconds=1))
+        if kind == 'ip':
+            packed = socket.inet_aton(value)
+            if socket.inet_ntoa(packed) != value:
+                raise ValueError(value)
+            return packed
+        if kind == 'port':
+            return self.PORT.pack(value)
+        raw = value.encode('utf-8')
+        length = self.SHORT_LEN if kind == 'str' else self.LONG_LEN
+        return length.pack(len(raw)) + raw
+
+    def decode(self, payload):
+        try:
+            message_type, fields = self.TYPES_BY_TAG[payload[0]]
+            message_obj = {'type': message_type}
+            offset = 1
+            for field, kind in fields:
+                message_obj[field], offset = self._unpack(kind, payload, offset)
+            extra, offset = self._unpack('text', payload, offset)
+        except (IndexError, KeyError, UnicodeDecodeError, struct.error) as e:
+            raise CodecError(f"Payload binário inválido: {e}") from e
+        if extra:
+            try:
+                extra = json.loads(extra)
+            except ValueError as e:
+                raise CodecError(f"Apêndice JSON inválido: {e}") from e
+            if not isinstance(extra, dict):
+                raise CodecError("Apêndice JSON não é um objeto")
+            message_obj.update(extra)
+        return message_obj
+
+    def _unpack(self, kind, payload, offset):
+        if kind == 'uuid':
+            if len(payload) < offset + 16:
+                raise IndexError("uuid truncado")
+            h = payload[offset:offset + 16].hex()
+            return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}", offset + 16
+        if kind == 'time':
+            (micros,) = self.TIME.unpack_from(payload, offset)
+            return (self.EPOCH + timedelta(microseconds=micros)).isoformat(), offset + self.TIME.size
+        if kind == 'ip':
+            if len(payload) < offset + 4:
+                raise IndexError("ip truncado")
+            return socket.inet_ntoa(bytes(payload[offset:offset + 4])), offset + 4
+        if kind == 'port':
+            return self.PORT.unpack_from(payload, offset)[0], offset + self.PORT.size
+        length = self.SHORT_LEN if kind == 'str' else self.LONG_LEN
+        (size,) = length.unpack_from(payload, offset)
+        start = offset + length.size
+        if len(payload) < start + size:
+            raise IndexError("texto truncado")
+        return bytes(payload[start:start + size]).decode('utf-8'), start + size
+
+JSON_CODEC = JSONCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+CODECS_BY_ID = {codec.codec_id: codec for codec in CODECS.values()}
+
+def choose_codec(offered):
+    # Primeiro codec da nossa preferência que o outro lado também fala;
+    # peers antigos não anunciam nada e ficam no JSON.
+    for name in PREFERRED_CODECS:
+        if name in (offered or ()):
+            return CODECS[name]
+    return JSON_CODEC
+
+def encode_payload(message_obj, codec=JSON_CODEC):
+    if codec is not JSON_CODEC:
+        payload = codec.encode(message_obj)
+        if payload is not None:
+            return codec.codec_id, payload
+    return JSON_CODEC.codec_id, JSON_CODEC.encode(message_obj)
+
+def decode_payload(flags, payload):
+    if flags & FLAG_FILE_CHUNK:
+        return decode_file_chunk(payload)
+    codec = CODECS_BY_ID.get(flags & FLAG_CODEC_MASK)
+    if codec is None:
+        raise CodecError(f"Codec desconhecido: {flags & FLAG_CODEC_MASK}")
+    return codec.decode(payload)
+
+def encode_frame(message_obj, codec=JSON_CODEC):
+    codec_id, payload = encode_payload(message_obj, codec)
+    return FRAME_HEADER.pack(len(payload), codec_id) + payload
+
+def send_message(sock, message_obj, codec=JSON_CODEC):
+    sock.sendall(encode_frame(message_obj, codec))
+
+def encode_file_chunk(transfer_id, receiver_id, offset, data):
+    # Cabeçalhos e dados ficam em buffers separados: os dados podem ser uma
+    # fatia do mmap do arquivo e vão direto para o sendmsg, sem cópia.
+    header = FILE_CHUNK_HEADER.pack(uuid.UUID(transfer_id).bytes, uuid.UUID(receiver_id).bytes, offset, zlib.crc32(data))
+    return [FRAME_HEADER.pack(len(header) + len(data), FLAG_FILE_CHUNK) + header, data]
+
+def decode_file_chunk(payload):
+    try:
+        transfer_id, receiver_id, offset, crc = FILE_CHUNK_HEADER.unpack_from(payload)
+    except struct.error as e:
+        raise CodecError(f"Chunk de arquivo inválido: {e}") from e
+    return {
+        'type': 'file_chunk',
+        'transfer_id': str(uuid.UUID(bytes=transfer_id)),
+        'receiver_id': str(uuid.UUID(bytes=receiver_id)),
+        'offset': offset,
+        'crc': crc,
+        'data': memoryview(payload)[FILE_CHUNK_HEADER.size:],
+        'payload': payload,
+    }
+
+def file_frame(message_obj):
+    # Frame para repassar uma mensagem de arquivo a outra conexão. Os
+    # controles não têm esquema binário e vão em JSON, que todo peer lê.
+    if message_obj['type'] == 'file_chunk':
+        payload = message_obj['payload']
+        return FRAME_HEADER.pack(len(payload), FLAG_FILE_CHUNK) + payload
+    return encode_frame(message_obj)
+
+FILE_MESSAGES = ('file_accept', 'file_ack', 'file_chunk')
+
+def file_target(message_obj):
+    # Aceites e confirmações vão para quem oferece o arquivo; pedaços, para quem recebe.
+    if message_obj['type'] == 'file_chunk':
+        return message_obj['receiver_id']
+    return message_obj.get('sender_id')
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def encode_datagram(message_obj, codec=JSON_CODEC):
+    # Datagramas de descoberta não têm cabeçalho: JSON sempre começa com '{'
+    # e o formato binário começa com o byte do tipo, então dá para distinguir.
+    return encode_payload(message_obj, codec)[1]
+
+def decode_datagram(data):
+    if data[:1] == b'{':
+        return JSON_CODEC.decode(data)
+    return BINARY_CODEC.decode(data)
+
+COMPRESSION_STATS = {'frames': 0, 'bytes_in': 0, 'bytes_out': 0}
+COMPRESSION_STATS_LOCK = threading.Lock()
+
+def compression_methods():
+    return ['zlib'] if COMPRESSION_ENABLED else []
+
+def compression_summary():
+    with COMPRESSION_STATS_LOCK:
+        stats = dict(COMPRESSION_STATS)
+    stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+    return stats
+
+def print_compression_summary():
+    stats = compression_summary()
+    if stats['frames']:
+        print(f"Compressão: {stats['frames']} mensagens comprimidas, {stats['bytes_saved']} bytes economizados "
+              f"({stats['bytes_in']} -> {stats['bytes_out']}).")
+
+class Histogram:
+    # Buckets em potências de 2 (microssegundos): registrar custa um
+    # bit_length, e os percentis saem com erro de no máximo 2x.
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 40
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.buckets[min(value.bit_length(), 39)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        threshold = fraction * self.count
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= threshold:
+                return min(1 << index, self.max)
+        return self.max
+
+    def state(self):
+        return [self.buckets, self.count, self.total, self.max]
+
+    def merge(self, state):
+        buckets, count, total, maximum = state
+        self.buckets = [a + b for a, b in zip(self.buckets, buckets)]
+        self.count += count
+        self.total += total
+        self.max = max(self.max, maximum)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_us': self.total / self.count if self.count else 0,
+            'p50_us': self.percentile(0.50),
+            'p99_us': self.percentile(0.99),
+            'max_us': self.max,
+        }
+
+class Metrics:
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.gauges = {}
+        # Últimos números recebidos de cada worker do modo multiprocesso.
+        self.remote = {}
+        self.started = time.time()
+
+    def incr(self, **amounts):
+        with self.lock:
+            self.counters.update(amounts)
+
+    def observe(self, name, seconds):
+        value = int(seconds * 1000000)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, callback):
+        # Gauges são calculados só quando alguém lê as métricas.
+        self.gauges[name] = callback
+
+    def remove_gauge(self, name):
+        self.gauges.pop(name, None)
+
+    def _read_gauges(self):
+        gauges = {}
+        for name, callback in list(self.gauges.items()):
+            try:
+                gauges[name] = callback()
+            except Exception:
+                gauges[name] = None
+        return gauges
+
+    def export(self):
+        # Estado cru (acumulado) deste processo, para o processo principal somar.
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.state() for name, histogram in self.histograms.items()}
+        return {'counters': counters, 'histograms': histograms, 'gauges': self._read_gauges(),
+                'compression': compression_summary()}
+
+    def merge(self, source, state):
+        with self.lock:
+            self.remote[source] = state
+
+    def snapshot(self):
+        with self.lock:
+            counters = collections.Counter(self.counters)
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = Histogram()
+                histograms[name].merge(histogram.state())
+            remote = dict(self.remote)
+        compression = compression_summary()
+        workers = {}
+        for source, state in sorted(remote.items()):
+            counters.update(state['counters'])
+            for name, histogram_state in state['histograms'].items():
+                histograms.setdefault(name, Histogram()).merge(histogram_state)
+            for name, value in state['compression'].items():
+                compression[name] = compression.get(name, 0) + value
+            workers[source] = state['gauges']
+        snapshot = {
+            'enabled': self.enabled,
+            'uptime_s': round(time.time() - self.started, 3),
+            'counters': dict(counters),
+            'gauges': self._read_gauges(),
+            'histograms': {name: histogram.summary() for name, histogram in histograms.items()},
+            'compression': compression,
+        }
+        if workers:
+            snapshot['workers'] = workers
+        return snapshot
+
+    def render_text(self):
+        snapshot = self.snapshot()
+        lines = [f"enabled {int(snapshot['enabled'])}", f"uptime_s {snapshot['uptime_s']}"]
+        for section in ('counters', 'gauges', 'compression'):
+            for name, value in sorted(snapshot[section].items()):
+                prefix = 'compression_' if section == 'compression' else ''
+                lines.append(f"{prefix}{name} {value}")
+        for source, gauges in snapshot.get('workers', {}).items():
+            for name, value in sorted(gauges.items()):
+                lines.append(f"worker{source}_{name} {value}")
+        for name, summary in sorted(snapshot['histograms'].items()):
+            lines.append(f"{name}_us count={summary['count']} mean={summary['mean_us']:.1f} "
+                         f"p50={summary['p50_us']} p99={summary['p99_us']} max={summary['max_us']}")
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+
+class MetricsExporter:
+    # Endpoint local de leitura das métricas: responde a um GET HTTP
+    # (/metrics ou /metrics.json) ou a uma linha 'text'/'json' crua, e grava
+    # periodicamente o JSON em dump_path, se configurado.
+    def __init__(self, metrics, port=METRICS_PORT, dump_path=None, dump_interval=METRICS_DUMP_INTERVAL):
+        self.metrics = metrics
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.sock = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind(('127.0.0.1', self.port))
+                sock.listen(8)
+            except OSError as e:
+                sock.close()
+                print(f"Aviso: endpoint de métricas desativado (porta {self.port}): {e}")
+            else:
+                self.sock = sock
+                threading.Thread(target=self._serve, daemon=True).start()
+                print(f"Métricas em http://127.0.0.1:{self.port}/metrics (ou /metrics.json)")
+        if self.dump_path:
+            threading.Thread(target=self._dump_loop, daemon=True).start()
+
+    def _serve(self):
+        while not self.stopped.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            try:
+                conn.settimeout(1.0)
+                request = conn.recv(BUFFER_SIZE).decode('latin-1')
+                if request.startswith('GET '):
+                    path = request.split()[1]
+                    as_json = path.endswith('.json') or 'format=json' in path
+                    body = self._render(as_json).encode('utf-8')
+                    content_type = 'application/json' if as_json else 'text/plain; charset=utf-8'
+                    conn.sendall(f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\n"
+                                 f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+                else:
+                    conn.sendall(self._render(request.strip() == 'json').encode('utf-8'))
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    def _render(self, as_json):
+        if as_json:
+            return json.dumps(self.metrics.snapshot(), indent=2) + '\n'
+        return self.metrics.render_text()
+
+    def _dump_loop(self):
+        while not self.stopped.wait(self.dump_interval):
+            self.dump()
+
+    def dump(self):
+        temp_path = f"{self.dump_path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self._render(True))
+            os.replace(temp_path, self.dump_path)
+        except OSError as e:
+            print(f"Erro ao gravar métricas em {self.dump_path}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock is not None:
+            self.sock.close()
+        if self.dump_path:
+            self.dump()
+
+class StackSampler:
+    # Perfil de CPU por amostragem: olha a pilha de todas as threads a cada
+    # SAMPLER_INTERVAL segundos. Diferente do cProfile, que só vê a thread que
+    # o ligou, isto enxerga leitores, escritores e o event loop de uma vez.
+    def __init__(self, interval=SAMPLER_INTERVAL):
+        self.interval = interval
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.samples += 1
+                self.own[self._label(frame.f_code)] += 1
+                seen = set()
+                while frame is not None:
+                    label = self._label(frame.f_code)
+                    if label not in seen:
+                        seen.add(label)
+                        self.cumulative[label] += 1
+                    frame = frame.f_back
+
+    @staticmethod
+    def _label(code):
+        return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.report()
+
+    def report(self, top=SAMPLER_TOP):
+        lines = [f"{self.samples} amostras"]
+        for title, counter in (('próprio', self.own), ('acumulado', self.cumulative)):
+            lines.append(f"-- mais tempo ({title}) --")
+            for label, amount in counter.most_common(top):
+                lines.append(f"{amount / max(self.samples, 1):7.1%}  {label}")
+        return '\n'.join(lines)
+
+PROFILER = None
+
+def toggle_profiler():
+    global PROFILER
+    if PROFILER is None:
+        PROFILER = StackSampler()
+        PROFILER.start()
+        print("Amostragem de CPU ligada. Use /perfil de novo para ver o resultado.")
+    else:
+        sampler, PROFILER = PROFILER, None
+        print(sampler.stop())
+
+def toggle_tracemalloc():
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        print("Rastreamento de memória ligado. Use /memoria de novo para ver o resultado.")
+        return
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Memória rastreada: {current / 1024:.1f} KiB (pico {peak / 1024:.1f} KiB)")
+    for stat in snapshot.statistics('lineno')[:SAMPLER_TOP]:
+        print(f"  {stat}")
+
+def handle_diagnostic_command(command, argument):
+    if command == '/metricas':
+        if argument in ('on', 'off'):
+            METRICS.enabled = argument == 'on'
+            print(f"Métricas {'ligadas' if METRICS.enabled else 'desligadas'}.")
+        else:
+            print(METRICS.render_text(), end='')
+    elif command == '/perfil':
+        toggle_profiler()
+    elif command == '/memoria':
+        toggle_tracemalloc()
+    else:
+        return False
+    return True
+
+class FrameCompressor:
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.compressor = zlib.compressobj(level)
+
+    def compress_frame(self, frame):
+        length, flags = FRAME_HEADER.unpack_from(frame)
+        if length < self.threshold or flags & FLAG_FILE_CHUNK:
+            return frame
+        payload = memoryview(frame)[FRAME_HEADER.size:]
+        compressed = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        with COMPRESSION_STATS_LOCK:
+            COMPRESSION_STATS['frames'] += 1
+            COMPRESSION_STATS['bytes_in'] += length
+            COMPRESSION_STATS['bytes_out'] += len(compressed)
+        return FRAME_HEADER.pack(len(compressed), flags | FLAG_COMPRESSED) + compressed
+
+def join_frames(item, compressor=None):
+    # Um item da fila de saída é um frame ou uma lista de frames que sai
+    # numa única escrita (replay e histórico de quem acabou de entrar).
+    if isinstance(item, list):
+        if compressor is None:
+            return b''.join(item)
+        return b''.join(compressor.compress_frame(frame) for frame in item)
+    return item if compressor is None else compressor.compress_frame(item)
+
+def item_size(item):
+    return sum(map(len, item)) if isinstance(item, list) else len(item)
+
+def take_batch(queue):
+    batch = [queue.popleft()]
+    size = item_size(batch[0])
+    while queue and len(batch) < WRITE_BATCH_FRAMES and size < WRITE_BATCH_BYTES:
+        item = queue.popleft()
+        batch.append(item)
+        size += item_size(item)
+    return batch
+
+def tune_socket(sock, keepalive=False):
+    # Mensagens de chat são pequenas e interativas: sem Nagle cada escrita
+    # sai na hora, e o agrupamento fica por conta dos escritores.
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+    if keepalive:
+        enable_keepalive(sock)
+
+def enable_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    # O kernel sonda a conexão parada e a derruba se o outro lado sumiu
+    # (notebook que dormiu, Wi-Fi que trocou de ponto de acesso).
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+    except (OSError, AttributeError):
+        pass
+
+def send_buffers(sock, buffers):
+    # Uma chamada sendmsg (writev) para vários frames; se o kernel aceitar só
+    # parte, continua de onde parou até escrever tudo.
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:])
+        while sent:
+            size = len(views[index])
+            if sent >= size:
+                sent -= size
+                index += 1
+            else:
+                views[index] = views[index][sent:]
+                sent = 0
+
+class FrameDecoder:
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.decompressor = None
+
+    def feed(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        header_size = FRAME_HEADER.size
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= header_size:
+            length, flags = FRAME_HEADER.unpack_from(buffer, offset)
+            if length > self.max_frame_size:
+                raise FrameError(f"Frame de {length} bytes excede o limite de {self.max_frame_size}")
+            end = offset + header_size + length
+            if end > len(buffer):
+                break
+            payload = bytes(buffer[offset + header_size:end])
+            if flags & FLAG_COMPRESSED:
+                payload = self._decompress(payload)
+                flags &= ~FLAG_COMPRESSED
+            frames.append((flags, payload))
+            offset = end
+        if offset:
+            del buffer[:offset]
+        return frames
+
+    def _decompress(self, payload):
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        data = self.decompressor.decompress(payload, self.max_frame_size)
+        if self.decompressor.unconsumed_tail:
+            raise FrameError(f"Frame descomprimido excede o limite de {self.max_frame_size}")
+        return data
+
+    def messages(self, data):
+        if not METRICS.enabled:
+            return [decode_payload(flags, payload) for flags, payload in self.feed(data)]
+        start = time.perf_counter()
+        messages = [decode_payload(flags, payload) for flags, payload in self.feed(data)]
+        METRICS.observe('decode', time.perf_counter() - start)
+        return messages
+
+    def sized_messages(self, data):
+        # Como messages(), mas com o tamanho de cada payload (já descomprimido).
+        if not METRICS.enabled:
+            return [(decode_payload(flags, payload), len(payload)) for flags, payload in self.feed(data)]
+        start = time.perf_counter()
+        messages = [(decode_payload(flags, payload), len(payload)) for flags, payload in self.feed(data)]
+        METRICS.observe('decode', time.perf_counter() - start)
+        return messages
+
+class SendQueueFull(Exception):
+    pass
+
+class ClientWriter:
+    def __init__(self, sock, on_error, max_queue=SEND_QUEUE_SIZE, policy=OVERFLOW_POLICY, flush_delay=WRITE_FLUSH_DELAY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de fila inválida: {policy}")
+        self.sock = sock
+        self.on_error = on_error
+        self.max_queue = max_queue
+        self.policy = policy
+        self.flush_delay = flush_delay
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.codec = JSON_CODEC
+        self.compressor = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, frame):
+        # Nunca bloqueia: com 'backpressure' a fila passa do limite e quem
+        # envia espera em wait_for_room(), já fora dos locks de sala.
+        with self.cond:
+            if self.closed:
+                return False
+            overflow = len(self.queue) >= self.max_queue
+            if overflow and self.policy == 'drop_oldest':
+                self.queue.popleft()
+                self.dropped += 1
+            if not overflow or self.policy != 'disconnect':
+                self.queue.append(frame)
+                self.cond.notify_all()
+                return True
+        self._overflow()
+        return False
+
+    def full(self):
+        return self.policy == 'backpressure' and len(self.queue) >= self.max_queue
+
+    def wait_for_room(self):
+        with self.cond:
+            if self.cond.wait_for(lambda: self.closed or len(self.queue) < self.max_queue, BACKPRESSURE_TIMEOUT):
+                return
+        self._overflow()
+
+    def _overflow(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+        self.on_error(SendQueueFull(f"fila de saída cheia ({self.max_queue} mensagens)"))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if self.flush_delay and len(self.queue) < WRITE_BATCH_FRAMES:
+                    self.cond.wait_for(lambda: self.closed or len(self.queue) >= WRITE_BATCH_FRAMES, self.flush_delay)
+                if self.closed:
+                    return
+                batch = take_batch(self.queue)
+                self.cond.notify_all()
+            try:
+                send_buffers(self.sock, [join_frames(item, self.compressor) for item in batch])
+                if METRICS.enabled:
+                    METRICS.incr(write_calls=1, frames_written=len(batch))
+            except Exception as e:
+                with self.cond:
+                    if self.closed:
+                        return
+                    self.closed = True
+                    self.queue.clear()
+                    self.cond.notify_all()
+                self.on_error(e)
+                return
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.cond.notify_all()
+
+class AsyncClientWriter:
+    # Equivalente ao ClientWriter para o AsyncChatServer: a fila é drenada por
+    # uma task e o 'backpressure' é aplicado pelo leitor de quem envia, que
+    # aguarda wait_for_room() em vez de bloquear o event loop.
+    def __init__(self, stream_writer, on_error, max_queue=SEND_QUEUE_SIZE, policy=OVERFLOW_POLICY,
+                 flush_delay=WRITE_FLUSH_DELAY):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de fila inválida: {policy}")
+        self.sock = stream_writer
+        self.on_error = on_error
+        self.max_queue = max_queue
+        self.policy = policy
+        self.flush_delay = flush_delay
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.has_room = asyncio.Event()
+        self.has_room.set()
+        self.closed = False
+        self.dropped = 0
+        self.codec = JSON_CODEC
+        self.compressor = None
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def enqueue(self, frame):
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue:
+            if self.policy == 'drop_oldest':
+                self.queue.popleft()
+                self.dropped += 1
+            elif self.policy == 'disconnect':
+                self._overflow()
+                return False
+        self.queue.append(frame)
+        if self.policy == 'backpressure' and len(self.queue) >= self.max_queue:
+            self.has_room.clear()
+        self.ready.set()
+        return True
+
+    def full(self):
+        return not self.has_room.is_set()
+
+    async def wait_for_room(self):
+        if self.has_room.is_set():
+            return
+        try:
+            await asyncio.wait_for(self.has_room.wait(), BACKPRESSURE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._overflow()
+
+    def _overflow(self):
+        self.close()
+        self.on_error(SendQueueFull(f"fila de saída cheia ({self.max_queue} mensagens)"))
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                if self.flush_delay and len(self.queue) < WRITE_BATCH_FRAMES:
+                    await asyncio.sleep(self.flush_delay)
+                    if self.closed:
+                        break
+                batch = take_batch(self.queue)
+                if len(self.queue) < self.max_queue:
+                    self.has_room.set()
+                self.sock.writelines([join_frames(item, self.compressor) for item in batch])
+                if METRICS.enabled:
+                    METRICS.incr(write_calls=1, frames_written=len(batch))
+                await self.sock.drain()
+        except Exception as e:
+            if not self.closed:
+                self.close()
+                self.on_error(e)
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.has_room.set()
+        self.ready.set()
+
+# ioctl SIOCGIFADDR por plataforma: o endereço IPv4 de uma interface sem
+# mandar nenhum pacote. Nas outras (Windows) os endereços vêm da resolução
+# do próprio nome da máquina, que o sistema responde localmente.
+SIOCGIFADDR = {'linux': 0x8915, 'darwin': 0xc0206921}
+VIRTUAL_INTERFACES = ('docker', 'br-', 'veth', 'virbr', 'vmnet', 'vboxnet', 'tun', 'tap', 'utun', 'zt', 'tailscale', 'wg')
+LOOPBACK_IP = "127.0.0.1"
+
+LOCAL_IP = None
+
+def interface_addresses():
+    addresses = []
+    request = SIOCGIFADDR.get(sys.platform)
+    if request is not None and hasattr(socket, 'if_nameindex'):
+        import fcntl
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _, name in socket.if_nameindex():
+                try:
+                    ifreq = fcntl.ioctl(probe.fileno(), request, struct.pack('256s', name.encode()[:15]))
+                except OSError:
+                    continue
+                addresses.append((name, socket.inet_ntoa(ifreq[20:24])))
+        except OSError:
+            pass
+        finally:
+            probe.close()
+    if not addresses:
+        try:
+            for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+                addresses.append(('', info[4][0]))
+        except OSError:
+            pass
+    return addresses
+
+def address_rank(name, ip_address):
+    # Menor é melhor: interface física, rede privada (RFC 1918), depois
+    # qualquer endereço roteável e por último link-local.
+    octets = [int(part) for part in ip_address.split('.')]
+    private = (octets[0] == 10 or (octets[0] == 172 and 16 <= octets[1] <= 31)
+               or (octets[0] == 192 and octets[1] == 168))
+    link_local = octets[0] == 169 and octets[1] == 254
+    return (name.startswith(VIRTUAL_INTERFACES), link_local, not private)
+
+def is_local_address(ip_address):
+    # Um endereço ainda pertence a esta máquina se dá para fazer bind nele.
+    if not ip_address or ip_address.startswith('127.') or ip_address == '0.0.0.0':
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind((ip_address, 0))
+        return True
+    except OSError:
+        return False
+
+def get_local_ip(refresh=False):
+    # Nada sai da máquina: o IP vem das interfaces de rede, então funciona em
+    # LANs sem internet. O último IP usado fica em user_data.json e só é
+    # reaproveitado se ainda estiver atribuído a alguma interface.
+    global LOCAL_IP
+    if not refresh and is_local_address(LOCAL_IP):
+        return LOCAL_IP
+    cached = None if refresh else (USER_DATA or {}).get('local_ip')
+    if is_local_address(cached):
+        LOCAL_IP = cached
+        return LOCAL_IP
+
+    candidates = [(name, ip_address) for name, ip_address in interface_addresses() if is_local_address(ip_address)]
+    if not candidates:
+        LOCAL_IP = None
+        return LOOPBACK_IP
+    LOCAL_IP = min(candidates, key=lambda candidate: address_rank(*candidate))[1]
+    if USER_DATA is not None and USER_DATA.get('local_ip') != LOCAL_IP:
+        save_user_data(USER_DATA['id'], USER_DATA['name'], LOCAL_IP)
+    return LOCAL_IP
+
+def get_broadcast_ip(local_ip):
+    if local_ip == LOOPBACK_IP:
+        return "255.255.255.255"
+    parts = local_ip.split('.')
+    return f"{parts[0]}.{parts[1]}.{parts[2]}.255"
+
+def room_label(room):
+    return "" if room == DEFAULT_ROOM else f"[#{room}] "
+
+def valid_room_name(room):
+    return isinstance(room, str) and 0 < len(room) <= ROOM_NAME_MAX and room.strip() == room and not room.startswith('/')
+
+class ClientConnection:
+    __slots__ = ('sock', 'address', 'id', 'name', 'writer', 'rooms', 'connected_at', 'last_seen', 'heartbeat',
+                 'limiter', 'debt', 'throttled_at', 'throttled', 'messages_in', 'messages_out', 'bytes_in', 'bytes_out')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.id = None
+        self.name = None
+        self.writer = None
+        self.rooms = frozenset()
+        self.connected_at = self.last_seen = time.monotonic()
+        # Se o cliente responde ping (anunciado no name_intro).
+        self.heartbeat = False
+        self.limiter = None
+        # Espera acumulada desde a última mensagem que passou direto, quando
+        # termina a última espera e quantas mensagens já esperaram.
+        self.debt = 0.0
+        self.throttled_at = 0.0
+        self.throttled = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def display_name(self):
+        return self.name or f"{self.address[0]}:{self.address[1]}"
+
+class ClientRegistry:
+    # Conexões do host. O fan-out lê tuplas imutáveis (todas as conexões e uma
+    # por sala) que só são refeitas quando alguém entra, sai ou muda de sala;
+    # enviar uma mensagem não copia nada. Essas mudanças são raras perto dos
+    # envios, então um lock só basta.
+    def __init__(self, rooms=(DEFAULT_ROOM,)):
+        self.lock = threading.Lock()
+        self.connections = {}
+        # Índice por código do participante (rotas de arquivo, pedaço a pedaço).
+        self.by_id = {}
+        self.all_connections = ()
+        self.room_members = {room: () for room in rooms}
+
+    def add(self, conn):
+        with self.lock:
+            if conn.address in self.connections:
+                return False
+            self.connections[conn.address] = conn
+            if conn.id is not None:
+                self.by_id[conn.id] = conn
+            self.all_connections = self.all_connections + (conn,)
+        return True
+
+    def remove(self, address):
+        # Só quem efetivamente tirou a conexão recebe o objeto; remoções
+        # repetidas (leitor e escritor ao mesmo tempo) devolvem None.
+        with self.lock:
+            conn = self.connections.pop(address, None)
+            if conn is None:
+                return None
+            if self.by_id.get(conn.id) is conn:
+                del self.by_id[conn.id]
+            self.all_connections = tuple(c for c in self.all_connections if c is not conn)
+            for room in conn.rooms:
+                members = self.room_members.get(room)
+                if members is not None:
+                    self.room_members[room] = tuple(c for c in members if c is not conn)
+            return conn
+
+    def identify(self, conn, client_id):
+        # Quem se reapresenta com o mesmo código passa a ser o destino dele.
+        with self.lock:
+            if self.by_id.get(conn.id) is conn:
+                del self.by_id[conn.id]
+            conn.id = client_id
+            if self.connections.get(conn.address) is conn:
+                self.by_id[client_id] = conn
+
+    def get(self, address):
+        return self.connections.get(address)
+
+    def snapshot(self):
+        return self.all_connections
+
+    def find(self, client_id):
+        return self.by_id.get(client_id)
+
+    def __len__(self):
+        return len(self.all_connections)
+
+    def rooms(self):
+        return sorted(self.room_members)
+
+    def has_room(self, room):
+        return room in self.room_members
+
+    def room_snapshot(self, room):
+        return self.room_members.get(room, ())
+
+    def add_room(self, room):
+        with self.lock:
+            if room in self.room_members:
+                return False
+            # Troca o dicionário inteiro para quem estiver iterando as salas.
+            room_members = dict(self.room_members)
+            room_members[room] = ()
+            self.room_members = room_members
+            return True
+
+    def subscribe(self, conn, room):
+        with self.lock:
+            members = self.room_members.get(room)
+            if members is None or room in conn.rooms or self.connections.get(conn.address) is not conn:
+                return False
+            conn.rooms = conn.rooms | {room}
+            self.room_members[room] = members + (conn,)
+            return True
+
+    def unsubscribe(self, conn, room):
+        with self.lock:
+            if room not in conn.rooms:
+                return False
+            conn.rooms = conn.rooms - {room}
+            self.room_members[room] = tuple(c for c in self.room_members[room] if c is not conn)
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.connections.clear()
+            self.by_id.clear()
+            conns, self.all_connections = self.all_connections, ()
+            self.room_members = {room: () for room in self.room_members}
+        return conns
+
+class RoomLog:
+    # Anel de tamanho fixo com as últimas mensagens de uma sala, numeradas
+    # pelo host. Cada posição guarda a mensagem, a hora em que chegou e os
+    # frames já codificados no fan-out, por codec, para que replay e
+    # histórico não serializem tudo de novo. O lock também ordena fan-out e
+    # replay: quem entra nunca recebe uma mensagem nova antes das antigas.
+    def __init__(self, capacity=REPLAY_BUFFER_SIZE):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.seq = 0
+        self.count = 0
+        self.messages = [None] * capacity
+        self.frames = [None] * capacity
+        self.times = array('d', bytes(8 * capacity))
+
+    def append(self, message_obj, frames, seq=None):
+        # No modo multiprocesso o número vem do processo principal.
+        self.seq = self.seq + 1 if seq is None else seq
+        slot = self.seq % self.capacity
+        self.messages[slot] = message_obj
+        self.frames[slot] = frames
+        self.times[slot] = time.time()
+        self.count = min(self.count + 1, self.capacity)
+        return self.seq
+
+    def first_seq(self):
+        return self.seq - self.count + 1
+
+    def frame(self, seq, codec):
+        # Uma entrada que não codifica vai em JSON, ou fica de fora (None):
+        # nunca derruba quem está entrando na sala.
+        slot = seq % self.capacity
+        frames = self.frames[slot]
+        frame = frames.get(codec)
+        if frame is None:
+            try:
+                frame = encode_frame(self.messages[slot], codec)
+            except (TypeError, ValueError, AttributeError):
+                try:
+                    frame = encode_frame(self.messages[slot])
+                except (TypeError, ValueError):
+                    return None
+            frames[codec] = frame
+        return frame
+
+    def since(self, last_seq):
+        # Números depois de last_seq que ainda estão no anel, e quantos já saíram.
+        first = max(last_seq + 1, self.first_seq())
+        return range(first, self.seq + 1), max(0, self.first_seq() - last_seq - 1)
+
+    def recent(self, limit, since_time=None):
+        first = max(self.first_seq(), self.seq - limit + 1)
+        if since_time is not None:
+            while first <= self.seq and self.times[first % self.capacity] < since_time:
+                first += 1
+        return range(first, self.seq + 1)
+
+class TimerWheel:
+    # Roda de tempo: agendar e avançar custam O(1) por item, com um relógio
+    # só para todas as conexões em vez de um timer por cliente. Prazos maiores
+    # que uma volta inteira esperam as voltas que faltam na mesma posição.
+    def __init__(self, tick=HEARTBEAT_TICK, slots=TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, item, delay):
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self.lock:
+            self.slots[(self.position + ticks) % len(self.slots)].append(((ticks - 1) // len(self.slots), item))
+            self.count += 1
+
+    def advance(self):
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            entries = self.slots[self.position]
+            waiting = [(rounds - 1, item) for rounds, item in entries if rounds > 0]
+            self.slots[self.position] = waiting
+            self.count -= len(entries) - len(waiting)
+        return [item for rounds, item in entries if rounds == 0]
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount, now):
+        # Tira as fichas mesmo que fique devendo e devolve quanto tempo falta
+        # para pagar a dívida (0 se havia fichas).
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter:
+    # Limite de mensagens e de bytes por segundo; o mesmo objeto serve a uma
+    # conexão ou a uma sala inteira (aí várias threads dividem os baldes).
+    __slots__ = ('messages', 'bytes', 'lock')
+
+    def __init__(self, message_rate, byte_rate, burst=RATE_BURST):
+        self.messages = TokenBucket(message_rate, max(1.0, message_rate * burst))
+        self.bytes = TokenBucket(byte_rate, byte_rate * burst)
+        self.lock = threading.Lock()
+
+    def take(self, size):
+        now = time.monotonic()
+        with self.lock:
+            return max(self.messages.take(1, now), self.bytes.take(size, now))
+
+# Pedaços e confirmações de arquivo já são controlados pela janela da
+# transferência e não contam nos limites de mensagens.
+RATE_EXEMPT = ('file_chunk', 'file_ack')
+
+class BeaconScheduler:
+    def __init__(self, min_interval=BEACON_MIN_INTERVAL, max_interval=BEACON_MAX_INTERVAL, backoff=BEACON_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def activity(self):
+        self.interval = self.min_interval
+
+    def next_interval(self):
+        interval = self.interval
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        return interval
+
+def valid_chat_message(message_obj):
+    return all(isinstance(message_obj.get(field), str) for field in ('sender_id', 'timestamp', 'content'))
+
+def valid_discovery(message_obj):
+    # Beacons chegam de qualquer um na rede: campos de tipo errado são descartados.
+    rooms = message_obj.get('rooms', [])
+    return (isinstance(message_obj.get('host_id'), str) and isinstance(message_obj.get('host_ip'), str)
+            and isinstance(message_obj.get('chat_port', CHAT_PORT), int)
+            and isinstance(message_obj.get('host_name', ''), str)
+            and isinstance(rooms, list) and all(isinstance(room, str) for room in rooms))
+
+def valid_file_offer(message_obj):
+    return (isinstance(message_obj.get('transfer_id'), str) and isinstance(message_obj.get('sender_id'), str)
+            and isinstance(message_obj.get('name'), str) and isinstance(message_obj.get('size'), int)
+            and message_obj['size'] >= 0)
+
+def safe_file_name(name):
+    # Só o nome, sem diretórios de quem enviou.
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    return '' if name in ('.', '..') else name
+
+class FileStream:
+    # Envio de um arquivo para um recebedor, numa thread própria. 'acked' é
+    # até onde ele confirmou e 'next_offset' o próximo pedaço a sair; um novo
+    # aceite (retomada ou pedaço perdido) volta os dois para o offset pedido.
+    def __init__(self, transfers, offer, path, receiver_id, offset):
+        self.transfers = transfers
+        self.offer = offer
+        self.path = path
+        self.receiver_id = receiver_id
+        self.size = offer['size']
+        self.acked = self.next_offset = offset
+        self.progress_at = time.monotonic()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def rewind(self, offset):
+        with self.cond:
+            if self.closed:
+                return False
+            self.acked = self.next_offset = min(offset, self.size)
+            self.progress_at = time.monotonic()
+            self.cond.notify_all()
+            return True
+
+    def ack(self, offset):
+        with self.cond:
+            if offset > self.acked:
+                self.acked = min(offset, self.size)
+                self.next_offset = max(self.next_offset, self.acked)
+                self.progress_at = time.monotonic()
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _can_send(self):
+        return self.closed or self.acked >= self.size or (
+            self.next_offset < self.size and self.next_offset - self.acked < FILE_WINDOW * FILE_CHUNK_SIZE)
+
+    def _run(self):
+        peer = CONTACTS.get(self.receiver_id, f"Amigo ({self.receiver_id[:8]})")
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.size:
+                    raise OSError("o arquivo diminuiu desde a oferta")
+                with mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ) as mapped:
+                    self._stream(mapped, peer)
+        except (OSError, ValueError) as e:
+            show(f"Erro ao enviar '{self.offer['name']}' para {peer}: {e}")
+        finally:
+            self.close()
+            self.transfers._stream_done(self)
+
+    def _stream(self, mapped, peer):
+        transfer_id = self.offer['transfer_id']
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(self._can_send, FILE_ACK_TIMEOUT):
+                    show(f"Envio de '{self.offer['name']}' para {peer} parado sem confirmação; continua se ele aceitar de novo.")
+                    return
+                if self.closed:
+                    return
+                if self.acked >= self.size:
+                    show(f"'{self.offer['name']}' enviado para {peer}.")
+                    return
+                offset = self.next_offset
+                self.next_offset = end = min(offset + FILE_CHUNK_SIZE, self.size)
+            chunk = encode_file_chunk(transfer_id, self.receiver_id, offset, memoryview(mapped)[offset:end])
+            sent = self.transfers.send_chunk(self.receiver_id, chunk)
+            # A fatia do mmap precisa ser solta antes de o arquivo fechar.
+            del chunk
+            if sent:
+                continue
+            # Sem conexão agora (reconectando): tenta o mesmo pedaço daqui a pouco.
+            with self.cond:
+                self.next_offset = min(self.next_offset, offset)
+                if time.monotonic() - self.progress_at > FILE_ACK_TIMEOUT:
+                    show(f"Envio de '{self.offer['name']}' para {peer} interrompido: sem conexão.")
+                    return
+                self.cond.wait(0.5)
+
+class IncomingFile:
+    # Arquivo sendo recebido. Os bytes vão para '<nome>.<id>.part' na pasta de
+    # recebidos e o tamanho desse arquivo é o offset de retomada, então um
+    # download interrompido continua de onde parou, mesmo após reiniciar.
+    def __init__(self, offer, directory):
+        self.offer = offer
+        self.size = offer['size']
+        os.makedirs(directory, exist_ok=True)
+        self.final_path = os.path.join(directory, safe_file_name(offer['name']) or offer['transfer_id'])
+        self.part_path = f"{self.final_path}.{offer['transfer_id'][:8]}.part"
+        self.file = open(self.part_path, 'ab')
+        self.offset = self.file.tell()
+        if self.offset > self.size:
+            self.file.truncate(0)
+            self.offset = 0
+        self.retry_requested = False
+        self.lock = threading.Lock()
+
+    def finish(self):
+        self.file.close()
+        base, extension = os.path.splitext(self.final_path)
+        path, copy = self.final_path, 1
+        while os.path.exists(path):
+            path = f"{base} ({copy}){extension}"
+            copy += 1
+        os.replace(self.part_path, path)
+        return path
+
+class FileTransfers:
+    # Arquivos oferecidos e recebidos por este participante (um cliente ou o
+    # próprio host). 'send' manda mensagens de controle; 'send_chunk' entrega
+    # um pedaço já montado ao destinatário e diz se conseguiu.
+    def __init__(self, send, send_chunk, download_dir=DOWNLOAD_DIR):
+        self.send = send
+        self.send_chunk = send_chunk
+        self.download_dir = download_dir
+        self.lock = threading.Lock()
+        self.shared = {}
+        self.offers = {}
+        self.streams = {}
+        self.downloads = {}
+
+    def offer(self, path, room):
+        path = os.path.expanduser(path.strip().strip('"'))
+        if not os.path.isfile(path):
+            show(f"Arquivo não encontrado: {path}")
+            return None
+        offer = {
+            'type': 'file_offer',
+            'transfer_id': str(uuid.uuid4()),
+            'sender_id': MY_ID,
+            'name': os.path.basename(path),
+            'size': os.path.getsize(path),
+            'timestamp': datetime.now().isoformat(),
+            'room': room
+        }
+        with self.lock:
+            self.shared[offer['transfer_id']] = (path, offer)
+        show(f"{room_label(room)}[Eu] ofereci '{offer['name']}' ({format_size(offer['size'])}).")
+        self.send(offer)
+        return offer
+
+    def handle(self, message_obj):
+        if message_obj['type'] == 'file_offer':
+            self.on_offer(message_obj)
+        elif message_obj['type'] == 'file_accept':
+            self.on_accept(message_obj)
+        elif message_obj['type'] == 'file_ack':
+            self.on_ack(message_obj)
+        elif message_obj['type'] == 'file_chunk':
+            self.on_chunk(message_obj)
+
+    def on_offer(self, offer, sender_name=None):
+        if not valid_file_offer(offer) or offer['sender_id'] == MY_ID:
+            return
+        with self.lock:
+            self.offers[offer['transfer_id']] = offer
+        sender_id = offer['sender_id']
+        sender_name = sender_name or CONTACTS.get(sender_id, f"Amigo ({sender_id[:8]})")
+        show(f"{room_label(offer.get('room', DEFAULT_ROOM))}[{sender_name}] quer enviar '{offer['name']}' "
+             f"({format_size(offer['size'])}). Para receber: /aceitar {offer['transfer_id'][:8]}")
+
+    def accept(self, prefix):
+        with self.lock:
+            matches = [offer for transfer_id, offer in self.offers.items() if transfer_id.startswith(prefix)]
+        if len(matches) != 1:
+            print("Nenhuma oferta com esse código." if not matches else "Código ambíguo; digite mais caracteres.")
+            return
+        offer = matches[0]
+        with self.lock:
+            download = self.downloads.get(offer['transfer_id'])
+            if download is None:
+                try:
+                    download = IncomingFile(offer, self.download_dir)
+                except OSError as e:
+                    print(f"Erro ao preparar o download de '{offer['name']}': {e}")
+                    return
+                self.downloads[offer['transfer_id']] = download
+        if download.offset >= download.size:
+            self._finish(download)
+            return
+        resumed = f", retomando de {format_size(download.offset)}" if download.offset else ""
+        print(f"Recebendo '{offer['name']}' ({format_size(download.size)}{resumed})...")
+        self._request(download)
+
+    def _request(self, download):
+        self.send({
+            'type': 'file_accept',
+            'transfer_id': download.offer['transfer_id'],
+            'sender_id': download.offer['sender_id'],
+            'receiver_id': MY_ID,
+            'offset': download.offset
+        })
+
+    def resume(self):
+        # Depois de reconectar: pede de novo tudo que ainda estava chegando.
+        with self.lock:
+            downloads = list(self.downloads.values())
+        for download in downloads:
+            with download.lock:
+                download.retry_requested = False
+            self._request(download)
+
+    def forget(self, transfer_id):
+        # Envios e downloads já começados seguem; só some a oferta guardada.
+        with self.lock:
+            self.offers.pop(transfer_id, None)
+            self.shared.pop(transfer_id, None)
+
+    def on_accept(self, accept):
+        with self.lock:
+            shared = self.shared.get(accept.get('transfer_id'))
+        receiver_id = accept.get('receiver_id')
+        if shared is None or not isinstance(receiver_id, str):
+            return
+        path, offer = shared
+        try:
+            offset = max(0, int(accept.get('offset', 0)))
+        except (TypeError, ValueError):
+            return
+        if offset >= offer['size']:
+            return
+        key = (offer['transfer_id'], receiver_id)
+        with self.lock:
+            stream = self.streams.get(key)
+            if stream is not None and stream.rewind(offset):
+                return
+            stream = self.streams[key] = FileStream(self, offer, path, receiver_id, offset)
+        peer = CONTACTS.get(receiver_id, f"Amigo ({receiver_id[:8]})")
+        resumed = f" a partir de {format_size(offset)}" if offset else ""
+        show(f"Enviando '{offer['name']}' para {peer}{resumed}...")
+        stream.thread.start()
+
+    def _stream_done(self, stream):
+        with self.lock:
+            key = (stream.offer['transfer_id'], stream.receiver_id)
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+
+    def on_ack(self, ack):
+        stream = self.streams.get((ack.get('transfer_id'), ack.get('receiver_id')))
+        if stream is not None and isinstance(ack.get('offset'), int):
+            stream.ack(ack['offset'])
+
+    def on_chunk(self, chunk):
+        download = self.downloads.get(chunk['transfer_id'])
+        if download is None or chunk['receiver_id'] != MY_ID:
+            return
+        data = chunk['data']
+        with download.lock:
+            if download.file.closed or chunk['offset'] < download.offset:
+                return
+            if chunk['offset'] > download.offset or zlib.crc32(data) != chunk['crc'] or download.offset + len(data) > download.size:
+                # Algum pedaço se perdeu ou chegou corrompido: pede de novo a
+                # partir do último byte bom, uma vez só até voltar a encaixar.
+                if download.retry_requested:
+                    return
+                download.retry_requested = True
+                retry = True
+            else:
+                download.file.write(data)
+                download.offset += len(data)
+                download.retry_requested = False
+                retry = False
+            offset = download.offset
+        if retry:
+            self._request(download)
+            return
+        self.send({
+            'type': 'file_ack',
+            'transfer_id': chunk['transfer_id'],
+            'sender_id': download.offer['sender_id'],
+            'receiver_id': MY_ID,
+            'offset': offset
+        })
+        if offset >= download.size:
+            self._finish(download)
+
+    def _finish(self, download):
+        with self.lock:
+            self.downloads.pop(download.offer['transfer_id'], None)
+        try:
+            path = download.finish()
+        except OSError as e:
+            show(f"Erro ao salvar '{download.offer['name']}': {e}")
+            return
+        show(f"Arquivo recebido: {path}")
+
+    def show(self):
+        with self.lock:
+            offers = [offer for transfer_id, offer in self.offers.items() if transfer_id not in self.downloads]
+            downloads = list(self.downloads.values())
+            streams = list(self.streams.values())
+        if not (offers or downloads or streams):
+            print("Nenhuma transferência de arquivo.")
+        for offer in offers:
+            print(f"  oferta   {offer['transfer_id'][:8]} '{offer['name']}' ({format_size(offer['size'])})")
+        for download in downloads:
+            print(f"  recebendo {download.offer['transfer_id'][:8]} '{download.offer['name']}' "
+                  f"{format_size(download.offset)}/{format_size(download.size)}")
+        for stream in streams:
+            peer = CONTACTS.get(stream.receiver_id, f"Amigo ({stream.receiver_id[:8]})")
+            print(f"  enviando '{stream.offer['name']}' para {peer} {format_size(stream.acked)}/{format_size(stream.size)}")
+
+    def close(self):
+        with self.lock:
+            streams = list(self.streams.values())
+            downloads = list(self.downloads.values())
+        for stream in streams:
+            stream.close()
+        for download in downloads:
+            with download.lock:
+                download.file.close()
+
+class ChatServer:
+    def __init__(self, host_ip, chat_port, discovery_port, backlog=LISTEN_BACKLOG,
+                 send_queue_size=SEND_QUEUE_SIZE, overflow_policy=OVERFLOW_POLICY, query_port=QUERY_PORT,
+                 rooms=(DEFAULT_ROOM,), flush_delay=WRITE_FLUSH_DELAY, heartbeat_interval=HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=HEARTBEAT_TIMEOUT, tcp_keepalive=TCP_KEEPALIVE,
+                 client_rate=(CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE), room_rate=(ROOM_MESSAGE_RATE, ROOM_BYTE_RATE),
+                 max_frame_size=CLIENT_MAX_FRAME_SIZE, headless=False):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de fila inválida: {overflow_policy}")
+        self.host_ip = host_ip
+        self.chat_port = chat_port
+        self.discovery_port = discovery_port
+        self.backlog = backlog
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = overflow_policy
+        self.flush_delay = flush_delay
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = max(heartbeat_timeout, heartbeat_interval)
+        self.tcp_keepalive = tcp_keepalive
+        # Sem terminal: só repassa mensagens, sem ler a entrada nem mostrar a conversa.
+        self.headless = headless
+        self.client_rate = tuple(client_rate)
+        self.room_rate = tuple(room_rate)
+        # Um pedaço de arquivo inteiro sempre precisa caber num frame.
+        self.max_frame_size = max(max_frame_size, FILE_CHUNK_SIZE + FILE_CHUNK_HEADER.size)
+        # No modo multiprocesso cada worker tem os próprios baldes por sala.
+        self.room_limiters = {}
+        self.wheel = TimerWheel()
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.registry = ClientRegistry((DEFAULT_ROOM,) + tuple(room for room in rooms if room != DEFAULT_ROOM))
+        self.room_logs = {}
+        # Identifica esta execução do host; números de sequência de outra
+        # execução não servem para retomar a conversa.
+        self.session_id = str(uuid.uuid4())
+        self.current_room = DEFAULT_ROOM
+        self.running = True
+        self.broadcast_socket = None
+        self.query_port = query_port
+        self.query_socket = None
+        self.beacon = BeaconScheduler()
+        self.beacon_payload = None
+        self.beacon_wakeup = threading.Event()
+        self.files = FileTransfers(self._send_file_message, self._send_file_chunk)
+        # Quem ofereceu cada arquivo: só essa conexão pode mandar os pedaços.
+        # Vale enquanto a oferta estiver no anel da sala (room_offers).
+        self.file_owners = {}
+        self.room_offers = {}
+        METRICS.gauge('clients', lambda: len(self.registry))
+        METRICS.gauge('rooms', lambda: len(self.registry.rooms()))
+        METRICS.gauge('send_queue_depth_total', lambda: sum(len(c.writer.queue) for c in self.registry.snapshot()))
+        METRICS.gauge('send_queue_depth_max', lambda: max((len(c.writer.queue) for c in self.registry.snapshot()), default=0))
+        METRICS.gauge('send_dropped', lambda: sum(c.writer.dropped for c in self.registry.snapshot()))
+        METRICS.gauge('timer_wheel_items', lambda: self.wheel.count)
+        METRICS.gauge('rate_limited_clients', lambda: sum(
+            1 for c in self.registry.snapshot() if c.throttled_at > time.monotonic()))
+
+    def start(self):
+        try:
+            self.server_socket.bind((self.host_ip, self.chat_port))
+            self.server_socket.listen(self.backlog)
+            print(f"\n--- Servidor de Chat Iniciado em {self.host_ip}:{self.chat_port} ---")
+            print("Aguardando conexões de amigos na mesma rede Wi-Fi...")
+            print(f"Seu código de chat (compartilhe com amigos): {MY_ID}")
+
+            accept_thread = threading.Thread(target=self._accept_connections)
+            accept_thread.daemon = True
+            accept_thread.start()
+
+            broadcast_thread = threading.Thread(target=self._start_udp_broadcasting)
+            broadcast_thread.daemon = True
+            broadcast_thread.start()
+
+            query_thread = threading.Thread(target=self._answer_discovery_queries)
+            query_thread.daemon = True
+            query_thread.start()
+
+            self._start_heartbeats()
+            self._start_user_input()
+
+        except OSError as e:
+            if e.errno == 98:
+                print(f"\nErro: A porta {self.chat_port} já está em uso ou o servidor já está rodando. Tente novamente mais tarde ou reinicie.")
+            else:
+                print(f"\nErro ao iniciar o servidor: {e}")
+            self.running = False
+
+    def _start_user_input(self):
+        if not self.headless:
+            threading.Thread(target=self._handle_user_input).start()
+
+    def _start_udp_broadcasting(self):
+        self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.broadcast_socket.settimeout(0.5)
+
+        broadcast_ip = get_broadcast_ip(self.host_ip)
+
+        print(f"Iniciando broadcast de descoberta em {broadcast_ip}:{self.discovery_port}")
+
+        while self.running:
+            try:
+                self.broadcast_socket.sendto(self._discovery_payload(), (broadcast_ip, self.discovery_port))
+                if METRICS.enabled:
+                    METRICS.incr(discovery_beacons_sent=1)
+            except Exception as e:
+                if self.running:
+                    print(f"Erro no broadcast UDP: {e}")
+                break
+            # Mudança no beacon acorda antes do prazo, mas não antes do mínimo.
+            interval = self.beacon.next_interval()
+            time.sleep(self.beacon.min_interval)
+            self.beacon_wakeup.wait(interval - self.beacon.min_interval)
+            self.beacon_wakeup.clear()
+
+    def _open_query_socket(self):
+        query_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        query_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            query_socket.bind(('', self.query_port))
+        except OSError as e:
+            query_socket.close()
+            print(f"Aviso: consultas de descoberta desativadas (porta {self.query_port}): {e}")
+            return None
+        return query_socket
+
+    def _answer_discovery_queries(self):
+        self.query_socket = self._open_query_socket()
+        if self.query_socket is None:
+            return
+        self.query_socket.settimeout(0.5)
+        while self.running:
+            try:
+                data, addr = self.query_socket.recvfrom(DATAGRAM_SIZE)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if self.running:
+                    print(f"Erro ao responder consulta de descoberta: {e}")
+                break
+            try:
+                reply = self._discovery_reply(data)
+                if reply is not None:
+                    self.query_socket.sendto(reply, addr)
+            except Exception:
+                # Consulta malformada (ou resposta que não sai): só esta se perde.
+                continue
+
+    def _discovery_message(self):
+        return {
+            'type': 'discovery',
+            'host_ip': self.host_ip,
+            'chat_port': self.chat_port,
+            'host_id': MY_ID,
+            'host_name': MY_NAME,
+            'rooms': self.registry.rooms()[:DISCOVERY_MAX_ROOMS]
+        }
+
+    @staticmethod
+    def _encode_discovery(message_obj):
+        data = encode_datagram(message_obj, CODECS[DISCOVERY_CODEC])
+        # Nomes longos ainda podem passar do limite: corta salas do fim.
+        while len(data) > DISCOVERY_MAX_BYTES and message_obj['rooms']:
+            message_obj['rooms'] = message_obj['rooms'][:-1]
+            data = encode_datagram(message_obj, CODECS[DISCOVERY_CODEC])
+        return data
+
+    def _discovery_payload(self):
+        # O beacon só muda quando os dados do host mudam; é codificado uma vez.
+        if self.beacon_payload is None:
+            self.beacon_payload = self._encode_discovery(self._discovery_message())
+        return self.beacon_payload
+
+    def _discovery_reply(self, data):
+        query = decode_datagram(data)
+        if query.get('type') != 'discovery_query' or query.get('client_id') == MY_ID:
+            return None
+        if METRICS.enabled:
+            METRICS.incr(discovery_queries_answered=1)
+        reply = self._discovery_message()
+        nonce = query.get('nonce')
+        reply['nonce'] = nonce if isinstance(nonce, int) else None
+        return self._encode_discovery(reply)
+
+    def _discovery_activity(self, changed=False):
+        self.beacon.activity()
+        if changed:
+            self.beacon_wakeup.set()
+
+    def _request_name_message(self):
+        message_obj = {'type': 'request_name', 'data': MY_ID, 'codecs': list(PREFERRED_CODECS),
+                       'compression': compression_methods(), 'session': self.session_id}
+        if self.heartbeat_interval > 0:
+            message_obj['heartbeat'] = {'interval': self.heartbeat_interval, 'timeout': self.heartbeat_timeout}
+        return message_obj
+
+    def _start_heartbeats(self):
+        if self.heartbeat_interval > 0:
+            threading.Thread(target=self._run_heartbeats, daemon=True).start()
+
+    def _run_heartbeats(self):
+        while self.running:
+            time.sleep(self.wheel.tick)
+            for conn in self.wheel.advance():
+                self._check_heartbeat(conn)
+
+    def _track(self, conn):
+        if self.heartbeat_interval > 0:
+            self.wheel.schedule(conn, self.heartbeat_interval)
+
+    def _check_heartbeat(self, conn):
+        # Conexões que já saíram simplesmente não voltam para a roda. Só é
+        # derrubado por silêncio quem responde ping ou nunca se apresentou.
+        if self.registry.get(conn.address) is not conn:
+            return
+        idle = time.monotonic() - conn.last_seen
+        reapable = conn.heartbeat or conn.id is None
+        if reapable and idle >= self.heartbeat_timeout:
+            self._reap(conn, idle)
+            return
+        if idle < self.heartbeat_interval:
+            delay = self.heartbeat_interval - idle
+        else:
+            if conn.heartbeat:
+                conn.writer.enqueue(encode_frame({'type': 'ping', 'sent': time.monotonic()}, conn.writer.codec))
+                if METRICS.enabled:
+                    METRICS.incr(heartbeat_pings=1)
+            delay = min(self.heartbeat_interval, self.heartbeat_timeout - idle) if reapable else self.heartbeat_interval
+        self.wheel.schedule(conn, delay)
+
+    def _reap(self, conn, idle):
+        show(f"Amigo {conn.display_name()} sem resposta há {idle:.0f}s; desconectado.")
+        if METRICS.enabled:
+            METRICS.incr(heartbeat_reaped=1)
+        conn = self._drop_client(conn.address)
+        if conn is not None:
+            self._abort(conn)
+
+    def _accept_connections(self):
+        while self.running:
+            try:
+                self.server_socket.settimeout(1.0)
+                client_socket, client_address = self.server_socket.accept()
+                show(f"Novo amigo conectado: {client_address[0]}:{client_address[1]}")
+                tune_socket(client_socket, self.tcp_keepalive)
+                conn = ClientConnection(client_socket, client_address)
+                conn.writer = ClientWriter(client_socket, lambda e, addr=client_address: self._on_send_error(addr, e),
+                                           self.send_queue_size, self.overflow_policy, self.flush_delay)
+                self.registry.add(conn)
+                self._track(conn)
+                if METRICS.enabled:
+                    METRICS.incr(connects=1)
+                self._discovery_activity()
+                conn.writer.enqueue(encode_frame(self._request_name_message()))
+                threading.Thread(target=self._handle_client, args=(conn,)).start()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    show(f"Erro ao aceitar conexão: {e}")
+                break
+
+    def _handle_client(self, conn):
+        decoder = FrameDecoder(self.max_frame_size)
+        try:
+            while self.running:
+                data = conn.sock.recv(RECV_SIZE)
+                if not data:
+                    show(f"Amigo {conn.display_name()} desconectou.")
+                    self._drop_client(conn.address)
+                    break
+
+                conn.last_seen = time.monotonic()
+                messages = decoder.sized_messages(data)
+                conn.bytes_in += len(data)
+                conn.messages_in += len(messages)
+                if METRICS.enabled:
+                    METRICS.incr(bytes_in=len(data), messages_in=len(messages))
+                for message_obj, size in messages:
+                    delay = self._throttle(conn, message_obj, size)
+                    if delay is None:
+                        self._drop_flooder(conn)
+                        return
+                    if delay:
+                        time.sleep(delay)
+                    self._process_message(message_obj, conn)
+        except FrameError as e:
+            self._reject_frame(conn, e)
+        except Exception as e:
+            if self.running:
+                show(f"Erro ao lidar com cliente {conn.address}: {e}")
+            self._drop_client(conn.address)
+        finally:
+            # O leitor é o dono do socket: fecha ao sair, por qualquer motivo
+            # (inclusive reaped pelo batimento). Com dados ainda por ler, o
+            # close manda RST e quem inunda para de escrever.
+            conn.sock.close()
+
+    def _throttle(self, conn, message_obj, size):
+        # Quanto esperar antes de processar a mensagem (0 passa direto), ou
+        # None se a conexão segue à frente do próprio limite há tempo demais.
+        # O limite da sala só atrasa: sala cheia não é culpa de quem fala.
+        if message_obj.get('type') in RATE_EXEMPT:
+            return 0.0
+        if conn.limiter is None:
+            conn.limiter = RateLimiter(*self.client_rate)
+        delay = conn.limiter.take(size)
+        if not delay:
+            conn.debt = 0.0
+        else:
+            conn.debt += delay
+            conn.throttled += 1
+            conn.throttled_at = time.monotonic() + delay
+            if METRICS.enabled:
+                METRICS.incr(rate_throttled=1)
+                METRICS.observe('rate_delay', delay)
+            if conn.debt > RATE_MAX_DEBT:
+                return None
+        room = message_obj.get('room', DEFAULT_ROOM)
+        if message_obj.get('type') in ('chat_message', 'file_offer') and isinstance(room, str) and room in conn.rooms:
+            limiter = self.room_limiters.get(room)
+            if limiter is None:
+                limiter = self.room_limiters.setdefault(room, RateLimiter(*self.room_rate))
+            room_delay = limiter.take(size)
+            if room_delay and METRICS.enabled:
+                METRICS.incr(rate_throttled_room=1)
+            delay = max(delay, room_delay)
+        return delay
+
+    def _drop_flooder(self, conn):
+        show(f"Amigo {conn.display_name()} continuou passando do limite de mensagens; desconectado.")
+        if METRICS.enabled:
+            METRICS.incr(rate_disconnects=1)
+        conn = self._drop_client(conn.address)
+        if conn is not None:
+            self._abort(conn)
+
+    def _reject_frame(self, conn, error):
+        if self.running:
+            show(f"Amigo {conn.display_name()} mandou um frame inválido ({error}); desconectado.")
+        if METRICS.enabled:
+            METRICS.incr(oversized_frames=1)
+        conn = self._drop_client(conn.address)
+        if conn is not None:
+            self._abort(conn)
+
+    def _drop_client(self, client_address):
+        conn = self.registry.remove(client_address)
+        if conn is not None:
+            if METRICS.enabled:
+                METRICS.incr(disconnects=1)
+            conn.writer.close()
+            self._discovery_activity()
+        return conn
+
+    def _on_send_error(self, client_address, error):
+        if not self.running:
+            return
+        show(f"Erro ao enviar mensagem para {client_address}: {error}")
+        if METRICS.enabled:
+            if isinstance(error, SendQueueFull):
+                METRICS.incr(send_overflows=1)
+            else:
+                METRICS.incr(send_errors=1)
+        conn = self._drop_client(client_address)
+        if conn is not None:
+            self._abort(conn)
+
+    def _abort(self, conn):
+        # Acorda o leitor da conexão, que então termina sozinho.
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _process_message(self, message_obj, conn):
+        if message_obj['type'] == 'name_intro':
+            remote_name = message_obj['name']
+            remote_id = message_obj['id']
+            self.registry.identify(conn, remote_id)
+            conn.name = remote_name
+            conn.heartbeat = bool(message_obj.get('heartbeat'))
+            writer = conn.writer
+            writer.codec = choose_codec(message_obj.get('codecs'))
+            if writer.compressor is None and 'zlib' in compression_methods() and 'zlib' in message_obj.get('compression', ()):
+                writer.compressor = FrameCompressor()
+            show(f"\nCHAT DE {remote_name} ({remote_id}): Conectado.")
+            if remember_contact(remote_id, remote_name):
+                show(f"Adicionado novo contato: {remote_name} (Código: {remote_id})")
+            resume = message_obj.get('resume') or {}
+            last_seen = resume.get('rooms', {}) if resume.get('session') == self.session_id else {}
+            requested = [room for room in message_obj.get('rooms', ()) if self.registry.has_room(room)]
+            for room in requested or [DEFAULT_ROOM]:
+                self._join_room(conn, room, last_seen.get(room), message_obj.get('history'))
+            self._send_room_list(conn)
+        elif message_obj['type'] == 'join_room':
+            if self.registry.has_room(message_obj.get('room')):
+                self._join_room(conn, message_obj['room'], history=message_obj.get('history'))
+            self._send_room_list(conn)
+        elif message_obj['type'] == 'leave_room':
+            self.registry.unsubscribe(conn, message_obj.get('room'))
+            self._send_room_list(conn)
+        elif message_obj['type'] in ('chat_message', 'file_offer'):
+            # Campos de tipo errado ficariam no anel da sala e quebrariam o
+            # replay para quem entrasse depois: são recusados na chegada.
+            room = message_obj.setdefault('room', DEFAULT_ROOM)
+            if not isinstance(room, str) or room not in conn.rooms:
+                return
+            if message_obj['type'] == 'chat_message' and not valid_chat_message(message_obj):
+                return
+            if message_obj['type'] == 'file_offer':
+                if not valid_file_offer(message_obj) or message_obj['sender_id'] != conn.id:
+                    return
+                self.file_owners[message_obj['transfer_id']] = conn.id
+            self._room_message(message_obj, conn)
+        elif message_obj['type'] in ('file_accept', 'file_ack'):
+            message_obj['receiver_id'] = conn.id
+            self._route_file(message_obj)
+        elif message_obj['type'] == 'file_chunk':
+            if self.file_owners.get(message_obj['transfer_id']) == conn.id:
+                self._route_file(message_obj)
+        elif message_obj['type'] == 'ping':
+            conn.writer.enqueue(encode_frame({'type': 'pong', 'sent': message_obj.get('sent')}, conn.writer.codec))
+        elif message_obj['type'] == 'pong':
+            if METRICS.enabled and isinstance(message_obj.get('sent'), (int, float)):
+                METRICS.incr(heartbeat_pongs=1)
+                METRICS.observe('heartbeat_rtt', time.monotonic() - message_obj['sent'])
+
+    def _room_message(self, message_obj, conn):
+        sender_id = message_obj.get('sender_id', 'Desconhecido')
+        self._show_room_message(message_obj, CONTACTS.get(sender_id, conn.name or f"Amigo ({sender_id[:8]})"))
+        self.broadcast_message(message_obj, sender_socket=conn.sock, room=message_obj['room'])
+
+    def _show_room_message(self, message_obj, sender_name):
+        if message_obj['type'] == 'file_offer':
+            self.files.on_offer(message_obj, sender_name)
+            return
+        save_message(message_obj.get('sender_id', 'Desconhecido'), MY_ID, message_obj['content'], is_me=False)
+        if not self.headless:
+            show(f"{room_label(message_obj['room'])}[{sender_name}]: {message_obj['content']}")
+
+    def _route_file(self, message_obj):
+        # Mensagens de arquivo vão só para o destinatário, pela mesma fila de
+        # saída do fan-out: os pedaços se intercalam com o texto e o host
+        # nunca guarda mais que os pedaços em trânsito.
+        target_id = file_target(message_obj)
+        if target_id == MY_ID:
+            self.files.handle(message_obj)
+            return
+        self._deliver_file_frame(target_id, file_frame(message_obj))
+
+    def _deliver_file_frame(self, target_id, frame):
+        target = self.registry.find(target_id)
+        if target is None:
+            # O destinatário saiu; quem envia para por falta de confirmação e
+            # retoma quando ele voltar e aceitar de novo.
+            return
+        if target.writer.enqueue(frame) and METRICS.enabled:
+            METRICS.incr(file_frames_relayed=1, file_bytes_relayed=len(frame))
+
+    def _send_file_message(self, message_obj):
+        if message_obj['type'] == 'file_offer':
+            self.broadcast_message(message_obj)
+        else:
+            self._dispatch(self._route_file, message_obj)
+
+    def _send_file_chunk(self, receiver_id, buffers):
+        self._dispatch(self._deliver_file_frame, receiver_id, b''.join(buffers))
+        return True
+
+    def _room_log(self, room):
+        log = self.room_logs.get(room)
+        if log is None:
+            log = self.room_logs.setdefault(room, RoomLog())
+        return log
+
+    def _join_room(self, conn, room, last_seq=None, history=None):
+        # Inscrição e envio do que já foi dito acontecem sob o lock da sala,
+        # antes de qualquer mensagem nova para este cliente. Quem retoma uma
+        # sessão recebe só o que perdeu; quem chega recebe o histórico recente.
+        log = self._room_log(room)
+        codec = conn.writer.codec
+        with log.lock:
+            if not self.registry.subscribe(conn, room):
+                return
+            if last_seq is not None:
+                seqs, missed = log.since(last_seq)
+                if not seqs and not missed:
+                    return
+                status = {'type': 'resume_status', 'room': room, 'replayed': len(seqs), 'missed': missed}
+            else:
+                seqs = log.recent(*self._history_window(history))
+                if not seqs:
+                    return
+                status = {'type': 'history_sync', 'room': room, 'count': len(seqs)}
+            frames = [frame for frame in (log.frame(seq, codec) for seq in seqs) if frame is not None]
+            conn.writer.enqueue([encode_frame(status, codec)] + frames)
+
+    def _expire_offers(self, message_obj, room):
+        # Oferta que saiu do anel da sala não aparece mais para ninguém: o
+        # dono e o que este host guardou dela podem ir embora. Chamado com a
+        # sala já ordenada (lock do anel, ou do processo principal).
+        offers = self.room_offers.get(room)
+        if offers is None:
+            offers = self.room_offers.setdefault(room, collections.deque())
+        seq = message_obj['seq']
+        if message_obj.get('type') == 'file_offer':
+            offers.append((seq, message_obj['transfer_id']))
+        while offers and offers[0][0] <= seq - REPLAY_BUFFER_SIZE:
+            transfer_id = offers.popleft()[1]
+            self.file_owners.pop(transfer_id, None)
+            self.files.forget(transfer_id)
+
+    def _history_window(self, history):
+        # O cliente pode pedir menos que HISTORY_SYNC_SIZE mensagens, ou só
+        # as que chegaram depois de um horário (ISO 8601, hora local).
+        history = history if isinstance(history, dict) else {}
+        try:
+            limit = max(0, min(int(history.get('limit', HISTORY_SYNC_SIZE)), HISTORY_SYNC_SIZE))
+        except (TypeError, ValueError):
+            limit = HISTORY_SYNC_SIZE
+        since_time = None
+        if history.get('since'):
+            try:
+                since_time = datetime.fromisoformat(history['since']).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return limit, since_time
+
+    def _room_list_message(self, conn):
+        # 'seqs' diz a quem acabou de entrar de onde retomar, mesmo antes de
+        # receber alguma mensagem da sala.
+        seqs = {}
+        for room in conn.rooms:
+            log = self._room_log(room)
+            with log.lock:
+                seqs[room] = log.seq
+        return {'type': 'room_list', 'rooms': self.registry.rooms(), 'joined': sorted(conn.rooms), 'seqs': seqs}
+
+    def _send_room_list(self, conn):
+        conn.writer.enqueue(encode_frame(self._room_list_message(conn), conn.writer.codec))
+
+    def _announce_rooms(self):
+        for conn in self.registry.snapshot():
+            self._send_room_list(conn)
+
+    def create_room(self, room):
+        if not valid_room_name(room):
+            print(f"Nome de sala inválido: '{room}'")
+            return False
+        if self.registry.has_room(room):
+            return False
+        self._dispatch(self._add_room, room)
+        return True
+
+    def _add_room(self, room):
+        self.registry.add_room(room)
+        self.beacon_payload = None
+        self._discovery_activity(changed=True)
+        self._announce_rooms()
+
+    def _room_member_count(self, room):
+        return len(self.registry.room_snapshot(room))
+
+    def _dispatch(self, callback, *args):
+        callback(*args)
+
+    def broadcast_message(self, message_obj, sender_socket=None, room=None):
+        if room is None:
+            room = message_obj.get('room', DEFAULT_ROOM)
+        self._dispatch(self._fan_out, message_obj, sender_socket, room)
+
+    def _fan_out(self, message_obj, sender_socket, room, seq=None):
+        # Serializa uma vez por codec; as filas de saída compartilham os mesmos bytes.
+        # A tupla da sala é imutável: pode ser percorrida sem lock nem cópia.
+        start = time.perf_counter() if METRICS.enabled else None
+        frames = {}
+        sent = sent_bytes = 0
+        waiting = []
+        log = self._room_log(room)
+        with log.lock:
+            message_obj['seq'] = log.append(message_obj, frames, seq)
+            self._expire_offers(message_obj, room)
+            for conn in self.registry.room_snapshot(room):
+                if conn.sock is sender_socket:
+                    continue
+                writer = conn.writer
+                frame = frames.get(writer.codec)
+                if frame is None:
+                    frame = frames[writer.codec] = encode_frame(message_obj, writer.codec)
+                conn.messages_out += 1
+                conn.bytes_out += len(frame)
+                sent += 1
+                sent_bytes += len(frame)
+                writer.enqueue(frame)
+                if writer.full():
+                    waiting.append(writer)
+        if start is not None:
+            METRICS.observe('fan_out', time.perf_counter() - start)
+            METRICS.incr(messages_out=sent, bytes_out=sent_bytes, fan_outs=1)
+        if waiting:
+            self._wait_for_room(waiting)
+
+    def _wait_for_room(self, writers):
+        # 'backpressure': quem enviou espera aqui, sem o lock da sala, até as
+        # filas cheias esvaziarem (ou derruba quem não esvaziar no prazo).
+        for writer in writers:
+            writer.wait_for_room()
+
+    def _handle_command(self, message):
+        command, _, argument = message.partition(' ')
+        argument = argument.strip()
+        if command == '/salas':
+            for room in self.registry.rooms():
+                marker = '*' if room == self.current_room else ' '
+                print(f" {marker} #{room} ({self._room_member_count(room)} pessoa(s))")
+        elif command == '/criar' and argument:
+            if self.create_room(argument):
+                print(f"Sala #{argument} criada.")
+        elif command == '/sala' and argument:
+            if self.registry.has_room(argument):
+                self.current_room = argument
+                print(f"Agora você fala em #{argument}.")
+            else:
+                print(f"Sala #{argument} não existe. Use /criar {argument}.")
+        elif command == '/enviar' and argument:
+            self.files.offer(argument, self.current_room)
+        elif command == '/aceitar' and argument:
+            self.files.accept(argument)
+        elif command == '/arquivos':
+            self.files.show()
+        elif command == '/limites':
+            self._show_limits()
+        elif command == '/historico':
+            history_command(argument)
+        elif not handle_diagnostic_command(command, argument):
+            print("Comandos: /salas, /criar <sala>, /sala <sala>, /enviar <arquivo>, /aceitar <código>, /arquivos, "
+                  "/limites, /historico [data] [página], /metricas [on|off], /perfil, /memoria, sair")
+
+    def _show_limits(self):
+        def rate(limits):
+            messages, size = limits
+            parts = [f"{messages:g} msg/s"] if messages > 0 else []
+            if size > 0:
+                parts.append(f"{format_size(size)}/s")
+            return ' e '.join(parts) or "sem limite"
+        print(f"Por conexão: {rate(self.client_rate)}; por sala: {rate(self.room_rate)}; "
+              f"frame máximo: {format_size(self.max_frame_size)}")
+        throttled = sorted((c for c in self.registry.snapshot() if c.throttled), key=lambda c: -c.throttled)
+        for conn in throttled:
+            print(f"  {conn.display_name()}: estrangulado {conn.throttled} vez(es), espera acumulada {conn.debt:.1f}s")
+        if not throttled:
+            print("Ninguém passou dos limites.")
+
+    def _handle_user_input(self):
+        while self.running:
+            try:
+                message = input("")
+                if message.lower() == 'sair':
+                    self.stop()
+                    break
+                if message.startswith('/'):
+                    self._handle_command(message)
+                elif message:
+                    message_obj = {
+                        'type': 'chat_message',
+                        'sender_id': MY_ID,
+                        'content': message,
+                        'timestamp': datetime.now().isoformat(),
+                        'room': self.current_room
+                    }
+                    save_message(MY_ID, "ALL", message, is_me=True)
+                    show(f"{room_label(self.current_room)}[Eu]: {message}")
+                    self.broadcast_message(message_obj)
+            except EOFError:
+                print("Entrada de usuário encerrada.")
+                self.stop()
+                break
+            except Exception as e:
+                print(f"Erro na entrada do usuário: {e}")
+                self.stop()
+                break
+
+    def stop(self):
+        print("Encerrando servidor...")
+        self.running = False
+
+        self.beacon_wakeup.set()
+        if self.broadcast_socket:
+            try:
+                self.broadcast_socket.close()
+            except Exception as e:
+                print(f"Erro ao fechar socket de broadcast: {e}")
+        if self.query_socket:
+            self.query_socket.close()
+
+        self.files.close()
+        connections = self.registry.clear()
+        for conn in connections:
+            conn.writer.close()
+
+        # Cada leitor fecha o próprio socket ao acordar.
+        for conn in connections:
+            self._abort(conn)
+
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        finally:
+            self.server_socket.close()
+        print_compression_summary()
+        print("Servidor encerrado.")
+
+class AsyncChatServer(ChatServer):
+    # Mesmo protocolo do ChatServer, mas descoberta, conexões, leituras e
+    # fan-out rodam em um único event loop asyncio em vez de uma thread por cliente.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.loop_thread = None
+        self.tcp_server = None
+        self.stop_event = None
+        self.beacon_event = None
+
+    def start(self):
+        try:
+            self.server_socket.bind((self.host_ip, self.chat_port))
+            self.server_socket.listen(self.backlog)
+            self.server_socket.setblocking(False)
+        except OSError as e:
+            if e.errno == 98:
+                print(f"\nErro: A porta {self.chat_port} já está em uso ou o servidor já está rodando. Tente novamente mais tarde ou reinicie.")
+            else:
+                print(f"\nErro ao iniciar o servidor: {e}")
+            self.running = False
+            return
+
+        print(f"\n--- Servidor de Chat (asyncio) Iniciado em {self.host_ip}:{self.chat_port} ---")
+        print("Aguardando conexões de amigos na mesma rede Wi-Fi...")
+        print(f"Seu código de chat (compartilhe com amigos): {MY_ID}")
+
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.loop_thread = threading.Thread(target=self._run_loop, args=(started,))
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+        started.wait()
+
+        self._start_user_input()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve(started))
+        except Exception as e:
+            if self.running:
+                print(f"Erro no servidor asyncio: {e}")
+            self.running = False
+        finally:
+            self.loop.close()
+
+    async def _serve(self, started):
+        self.stop_event = asyncio.Event()
+        self.beacon_event = asyncio.Event()
+        self.tcp_server = await asyncio.start_server(
+            self._handle_client_async, sock=self.server_socket,
+            backlog=self.backlog, limit=RECV_SIZE)
+        discovery_tasks = [
+            asyncio.create_task(self._broadcast_discovery()),
+            asyncio.create_task(self._answer_discovery_queries_async()),
+        ]
+        if self.heartbeat_interval > 0:
+            discovery_tasks.append(asyncio.create_task(self._run_heartbeats_async()))
+        started.set()
+
+        await self.stop_event.wait()
+
+        for task in discovery_tasks:
+            task.cancel()
+        self.tcp_server.close()
+        connections = self.registry.clear()
+        for conn in connections:
+            conn.writer.close()
+        for conn in connections:
+            conn.sock.transport.abort()
+        if self.broadcast_socket:
+            self.broadcast_socket.close()
+        if self.query_socket:
+            self.query_socket.close()
+        # Com os transports fechados, leitores e escritores terminam sozinhos.
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=1.0)
+
+    async def _broadcast_discovery(self):
+        self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.broadcast_socket.setblocking(False)
+
+        broadcast_ip = get_broadcast_ip(self.host_ip)
+
+        print(f"Iniciando broadcast de descoberta em {broadcast_ip}:{self.discovery_port}")
+
+        while self.running:
+            try:
+                await self.loop.sock_sendto(self.broadcast_socket, self._discovery_payload(), (broadcast_ip, self.discovery_port))
+                if METRICS.enabled:
+                    METRICS.incr(discovery_beacons_sent=1)
+            except Exception as e:
+                if self.running:
+                    print(f"Erro no broadcast UDP: {e}")
+                break
+            interval = self.beacon.next_interval()
+            await asyncio.sleep(self.beacon.min_interval)
+            try:
+                await asyncio.wait_for(self.beacon_event.wait(), interval - self.beacon.min_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.beacon_event.clear()
+
+    async def _answer_discovery_queries_async(self):
+        self.query_socket = self._open_query_socket()
+        if self.query_socket is None:
+            return
+        self.query_socket.setblocking(False)
+        while self.running:
+            try:
+                data, addr = await self.loop.sock_recvfrom(self.query_socket, DATAGRAM_SIZE)
+            except OSError as e:
+                if self.running:
+                    print(f"Erro ao responder consulta de descoberta: {e}")
+                break
+            try:
+                reply = self._discovery_reply(data)
+                if reply is not None:
+                    await self.loop.sock_sendto(self.query_socket, reply, addr)
+            except Exception:
+                continue
+
+    def _discovery_activity(self, changed=False):
+        self.beacon.activity()
+        if changed and self.beacon_event is not None:
+            self.beacon_event.set()
+
+    def _wait_for_room(self, writers):
+        # Aqui o event loop não pode parar: o leitor de quem enviou aguarda
+        # wait_for_room() depois de processar o que recebeu.
+        pass
+
+    async def _run_heartbeats_async(self):
+        # A mesma roda, avançada pelo event loop em vez de uma thread.
+        while self.running:
+            await asyncio.sleep(self.wheel.tick)
+            for conn in self.wheel.advance():
+                self._check_heartbeat(conn)
+
+    async def _handle_client_async(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        show(f"Novo amigo conectado: {client_address[0]}:{client_address[1]}")
+        tune_socket(writer.get_extra_info('socket'), self.tcp_keepalive)
+        conn = ClientConnection(writer, client_address)
+        conn.writer = AsyncClientWriter(writer, lambda e: self._on_send_error(client_address, e),
+                                        self.send_queue_size, self.overflow_policy, self.flush_delay)
+        self.registry.add(conn)
+        self._track(conn)
+        if METRICS.enabled:
+            METRICS.incr(connects=1)
+        self._discovery_activity()
+        conn.writer.enqueue(encode_frame(self._request_name_message()))
+        decoder = FrameDecoder(self.max_frame_size)
+        try:
+            while self.running:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    show(f"Amigo {conn.display_name()} desconectou.")
+                    break
+
+                conn.last_seen = time.monotonic()
+                messages = decoder.sized_messages(data)
+                conn.bytes_in += len(data)
+                conn.messages_in += len(messages)
+                if METRICS.enabled:
+                    METRICS.incr(bytes_in=len(data), messages_in=len(messages))
+                written = set()
+                for message_obj, size in messages:
+                    delay = self._throttle(conn, message_obj, size)
+                    if delay is None:
+                        self._drop_flooder(conn)
+                        return
+                    if delay:
+                        await asyncio.sleep(delay)
+                    self._process_message(message_obj, conn)
+                    if message_obj['type'] in ('chat_message', 'file_offer') and isinstance(message_obj['room'], str):
+                        written.add(message_obj['room'])
+                # Com 'backpressure', só volta a ler deste cliente quando as
+                # filas de quem está nas salas em que ele escreveu tiverem espaço.
+                if self.overflow_policy == 'backpressure':
+                    for room in written:
+                        for other in self.registry.room_snapshot(room):
+                            await other.writer.wait_for_room()
+        except FrameError as e:
+            self._reject_frame(conn, e)
+        except Exception as e:
+            if self.running:
+                show(f"Erro ao lidar com cliente {client_address}: {e}")
+        finally:
+            self._drop_client(client_address)
+            writer.close()
+
+    def _abort(self, conn):
+        conn.sock.transport.abort()
+
+    def _dispatch(self, callback, *args):
+        if self._in_loop():
+            callback(*args)
+        elif self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def stop(self):
+        print("Encerrando servidor...")
+        self.running = False
+        self.files.close()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            if threading.current_thread() is not self.loop_thread:
+                self.loop_thread.join(timeout=5)
+        else:
+            self.server_socket.close()
+        print_compression_summary()
+        print("Servidor encerrado.")
+
+def send_bus(sock, lock, message_obj):
+    # Pedaços de arquivo já chegam como frame e atravessam o barramento intactos.
+    frame = message_obj if isinstance(message_obj, bytes) else encode_frame(message_obj)
+    with lock:
+        sock.sendall(frame)
+
+def route_payload(message_obj, room, sender=('0.0.0.0', 0), origin=BUS_NO_ORIGIN, sender_name=''):
+    codec_id, body = encode_payload(message_obj, BINARY_CODEC)
+    room_bytes = room.encode('utf-8')[:255]
+    name_bytes = sender_name.encode('utf-8')[:255]
+    return (BUS_ROUTE.pack(0, socket.inet_aton(sender[0]), sender[1], origin, codec_id, len(room_bytes), len(name_bytes))
+            + room_bytes + name_bytes + body)
+
+def routed_frame(payload):
+    return FRAME_HEADER.pack(len(payload), FLAG_BUS_ROUTED) + payload
+
+def route_room(payload):
+    return payload[BUS_ROUTE.size:BUS_ROUTE.size + BUS_ROUTE.unpack_from(payload)[5]]
+
+def parse_route(payload):
+    seq, ip, port, origin, codec_id, room_size, name_size = BUS_ROUTE.unpack_from(payload)
+    start = BUS_ROUTE.size
+    room = payload[start:start + room_size].decode('utf-8')
+    start += room_size
+    sender_name = payload[start:start + name_size].decode('utf-8', 'replace')
+    message_obj = decode_payload(codec_id, payload[start + name_size:])
+    message_obj['seq'] = seq
+    return message_obj, room, (socket.inet_ntoa(ip), port), origin, sender_name
+
+class WorkerChatServer(ChatServer):
+    # Um processo do modo multiprocesso. Atende os clientes que aceitar no
+    # socket de escuta compartilhado; mensagens de sala vão para o processo
+    # principal pelo barramento e voltam numeradas para todos os workers,
+    # inclusive este, que então faz o fan-out local.
+    def __init__(self, listen_socket, bus_socket, worker_id, session_id, rooms, **kwargs):
+        host_ip, chat_port = listen_socket.getsockname()[:2]
+        super().__init__(host_ip, chat_port, None, rooms=rooms, **kwargs)
+        self.server_socket.close()
+        self.server_socket = listen_socket
+        self.bus = bus_socket
+        self.bus_lock = threading.Lock()
+        self.worker_id = worker_id
+        self.session_id = session_id
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._accept_connections, daemon=True).start()
+        threading.Thread(target=self._read_bus, daemon=True).start()
+        threading.Thread(target=self._report_metrics, daemon=True).start()
+        self._start_heartbeats()
+
+    def _read_bus(self):
+        decoder = FrameDecoder()
+        try:
+            while self.running:
+                data = self.bus.recv(RECV_SIZE)
+                if not data:
+                    break
+                for flags, payload in decoder.feed(data):
+                    if flags & FLAG_BUS_ROUTED:
+                        self._on_routed(payload)
+                    else:
+                        self._on_bus_message(decode_payload(flags, payload))
+        except Exception as e:
+            if self.running:
+                print(f"Erro no barramento do worker {self.worker_id}: {e}")
+        self.stop()
 
-def save_user_data(user_id, user_name):
-    try:
-        with open(USER_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'id': user_id, 'name': user_name}, f)
-    except Exception as e:
-        print(f"Erro ao salvar dados do usuário: {e}")
+    def _on_routed(self, payload):
+        message_obj, room, sender, origin, _ = parse_route(payload)
+        sender_socket = None
+        if origin == self.worker_id:
+            conn = self.registry.get(sender)
+            sender_socket = conn.sock if conn is not None else None
+        self._fan_out(message_obj, sender_socket, room, message_obj['seq'])
 
-MY_ID = None
-MY_NAME = None
+    def _on_bus_message(self, message_obj):
+        if message_obj['type'] == 'bus_room':
+            if self.registry.add_room(message_obj['room']):
+                self._announce_rooms()
+        elif message_obj['type'] in FILE_MESSAGES:
+            self._deliver_file_frame(file_target(message_obj), file_frame(message_obj))
+        elif message_obj['type'] == 'bus_metrics':
+            METRICS.enabled = message_obj['enabled']
+        elif message_obj['type'] == 'bus_stop':
+            self.running = False
 
-CONTACTS = {}
+    def _publish(self, message_obj):
+        try:
+            send_bus(self.bus, self.bus_lock, message_obj)
+        except OSError as e:
+            if self.running:
+                print(f"Erro ao publicar no barramento: {e}")
 
-def get_local_ip():
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip_address = s.getsockname()[0]
-        s.close()
-        return ip_address
-    except Exception as e:
-        print(f"Erro ao obter IP local: {e}. Verifique sua conexão Wi-Fi.")
-        return "127.0.0.1"
+    def _process_message(self, message_obj, conn):
+        super()._process_message(message_obj, conn)
+        if message_obj['type'] in ('name_intro', 'join_room', 'leave_room'):
+            self._report()
 
-def get_broadcast_ip(local_ip):
-    if local_ip == "127.0.0.1":
-        return "255.255.255.255"
-    parts = local_ip.split('.')
-    return f"{parts[0]}.{parts[1]}.{parts[2]}.255"
+    def _room_message(self, message_obj, conn):
+        # Codificada aqui, uma vez; o processo principal repassa os bytes.
+        sender_id = message_obj.get('sender_id', 'Desconhecido')
+        sender_name = CONTACTS.get(sender_id, conn.name or f"Amigo ({sender_id[:8]})")
+        self._publish(routed_frame(route_payload(message_obj, message_obj['room'], conn.address,
+                                                 self.worker_id, sender_name)))
 
-class ChatServer:
-    def __init__(self, host_ip, chat_port, discovery_port):
-        self.host_ip = host_ip
-        self.chat_port = chat_port
-        self.discovery_port = discovery_port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients = {}
-        self.client_names = {}
-        self.running = True
-        self.broadcast_socket = None
+    def _route_file(self, message_obj):
+        # Destinatário em outro worker, ou o próprio host: segue pelo barramento.
+        target = self.registry.find(file_target(message_obj))
+        if target is not None:
+            target.writer.enqueue(file_frame(message_obj))
+        else:
+            self._publish(file_frame(message_obj))
 
-    def start(self):
-        try:
-            self.server_socket.bind((self.host_ip, self.chat_port))
-            self.server_socket.listen(5)
-            print(f"\n--- Servidor de Chat Iniciado em {self.host_ip}:{self.chat_port} ---")
-            print("Aguardando conexões de amigos na mesma rede Wi-Fi...")
-            print(f"Seu código de chat (compartilhe com amigos): {MY_ID}")
+    def _discovery_activity(self, changed=False):
+        self._report()
 
-            accept_thread = threading.Thread(target=self._accept_connections)
-            accept_thread.daemon = True
-            accept_thread.start()
+    def _report(self):
+        # Contagens deste worker, para o beacon e o /salas do processo principal.
+        rooms = {room: len(self.registry.room_snapshot(room)) for room in self.registry.rooms()}
+        self._publish({'type': 'bus_activity', 'worker': self.worker_id, 'clients': len(self.registry), 'rooms': rooms})
 
-            broadcast_thread = threading.Thread(target=self._start_udp_broadcasting)
-            broadcast_thread.daemon = True
-            broadcast_thread.start()
+    def _report_metrics(self):
+        # Manda o acumulado, não a diferença: o principal só guarda o último.
+        while not self.stopped.wait(METRICS_WORKER_INTERVAL):
+            if METRICS.enabled:
+                self._publish({'type': 'bus_metrics', 'worker': self.worker_id, 'metrics': METRICS.export()})
 
-            threading.Thread(target=self._handle_user_input).start()
+    def stop(self):
+        self.running = False
+        for conn in self.registry.clear():
+            conn.writer.close()
+            self._abort(conn)
+        # O socket de escuta é compartilhado: cada worker só fecha a sua cópia.
+        self.server_socket.close()
+        self.bus.close()
+        self.stopped.set()
+
+def run_worker(listen_socket, bus_socket, worker_id, host_id, host_name, session_id, rooms, options):
+    global MY_ID, MY_NAME
+    MY_ID, MY_NAME = host_id, host_name
+    # Processo novo (spawn): o estado das métricas vem do principal.
+    METRICS.enabled = options.pop('metrics')
+    worker = WorkerChatServer(listen_socket, bus_socket, worker_id, session_id, rooms, **options)
+    worker.start()
+    worker.stopped.wait()
+
+class MultiProcessChatServer(ChatServer):
+    # Processo principal do modo multiprocesso: abre o socket de escuta,
+    # inicia os workers e faz o papel de barramento. Também cuida da
+    # descoberta, do console do host e do histórico local.
+    def __init__(self, host_ip, chat_port, discovery_port, workers=WORKER_COUNT, **kwargs):
+        super().__init__(host_ip, chat_port, discovery_port, **kwargs)
+        self.worker_count = min(max(1, workers), BUS_NO_ORIGIN)
+        self.workers = []
+        self.buses = []
+        self.bus_writers = []
+        # Um lock só para numerar e enfileirar: todos os workers recebem as
+        # mensagens na mesma ordem. Dentro dele nada bloqueia (as filas de
+        # saída têm thread própria), então um worker que publica enquanto o
+        # principal lhe escreve nunca trava os dois.
+        self.hub_lock = threading.Lock()
+        self.room_seqs = collections.Counter()
+        self.worker_stats = {}
+        # Mensagens já repassadas, para o console e o histórico do host, que
+        # decodificam fora do caminho do repasse.
+        self.relayed = collections.deque()
+        self.relayed_cond = threading.Condition()
+
+    @staticmethod
+    def supported():
+        return os.name == 'posix' and hasattr(socket, 'socketpair')
 
+    def start(self):
+        try:
+            self.server_socket.bind((self.host_ip, self.chat_port))
+            self.server_socket.listen(self.backlog)
         except OSError as e:
             if e.errno == 98:
                 print(f"\nErro: A porta {self.chat_port} já está em uso ou o servidor já está rodando. Tente novamente mais tarde ou reinicie.")
             else:
                 print(f"\nErro ao iniciar o servidor: {e}")
             self.running = False
+            return
 
-    def _start_udp_broadcasting(self):
-        self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.broadcast_socket.settimeout(0.5)
-
-        broadcast_ip = get_broadcast_ip(self.host_ip)
-
-        print(f"Iniciando broadcast de descoberta em {broadcast_ip}:{self.discovery_port}")
+        print(f"\n--- Servidor de Chat ({self.worker_count} workers) Iniciado em {self.host_ip}:{self.chat_port} ---")
+        print("Aguardando conexões de amigos na mesma rede Wi-Fi...")
+        print(f"Seu código de chat (compartilhe com amigos): {MY_ID}")
 
-        while self.running:
-            try:
-                discovery_message = {
-                    'type': 'discovery',
-                    'host_ip': self.host_ip,
-                    'chat_port': self.chat_port,
-                    'host_id': MY_ID,
-                    'host_name': MY_NAME
-                }
-                self.broadcast_socket.sendto(json.dumps(discovery_message).encode('utf-8'), (broadcast_ip, self.discovery_port))
-                time.sleep(2)
-            except Exception as e:
-                if self.running:
-                    print(f"Erro no broadcast UDP: {e}")
-                break
+        options = {'backlog': self.backlog, 'send_queue_size': self.send_queue_size,
+                   'overflow_policy': self.overflow_policy, 'flush_delay': self.flush_delay,
+                   'heartbeat_interval': self.heartbeat_interval, 'heartbeat_timeout': self.heartbeat_timeout,
+                   'tcp_keepalive': self.tcp_keepalive, 'client_rate': self.client_rate,
+                   'room_rate': self.room_rate, 'max_frame_size': self.max_frame_size,
+                   'metrics': METRICS.enabled}
+        context = multiprocessing.get_context('spawn')
+        for worker_id in range(self.worker_count):
+            hub_end, worker_end = socket.socketpair()
+            process = context.Process(target=run_worker, daemon=True, args=(
+                self.server_socket, worker_end, worker_id, MY_ID, MY_NAME, self.session_id,
+                self.registry.rooms(), options))
+            process.start()
+            worker_end.close()
+            self.workers.append(process)
+            self.buses.append(hub_end)
+            self.bus_writers.append(ClientWriter(hub_end, lambda e, worker_id=worker_id: self._on_bus_error(worker_id, e),
+                                                 BUS_QUEUE_SIZE, 'disconnect', 0))
+            threading.Thread(target=self._read_worker, args=(worker_id, hub_end), daemon=True).start()
+        threading.Thread(target=self._show_relayed, daemon=True).start()
 
-    def _accept_connections(self):
-        while self.running:
-            try:
-                self.server_socket.settimeout(1.0)
-                client_socket, client_address = self.server_socket.accept()
-                print(f"Novo amigo conectado: {client_address[0]}:{client_address[1]}")
-                self.clients[client_address] = client_socket
-                threading.Thread(target=self._handle_client, args=(client_socket, client_address)).start()
-                client_socket.send(json.dumps({'type': 'request_name', 'data': MY_ID}).encode('utf-8'))
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    print(f"Erro ao aceitar conexão: {e}")
-                break
+        threading.Thread(target=self._start_udp_broadcasting, daemon=True).start()
+        threading.Thread(target=self._answer_discovery_queries, daemon=True).start()
+        self._start_user_input()
 
-    def _handle_client(self, client_socket, client_address):
+    def _read_worker(self, worker_id, bus):
+        decoder = FrameDecoder()
         try:
             while self.running:
-                data = client_socket.recv(BUFFER_SIZE).decode('utf-8')
+                data = bus.recv(RECV_SIZE)
                 if not data:
-                    print(f"Amigo {self.client_names.get(client_address, client_address)} desconectou.")
-                    del self.clients[client_address]
-                    if client_address in self.client_names:
-                        del self.client_names[client_address]
                     break
-
-                message_obj = json.loads(data)
-                if message_obj['type'] == 'name_intro':
-                    remote_name = message_obj['name']
-                    remote_id = message_obj['id']
-                    self.client_names[client_address] = remote_name
-                    print(f"\nCHAT DE {remote_name} ({remote_id}): Conectado.")
-                    if remote_id not in CONTACTS:
-                        CONTACTS[remote_id] = remote_name
-                        print(f"Adicionado novo contato: {remote_name} (Código: {remote_id})")
-                elif message_obj['type'] == 'chat_message':
-                    sender_id = message_obj.get('sender_id', 'Desconhecido')
-                    sender_name = CONTACTS.get(sender_id, self.client_names.get(client_address, f"Amigo ({sender_id[:8]})"))
-                    message_content = message_obj['content']
-                    save_message(sender_id, MY_ID, message_content, is_me=False)
-                    print(f"[{sender_name}]: {message_content}")
-                    self.broadcast_message(message_obj, sender_socket=client_socket)
+                for flags, payload in decoder.feed(data):
+                    if flags & FLAG_BUS_ROUTED:
+                        self._relay(payload)
+                        continue
+                    message_obj = decode_payload(flags, payload)
+                    if message_obj['type'] in FILE_MESSAGES:
+                        self._route_file(message_obj, origin=worker_id)
+                    elif message_obj['type'] == 'bus_activity':
+                        self.worker_stats[worker_id] = message_obj
+                        super()._discovery_activity()
+                    elif message_obj['type'] == 'bus_metrics':
+                        METRICS.merge(worker_id, message_obj['metrics'])
         except Exception as e:
             if self.running:
-                print(f"Erro ao lidar com cliente {client_address}: {e}")
-            if client_address in self.clients:
-                del self.clients[client_address]
-            if client_address in self.client_names:
-                del self.client_names[client_address]
-
-    def broadcast_message(self, message_obj, sender_socket=None):
-        message_json = json.dumps(message_obj).encode('utf-8')
-        for addr, client_socket in list(self.clients.items()):
-            if client_socket != sender_socket:
+                show(f"Erro no barramento com o worker {worker_id}: {e}")
+        if self.running:
+            show(f"Worker {worker_id} encerrou.")
+
+    def _relay(self, payload):
+        room = route_room(payload)
+        with self.hub_lock:
+            self.room_seqs[room] += 1
+            payload = BUS_SEQ.pack(self.room_seqs[room]) + payload[BUS_SEQ.size:]
+            self._send_all(routed_frame(payload))
+            with self.relayed_cond:
+                self.relayed.append(payload)
+                self.relayed_cond.notify()
+
+    def _show_relayed(self):
+        while True:
+            with self.relayed_cond:
+                while not self.relayed and self.running:
+                    self.relayed_cond.wait()
+                if not self.relayed:
+                    return
+                batch = list(self.relayed)
+                self.relayed.clear()
+            for payload in batch:
                 try:
-                    client_socket.sendall(message_json)
+                    message_obj, room, _, origin, sender_name = parse_route(payload)
+                    self._expire_offers(message_obj, room)
+                    if origin != BUS_NO_ORIGIN:
+                        self._show_room_message(message_obj, sender_name)
                 except Exception as e:
-                    print(f"Erro ao enviar mensagem para {addr}: {e}")
-                    if addr in self.clients:
-                        del self.clients[addr]
-                    if addr in self.client_names:
-                        del self.client_names[addr]
+                    show(f"Erro ao mostrar mensagem repassada: {e}")
 
-    def _handle_user_input(self):
-        while self.running:
-            try:
-                message = input("")
-                if message.lower() == 'sair':
-                    self.stop()
-                    break
-                if message:
-                    message_obj = {
-                        'type': 'chat_message',
-                        'sender_id': MY_ID,
-                        'content': message,
-                        'timestamp': datetime.now().isoformat()
-                    }
-                    save_message(MY_ID, "ALL", message, is_me=True)
-                    print(f"[Eu]: {message}")
-                    self.broadcast_message(message_obj)
-            except EOFError:
-                print("Entrada de usuário encerrada.")
-                self.stop()
-                break
-            except Exception as e:
-                print(f"Erro na entrada do usuário: {e}")
-                self.stop()
-                break
+    def _send_all(self, message_obj, exclude=None):
+        frame = message_obj if isinstance(message_obj, bytes) else encode_frame(message_obj)
+        for worker_id, writer in enumerate(self.bus_writers):
+            if worker_id != exclude:
+                writer.enqueue(frame)
+
+    def _on_bus_error(self, worker_id, error):
+        if self.running:
+            show(f"Erro no barramento com o worker {worker_id}: {error}")
+
+    def broadcast_message(self, message_obj, sender_socket=None, room=None):
+        if room is not None:
+            message_obj['room'] = room
+        message_obj.setdefault('room', DEFAULT_ROOM)
+        self._relay(route_payload(message_obj, message_obj['room'], sender_name=MY_NAME or ''))
+
+    def _route_file(self, message_obj, origin=None):
+        # Não se sabe em qual worker está o destinatário: todos recebem e só
+        # quem o tem entrega.
+        if file_target(message_obj) == MY_ID:
+            self.files.handle(message_obj)
+        else:
+            self._send_all(file_frame(message_obj), exclude=origin)
+
+    def _deliver_file_frame(self, target_id, frame):
+        self._send_all(frame)
+
+    def _add_room(self, room):
+        super()._add_room(room)
+        self._send_all({'type': 'bus_room', 'room': room})
+
+    def _room_member_count(self, room):
+        return sum(stats['rooms'].get(room, 0) for stats in list(self.worker_stats.values()))
+
+    def _handle_command(self, message):
+        super()._handle_command(message)
+        command, _, argument = message.partition(' ')
+        if command == '/metricas' and argument.strip() in ('on', 'off'):
+            self._send_all({'type': 'bus_metrics', 'enabled': METRICS.enabled})
 
     def stop(self):
-        print("Encerrando servidor...")
         self.running = False
+        self._send_all({'type': 'bus_stop'})
+        for process in self.workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for writer in self.bus_writers:
+            writer.close()
+        for bus in self.buses:
+            bus.close()
+        with self.relayed_cond:
+            self.relayed_cond.notify_all()
+        super().stop()
 
-        if self.broadcast_socket:
-            try:
-                self.broadcast_socket.close()
-            except Exception as e:
-                print(f"Erro ao fechar socket de broadcast: {e}")
+SERVER_ENGINES = {
+    'threads': ChatServer,
+    'asyncio': AsyncChatServer,
+    'workers': MultiProcessChatServer,
+}
 
-        for client_socket in self.clients.values():
-            try:
-                client_socket.shutdown(socket.SHUT_RDWR)
-                client_socket.close()
-            except Exception as e:
-                print(f"Erro ao fechar socket de cliente: {e}")
-        self.clients.clear()
+class DiscoveredHost:
+    __slots__ = ('host_id', 'ip', 'port', 'name', 'rooms', 'first_seen', 'last_seen', 'rtt')
 
-        try:
-            self.server_socket.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            pass
-        finally:
-            self.server_socket.close()
-        print("Servidor encerrado.")
+    def __init__(self, host_id, ip, port, name, now):
+        self.host_id = host_id
+        self.ip = ip
+        self.port = port
+        self.name = name
+        self.rooms = (DEFAULT_ROOM,)
+        self.first_seen = now
+        self.last_seen = now
+        self.rtt = None
 
-class ChatClient:
-    def __init__(self, chat_port):
-        self.chat_port = chat_port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.running = True
-        self.connected_to_ip = None
+class DiscoveryRegistry:
+    def __init__(self, ttl=DISCOVERY_TTL):
+        self.ttl = ttl
+        self.hosts = {}
+        self.cond = threading.Condition()
+
+    def update(self, message_obj, rtt=None):
+        if not valid_discovery(message_obj):
+            return None
+        host_id = message_obj['host_id']
+        if host_id == MY_ID:
+            return None
+        now = time.monotonic()
+        with self.cond:
+            host = self.hosts.get(host_id)
+            if host is None:
+                host = DiscoveredHost(host_id, message_obj['host_ip'], message_obj.get('chat_port', CHAT_PORT),
+                                      message_obj.get('host_name', 'Desconhecido'), now)
+                host.rooms = tuple(message_obj.get('rooms', host.rooms))
+                self.hosts[host_id] = host
+                self.cond.notify_all()
+            else:
+                # Beacons repetidos só atualizam o registro existente.
+                host.ip = message_obj['host_ip']
+                host.port = message_obj.get('chat_port', host.port)
+                host.name = message_obj.get('host_name', host.name)
+                host.rooms = tuple(message_obj.get('rooms', host.rooms))
+                host.last_seen = now
+            if rtt is not None:
+                host.rtt = rtt
+        return host
+
+    def _expire(self, now):
+        expired = [host_id for host_id, host in self.hosts.items() if now - host.last_seen > self.ttl]
+        for host_id in expired:
+            del self.hosts[host_id]
+
+    def active(self):
+        with self.cond:
+            self._expire(time.monotonic())
+            return sorted(self.hosts.values(), key=lambda host: host.first_seen)
 
-    def discover_and_connect(self):
-        print("\n--- Buscando chats disponíveis na rede local (Wi-Fi)... ---")
-        discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        discovery_socket.settimeout(5.0)
+    def wait_for(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                if (count and len(self.hosts) >= count) or now >= deadline:
+                    return sorted(self.hosts.values(), key=lambda host: host.first_seen)
+                self.cond.wait(deadline - now)
+
+class DiscoveryListener:
+    # Escuta beacons em segundo plano durante toda a sessão, para que o menu
+    # já conheça os hosts quando o usuário pedir para conectar.
+    def __init__(self, registry, port=DISCOVERY_PORT, query_port=QUERY_PORT):
+        self.registry = registry
+        self.port = port
+        self.query_port = query_port
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.probes = {}
+        self.probes_lock = threading.Lock()
 
+    def start(self):
+        if self.running:
+            return True
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(0.5)
         try:
-            discovery_socket.bind(('', DISCOVERY_PORT))
+            sock.bind(('', self.port))
         except OSError as e:
-            print(f"Erro ao iniciar escuta de descoberta (porta {DISCOVERY_PORT}): {e}")
+            sock.close()
+            print(f"Erro ao iniciar escuta de descoberta (porta {self.port}): {e}")
             print("Pode ser que outro aplicativo esteja usando essa porta, ou o firewall esteja bloqueando.")
-            print("Por favor, reinicie o aplicativo e tente novamente.")
             return False
+        self.sock = sock
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
 
-        found_servers = {}
-
-        start_time = time.time()
-        while time.time() - start_time < 5:
+    def _run(self):
+        while self.running:
             try:
-                data, addr = discovery_socket.recvfrom(BUFFER_SIZE)
-                message_obj = json.loads(data.decode('utf-8'))
-                if message_obj.get('type') == 'discovery':
-                    host_ip = message_obj['host_ip']
-                    host_id = message_obj['host_id']
-                    host_name = message_obj.get('host_name', 'Desconhecido')
-
-                    if host_id == MY_ID:
-                        continue
-
-                    if host_id not in found_servers:
-                        found_servers[host_id] = {'ip': host_ip, 'name': host_name}
-                        print(f"Encontrado: [{len(found_servers)}] Chat de '{host_name}' (IP: {host_ip})")
+                data, addr = self.sock.recvfrom(DATAGRAM_SIZE)
             except socket.timeout:
                 continue
-            except json.JSONDecodeError:
-                print("Mensagem de descoberta inválida recebida.")
-                continue
-            except Exception as e:
-                print(f"Erro durante a descoberta: {e}")
+            except OSError as e:
+                if self.running:
+                    print(f"Erro durante a descoberta: {e}")
                 break
+            if METRICS.enabled:
+                METRICS.incr(discovery_packets_received=1)
+            try:
+                self._handle(data)
+            except Exception:
+                # Um datagrama malformado não pode encerrar a escuta.
+                if METRICS.enabled:
+                    METRICS.incr(discovery_packets_invalid=1)
+        self.running = False
+
+    def _handle(self, data):
+        message_obj = decode_datagram(data)
+        if message_obj.get('type') != 'discovery':
+            return
+        rtt = None
+        nonce = message_obj.get('nonce')
+        if isinstance(nonce, int):
+            with self.probes_lock:
+                sent_at = self.probes.get(nonce)
+            if sent_at is not None:
+                rtt = time.monotonic() - sent_at
+        self.registry.update(message_obj, rtt)
+
+    def probe(self, target_ip=None):
+        # Consulta ativa: os hosts respondem por unicast para esta porta, então
+        # não é preciso esperar o próximo beacon periódico.
+        if not self.running:
+            return False
+        if target_ip is None:
+            target_ip = get_broadcast_ip(get_local_ip())
+        nonce = random.getrandbits(32)
+        now = time.monotonic()
+        with self.probes_lock:
+            for old_nonce in [n for n, sent_at in self.probes.items() if now - sent_at > DISCOVERY_TTL]:
+                del self.probes[old_nonce]
+            self.probes[nonce] = now
+        query = {'type': 'discovery_query', 'client_id': MY_ID, 'nonce': nonce}
+        try:
+            self.sock.sendto(encode_datagram(query), (target_ip, self.query_port))
+            if METRICS.enabled:
+                METRICS.incr(discovery_queries_sent=1)
+        except OSError as e:
+            print(f"Erro ao enviar consulta de descoberta: {e}")
+            return False
+        return True
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+
+DISCOVERY_REGISTRY = DiscoveryRegistry()
+DISCOVERY_LISTENER = DiscoveryListener(DISCOVERY_REGISTRY)
+
+class ChatClient:
+    def __init__(self, chat_port, history_limit=HISTORY_SYNC_SIZE, history_since=None, tcp_keepalive=TCP_KEEPALIVE):
+        self.chat_port = chat_port
+        self.history_limit = history_limit
+        self.history_since = history_since
+        self.tcp_keepalive = tcp_keepalive
+        # Intervalo e prazo de batimentos anunciados pelo host (None: host antigo).
+        self.heartbeat = None
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.running = True
+        self.connected_to_ip = None
+        self.codec = JSON_CODEC
+        self.compressor = None
+        self.current_room = DEFAULT_ROOM
+        self.joined_rooms = {DEFAULT_ROOM}
+        self.available_rooms = [DEFAULT_ROOM]
+        self.send_lock = threading.Lock()
+        self.server_session = None
+        self.last_seq = {}
+        self.reconnecting = False
+        self.pending = collections.deque(maxlen=SEND_QUEUE_SIZE)
+        self.files = FileTransfers(self._send, self._send_chunk)
 
-        discovery_socket.close()
+    def discover_and_connect(self, max_hosts=DISCOVERY_EARLY_HOSTS, wait_ms=DISCOVERY_WAIT_MS):
+        if not DISCOVERY_LISTENER.start():
+            print("Por favor, reinicie o aplicativo e tente novamente.")
+            return False
 
-        if not found_servers:
+        hosts = DISCOVERY_REGISTRY.active()
+        if not hosts:
+            print("\n--- Buscando chats disponíveis na rede local (Wi-Fi)... ---")
+            DISCOVERY_LISTENER.probe()
+            hosts = DISCOVERY_REGISTRY.wait_for(max_hosts, wait_ms / 1000)
+
+        if not hosts:
             print("Nenhum chat encontrado na sua rede local. Verifique se o amigo iniciou o chat como host.")
             print("Ou talvez eles não estejam na mesma rede Wi-Fi que você.")
             return False
 
-        if len(found_servers) == 1:
-            host_id = list(found_servers.keys())[0]
-            host_info = found_servers[host_id]
-            print(f"\nConectando-se automaticamente ao chat de '{host_info['name']}' ({host_info['ip']})...")
-            return self._connect_to_server(host_info['ip'])
+        if len(hosts) == 1:
+            host = hosts[0]
+            print(f"\nConectando-se automaticamente ao chat de '{host.name}' ({host.ip})...")
+            return self._connect_to_server(host.ip)
         else:
             print("\nChats encontrados:")
-            options = list(found_servers.keys())
-            for i, host_id in enumerate(options):
-                info = found_servers[host_id]
-                print(f"  {i+1}. '{info['name']}' (IP: {info['ip']})")
+            for i, host in enumerate(hosts):
+                rooms = ', '.join(f"#{room}" for room in host.rooms)
+                print(f"  {i+1}. '{host.name}' (IP: {host.ip}, salas: {rooms})")
 
             while True:
                 try:
                     choice_num = int(input("Digite o número do chat para conectar: ").strip())
-                    if 1 <= choice_num <= len(options):
-                        chosen_host_id = options[choice_num - 1]
-                        chosen_host_info = found_servers[chosen_host_id]
-                        print(f"Conectando a '{chosen_host_info['name']}' ({chosen_host_info['ip']})...")
-                        return self._connect_to_server(chosen_host_info['ip'])
+                    if 1 <= choice_num <= len(hosts):
+                        chosen_host = hosts[choice_num - 1]
+                        print(f"Conectando a '{chosen_host.name}' ({chosen_host.ip})...")
+                        return self._connect_to_server(chosen_host.ip)
                     else:
                         print("Número inválido. Tente novamente.")
                 except ValueError:
@@ -316,19 +3345,14 @@ class ChatClient:
                     print(f"Erro na escolha: {e}")
                     return False
 
-
     def _connect_to_server(self, target_host_ip):
         self.connected_to_ip = target_host_ip
         try:
             self.client_socket.connect((self.connected_to_ip, self.chat_port))
+            tune_socket(self.client_socket, self.tcp_keepalive)
             print("Conectado ao servidor de chat!")
 
-            intro_message = {
-                'type': 'name_intro',
-                'id': MY_ID,
-                'name': MY_NAME
-            }
-            self.client_socket.send(json.dumps(intro_message).encode('utf-8'))
+            send_message(self.client_socket, self._intro_message())
 
             threading.Thread(target=self._receive_messages).start()
             threading.Thread(target=self._handle_user_input).start()
@@ -347,32 +3371,214 @@ class ChatClient:
             self.running = False
             return False
 
+    def _intro_message(self):
+        intro_message = {
+            'type': 'name_intro',
+            'id': MY_ID,
+            'name': MY_NAME,
+            'codecs': list(PREFERRED_CODECS),
+            'compression': compression_methods(),
+            'rooms': sorted(self.joined_rooms),
+            'heartbeat': True
+        }
+        if self.server_session is not None:
+            intro_message['resume'] = {'session': self.server_session, 'rooms': dict(self.last_seq)}
+        intro_message['history'] = self._history_request()
+        return intro_message
+
+    def _heartbeat_period(self):
+        # Espera mais que o intervalo do host antes de mandar ping: normalmente
+        # o ping do host chega primeiro e só ele mede a latência.
+        if self.heartbeat is None:
+            return None
+        return max(self.heartbeat['interval'], self.heartbeat.get('timeout', 0) / 2)
+
+    def _history_request(self):
+        history = {'limit': self.history_limit}
+        if self.history_since:
+            history['since'] = self.history_since
+        return history
+
+    def _send(self, message_obj):
+        with self.send_lock:
+            if self.reconnecting:
+                # Sai assim que a conexão voltar.
+                self.pending.append(message_obj)
+                return
+            frame = encode_frame(message_obj, self.codec)
+            if self.compressor is not None:
+                frame = self.compressor.compress_frame(frame)
+            try:
+                self.client_socket.sendall(frame)
+            except OSError:
+                if not self.running:
+                    raise
+                # A conexão caiu (ou o envio estourou o prazo no meio de um
+                # frame): guarda para o reenvio, que só sai no socket novo.
+                self.pending.append(message_obj)
+                self._break_connection()
+                return
+        if METRICS.enabled:
+            METRICS.incr(messages_out=1, bytes_out=len(frame))
+
+    def _break_connection(self):
+        # Chamado com o send_lock. Depois de um envio que falhou, o fluxo de
+        # frames pode ter ficado pela metade: nada mais sai por este socket, e
+        # o shutdown acorda o leitor, que reconecta.
+        self.reconnecting = True
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send_chunk(self, receiver_id, buffers):
+        # Um pedaço por vez sob o send_lock: mensagens de texto entram entre eles.
+        with self.send_lock:
+            if self.reconnecting:
+                return False
+            try:
+                send_buffers(self.client_socket, buffers)
+            except OSError:
+                self._break_connection()
+                return False
+        if METRICS.enabled:
+            METRICS.incr(file_chunks_out=1, bytes_out=sum(map(len, buffers)))
+        return True
+
     def _receive_messages(self):
+        while self.running:
+            reason = self._read_until_closed()
+            if not self.running:
+                break
+            show(f"Conexão com o host perdida ({reason}).")
+            if not self._reconnect():
+                self.stop()
+                break
+
+    def _reconnect(self):
+        with self.send_lock:
+            self.reconnecting = True
+            self.codec = JSON_CODEC
+            self.compressor = None
+        for attempt in range(RECONNECT_ATTEMPTS):
+            # Jitter: vários clientes derrubados juntos não voltam todos no mesmo instante.
+            delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+            time.sleep(random.uniform(delay / 2, delay))
+            if not self.running:
+                return False
+            show(f"Tentando reconectar a {self.connected_to_ip} ({attempt + 1}/{RECONNECT_ATTEMPTS})...")
+            new_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            new_socket.settimeout(RECONNECT_TIMEOUT)
+            try:
+                new_socket.connect((self.connected_to_ip, self.chat_port))
+                tune_socket(new_socket, self.tcp_keepalive)
+                send_message(new_socket, self._intro_message())
+                # Só conta quando o host responde: um processo travado ainda
+                # completa conexões pelo backlog do kernel.
+                if not new_socket.recv(1, socket.MSG_PEEK):
+                    raise ConnectionResetError("o host fechou a conexão")
+                new_socket.settimeout(self._heartbeat_period())
+            except OSError:
+                new_socket.close()
+                continue
+            with self.send_lock:
+                old_socket, self.client_socket = self.client_socket, new_socket
+                self.reconnecting = False
+                pending = list(self.pending)
+                self.pending.clear()
+            old_socket.close()
+            show("Reconectado.")
+            for message_obj in pending:
+                self._send(message_obj)
+            self.files.resume()
+            return True
+        show("Não foi possível reconectar ao host.")
+        return False
+
+    def _read_until_closed(self):
+        decoder = FrameDecoder()
+        last_heard = time.monotonic()
         try:
             while self.running:
-                data = self.client_socket.recv(BUFFER_SIZE).decode('utf-8')
+                try:
+                    data = self.client_socket.recv(RECV_SIZE)
+                except socket.timeout:
+                    # Host quieto há um intervalo: manda um ping. Se nem assim
+                    # ele der sinal até o prazo, a conexão morreu sem aviso.
+                    if time.monotonic() - last_heard >= self.heartbeat['timeout']:
+                        return "sem resposta do host"
+                    self._send({'type': 'ping', 'sent': time.monotonic()})
+                    continue
                 if not data:
-                    print("Servidor desconectou.")
-                    self.stop()
-                    break
+                    return "o servidor desconectou"
+                last_heard = time.monotonic()
+
+                messages = decoder.messages(data)
+                if METRICS.enabled:
+                    METRICS.incr(bytes_in=len(data), messages_in=len(messages))
+                for message_obj in messages:
+                    if message_obj['type'] == 'request_name':
+                        with self.send_lock:
+                            self.codec = choose_codec(message_obj.get('codecs'))
+                            if self.compressor is None and 'zlib' in compression_methods() and 'zlib' in message_obj.get('compression', ()):
+                                self.compressor = FrameCompressor()
+                        session = message_obj.get('session')
+                        if session != self.server_session:
+                            self.server_session = session
+                            self.last_seq = {}
+                        heartbeat = message_obj.get('heartbeat')
+                        if isinstance(heartbeat, dict) and heartbeat.get('interval', 0) > 0:
+                            self.heartbeat = heartbeat
+                            self.client_socket.settimeout(self._heartbeat_period())
+                        server_id = message_obj.get('data')
+                        if server_id:
+                            remember_contact(server_id, f"Host ({server_id[:8]})")
+                            show(f"Adicionado novo contato (host): Host ({server_id[:8]})")
+
+                    elif message_obj['type'] == 'room_list':
+                        self.available_rooms = message_obj.get('rooms', [DEFAULT_ROOM])
+                        self.joined_rooms = set(message_obj.get('joined', ()))
+                        for room, seq in message_obj.get('seqs', {}).items():
+                            self.last_seq.setdefault(room, seq)
+                        if self.current_room not in self.joined_rooms and self.joined_rooms:
+                            self.current_room = DEFAULT_ROOM if DEFAULT_ROOM in self.joined_rooms else min(self.joined_rooms)
+
+                    elif message_obj['type'] == 'resume_status':
+                        replayed, missed = message_obj.get('replayed', 0), message_obj.get('missed', 0)
+                        if replayed or missed:
+                            lost = f", {missed} perdida(s)" if missed else ""
+                            show(f"{room_label(message_obj.get('room', DEFAULT_ROOM))}{replayed} mensagem(ns) recuperada(s){lost}.")
 
-                message_obj = json.loads(data)
-                if message_obj['type'] == 'request_name':
-                    server_id = message_obj.get('data')
-                    if server_id and server_id not in CONTACTS:
-                        CONTACTS[server_id] = f"Host ({server_id[:8]})"
-                        print(f"Adicionado novo contato (host): Host ({server_id[:8]})")
-
-                elif message_obj['type'] == 'chat_message':
-                    sender_id = message_obj.get('sender_id', 'Desconhecido')
-                    message_content = message_obj['content']
-                    sender_name = CONTACTS.get(sender_id, f"Amigo ({sender_id[:8] if sender_id != 'Desconhecido' else '?'})")
-                    save_message(sender_id, MY_ID, message_content, is_me=False)
-                    print(f"[{sender_name}]: {message_content}")
+                    elif message_obj['type'] == 'history_sync':
+                        show(f"--- Últimas {message_obj.get('count', 0)} mensagem(ns) em #{message_obj.get('room', DEFAULT_ROOM)} ---")
+
+                    elif message_obj['type'] in FILE_MESSAGES:
+                        self.files.handle(message_obj)
+
+                    elif message_obj['type'] == 'ping':
+                        self._send({'type': 'pong', 'sent': message_obj.get('sent')})
+
+                    elif message_obj['type'] in ('chat_message', 'file_offer'):
+                        room = message_obj.get('room', DEFAULT_ROOM)
+                        seq = message_obj.get('seq')
+                        if seq is not None:
+                            if seq <= self.last_seq.get(room, 0):
+                                continue
+                            self.last_seq[room] = seq
+                        sender_id = message_obj.get('sender_id', 'Desconhecido')
+                        if sender_id == MY_ID:
+                            # Mensagem própria devolvida pelo replay; já foi exibida.
+                            continue
+                        if message_obj['type'] == 'file_offer':
+                            self.files.on_offer(message_obj)
+                            continue
+                        message_content = message_obj['content']
+                        sender_name = CONTACTS.get(sender_id, f"Amigo ({sender_id[:8] if sender_id != 'Desconhecido' else '?'})")
+                        save_message(sender_id, MY_ID, message_content, is_me=False)
+                        show(f"{room_label(room)}[{sender_name}]: {message_content}")
         except Exception as e:
-            if self.running:
-                print(f"Erro ao receber mensagem: {e}")
-            self.stop()
+            return str(e)
+        return None
 
     def _handle_user_input(self):
         while self.running:
@@ -381,16 +3587,19 @@ class ChatClient:
                 if message.lower() == 'sair':
                     self.stop()
                     break
-                if message:
+                if message.startswith('/'):
+                    self._handle_command(message)
+                elif message:
                     message_obj = {
                         'type': 'chat_message',
                         'sender_id': MY_ID,
                         'content': message,
-                        'timestamp': datetime.now().isoformat()
+                        'timestamp': datetime.now().isoformat(),
+                        'room': self.current_room
                     }
                     save_message(MY_ID, self.connected_to_ip, message, is_me=True)
-                    print(f"[Eu]: {message}")
-                    self.client_socket.send(json.dumps(message_obj).encode('utf-8'))
+                    show(f"{room_label(self.current_room)}[Eu]: {message}")
+                    self._send(message_obj)
             except EOFError:
                 print("Entrada de usuário encerrada.")
                 self.stop()
@@ -400,20 +3609,229 @@ class ChatClient:
                 self.stop()
                 break
 
+    def _handle_command(self, message):
+        command, _, argument = message.partition(' ')
+        argument = argument.strip()
+        if command == '/salas':
+            for room in self.available_rooms:
+                marker = '*' if room == self.current_room else ('+' if room in self.joined_rooms else ' ')
+                print(f" {marker} #{room}")
+        elif command == '/entrar' and argument:
+            if argument not in self.available_rooms:
+                print(f"Sala #{argument} não existe neste chat.")
+                return
+            self._send({'type': 'join_room', 'room': argument, 'history': self._history_request()})
+            self.joined_rooms.add(argument)
+            self.current_room = argument
+            print(f"Agora você fala em #{argument}.")
+        elif command == '/deixar' and argument:
+            self._send({'type': 'leave_room', 'room': argument})
+            self.joined_rooms.discard(argument)
+            self.last_seq.pop(argument, None)
+            if self.current_room == argument:
+                self.current_room = DEFAULT_ROOM
+        elif command == '/sala' and argument:
+            if argument in self.joined_rooms:
+                self.current_room = argument
+                print(f"Agora você fala em #{argument}.")
+            else:
+                print(f"Você não está em #{argument}. Use /entrar {argument}.")
+        elif command == '/enviar' and argument:
+            self.files.offer(argument, self.current_room)
+        elif command == '/aceitar' and argument:
+            self.files.accept(argument)
+        elif command == '/arquivos':
+            self.files.show()
+        elif command == '/historico':
+            history_command(argument)
+        elif not handle_diagnostic_command(command, argument):
+            print("Comandos: /salas, /entrar <sala>, /deixar <sala>, /sala <sala>, /enviar <arquivo>, /aceitar <código>, "
+                  "/arquivos, /historico [data] [página], /metricas [on|off], /perfil, /memoria, sair")
+
     def stop(self):
         print("Desconectando...")
         self.running = False
+        self.files.close()
         try:
             self.client_socket.shutdown(socket.SHUT_RDWR)
             self.client_socket.close()
         except Exception as e:
             print(f"Erro ao fechar socket do cliente: {e}")
+        print_compression_summary()
         print("Desconectado.")
 
-MESSAGE_HISTORY = []
+HISTORY_DB = 'chat_history.db'
+HISTORY_TAIL_SIZE = 200
+HISTORY_BATCH_SIZE = 100
+HISTORY_FLUSH_INTERVAL = 0.5
+HISTORY_PAGE_SIZE = 20
+# Registros esperando gravação; se o disco não acompanhar, os mais antigos
+# ficam só na cauda em memória.
+HISTORY_QUEUE_SIZE = 10000
+
+HISTORY_FIELDS = ('sender_id', 'receiver_id', 'content', 'is_me', 'timestamp')
+
+class HistoryStore:
+    # Histórico durável em SQLite. As gravações vão para uma fila e são
+    # feitas em lote por uma thread própria, então quem recebe mensagens da
+    # rede nunca espera pelo disco. As mensagens mais recentes ficam também
+    # numa cauda limitada em memória.
+    def __init__(self, path=HISTORY_DB, tail_size=HISTORY_TAIL_SIZE):
+        self.path = path
+        self.tail = collections.deque(maxlen=tail_size)
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.closed = False
+        self.writer_thread = None
+        self.read_conn = None
+        self.read_lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                sender_id TEXT NOT NULL,
+                receiver_id TEXT NOT NULL,
+                content TEXT NOT NULL,
+                is_me INTEGER NOT NULL,
+                timestamp TEXT NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages (receiver_id, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)")
+        conn.commit()
+        return conn
+
+    def append(self, record):
+        with self.cond:
+            if self.closed:
+                return
+            self.tail.append(record)
+            if len(self.pending) >= HISTORY_QUEUE_SIZE:
+                self.pending.popleft()
+                self.dropped += 1
+                self.written += 1
+            self.pending.append(record)
+            self.queued += 1
+            if self.writer_thread is None:
+                self.writer_thread = threading.Thread(target=self._write_loop)
+                self.writer_thread.daemon = True
+                self.writer_thread.start()
+            elif len(self.pending) >= HISTORY_BATCH_SIZE:
+                self.cond.notify_all()
+
+    def _write_loop(self):
+        try:
+            conn = self._connect()
+        except sqlite3.Error as e:
+            print(f"Erro ao abrir histórico ({self.path}): {e}. O histórico ficará só em memória.")
+            with self.cond:
+                self.written = self.queued
+                self.pending.clear()
+                self.closed = True
+                self.cond.notify_all()
+            return
+
+        while True:
+            with self.cond:
+                if not self.pending and not self.closed:
+                    self.cond.wait(HISTORY_FLUSH_INTERVAL)
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), HISTORY_BATCH_SIZE))]
+                done = self.closed and not self.pending and not batch
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                show(f"Aviso: o disco não acompanhou; {dropped} mensagem(ns) ficaram fora do histórico.")
+            if batch:
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO messages (sender_id, receiver_id, content, is_me, timestamp) VALUES (?, ?, ?, ?, ?)",
+                            [tuple(record[field] for field in HISTORY_FIELDS) for record in batch])
+                except sqlite3.Error as e:
+                    print(f"Erro ao gravar histórico: {e}")
+                with self.cond:
+                    self.written += len(batch)
+                    self.cond.notify_all()
+            if done:
+                conn.close()
+                return
+
+    def flush(self, timeout=5.0):
+        with self.cond:
+            target = self.queued
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: self.written >= target, timeout)
+
+    def _query(self, where, params, limit, offset, newest_first):
+        self.flush()
+        order = "DESC" if newest_first else "ASC"
+        sql = f"SELECT {', '.join(HISTORY_FIELDS)} FROM messages"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY timestamp {order}, id {order} LIMIT ? OFFSET ?"
+        with self.read_lock:
+            if self.read_conn is None:
+                self.read_conn = self._connect()
+            rows = self.read_conn.execute(sql, (*params, limit, offset)).fetchall()
+        records = [dict(zip(HISTORY_FIELDS, row)) for row in rows]
+        for record in records:
+            record['is_me'] = bool(record['is_me'])
+        return records
+
+    def _filters(self, sender_id, receiver_id):
+        where, params = [], []
+        if sender_id is not None:
+            where.append("sender_id = ?")
+            params.append(sender_id)
+        if receiver_id is not None:
+            where.append("receiver_id = ?")
+            params.append(receiver_id)
+        return where, params
+
+    def last(self, limit=HISTORY_PAGE_SIZE, offset=0, sender_id=None, receiver_id=None):
+        # Páginas recentes sem filtro saem direto da cauda em memória.
+        if sender_id is None and receiver_id is None and offset + limit <= len(self.tail):
+            with self.cond:
+                tail = list(self.tail)
+            return tail[len(tail) - offset - limit:len(tail) - offset]
+        where, params = self._filters(sender_id, receiver_id)
+        records = self._query(where, params, limit, offset, newest_first=True)
+        records.reverse()
+        return records
+
+    def range(self, start=None, end=None, limit=HISTORY_PAGE_SIZE, offset=0, sender_id=None, receiver_id=None):
+        where, params = self._filters(sender_id, receiver_id)
+        if start is not None:
+            where.append("timestamp >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("timestamp < ?")
+            params.append(end)
+        return self._query(where, params, limit, offset, newest_first=False)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            writer_thread = self.writer_thread
+        if writer_thread is not None:
+            writer_thread.join(timeout=5)
+        with self.read_lock:
+            if self.read_conn is not None:
+                self.read_conn.close()
+                self.read_conn = None
+
+HISTORY = HistoryStore()
+atexit.register(HISTORY.close)
 
 def save_message(sender_id, receiver_id, content, is_me):
-    MESSAGE_HISTORY.append({
+    HISTORY.append({
         'sender_id': sender_id,
         'receiver_id': receiver_id,
         'content': content,
@@ -421,23 +3839,94 @@ def save_message(sender_id, receiver_id, content, is_me):
         'timestamp': datetime.now().isoformat()
     })
 
-def display_message_history():
-    if not MESSAGE_HISTORY:
-        print("\n--- Nenhuma mensagem no histórico para esta sessão. ---")
-        return
+def display_message_history(page=0, page_size=HISTORY_PAGE_SIZE, since=None):
+    # Sem data, a página 0 é a mais recente e as seguintes vão voltando no
+    # tempo; com data, as páginas seguem em ordem a partir dela.
+    if since is None:
+        messages = HISTORY.last(page_size, offset=page * page_size)
+    else:
+        messages = HISTORY.range(start=since, limit=page_size, offset=page * page_size)
+    if not messages:
+        print("\n--- Nenhuma mensagem no histórico. ---")
+        return 0
 
-    print("\n--- Histórico de Mensagens ---")
-    for msg in MESSAGE_HISTORY:
+    print(f"\n--- Histórico de Mensagens (página {page + 1}) ---")
+    for msg in messages:
         sender_name = "Eu" if msg['is_me'] else CONTACTS.get(msg['sender_id'], f"Amigo ({msg['sender_id'][:8]})")
         print(f"[{sender_name}]: {msg['content']}")
     print("----------------------------")
+    return len(messages)
+
+def history_command(argument):
+    # /historico [desde AAAA-MM-DD[THH:MM]] [página]
+    since, page = None, 1
+    for token in argument.split():
+        if token.isdigit():
+            page = max(1, int(token))
+            continue
+        try:
+            since = datetime.fromisoformat(token).isoformat()
+        except ValueError:
+            print(f"Data inválida: {token}. Use /historico [AAAA-MM-DD] [página].")
+            return
+    if display_message_history(page - 1, since=since) == HISTORY_PAGE_SIZE:
+        since_arg = f"{since} " if since is not None else ""
+        print(f"Use /historico {since_arg}{page + 1} para a página seguinte.")
 
+def browse_message_history():
+    page = 0
+    while display_message_history(page) == HISTORY_PAGE_SIZE:
+        if input("Enter para mensagens mais antigas, 'v' para voltar: ").strip().lower() == 'v':
+            return
+        page += 1
+    input("Pressione Enter para continuar...")
 
-def setup_user():
 
-    global MY_ID, MY_NAME
+class StartupTimer:
+    # Marca o fim de cada fase da abertura, contando desde o primeiro import.
+    def __init__(self, started_at):
+        self.started_at = started_at
+        self.last = started_at
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self.last) * 1000))
+        self.last = now
+
+    def total_ms(self):
+        return (self.last - self.started_at) * 1000
+
+    def as_dict(self, budget_ms=STARTUP_BUDGET_MS):
+        return {
+            'phases_ms': dict(self.phases),
+            'total_ms': self.total_ms(),
+            'budget_ms': budget_ms,
+            'frozen': bool(getattr(sys, 'frozen', False)),
+            'lazy_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+        }
+
+    def report(self, path=None, budget_ms=STARTUP_BUDGET_MS):
+        print("\n--- Tempo de abertura ---")
+        for phase, elapsed in self.phases:
+            print(f"{phase:<14} {elapsed:>8.1f} ms")
+        total = self.total_ms()
+        status = "dentro do orçamento" if total <= budget_ms else "ACIMA do orçamento"
+        print(f"{'total':<14} {total:>8.1f} ms ({status} de {budget_ms} ms)")
+        if path:
+            try:
+                with open(path, 'w', encoding='utf-8') as f:
+                    json.dump(self.as_dict(budget_ms), f, indent=2)
+            except OSError as e:
+                print(f"Erro ao gravar o relatório de abertura: {e}")
+
+STARTUP = StartupTimer(STARTED_AT)
 
-    user_data = load_user_data()
+def setup_user(headless=False):
+
+    global MY_ID, MY_NAME, USER_DATA
+
+    user_data = USER_DATA = load_user_data()
 
 
     if user_data:
@@ -448,6 +3937,16 @@ def setup_user():
 
         print(f"Bem-vindo de volta, {MY_NAME}! Seu código de chat é: {MY_ID}")
 
+    elif headless:
+        # Sem terminal para perguntar: o host usa o nome da máquina.
+        MY_NAME = socket.gethostname() or "host"
+
+        MY_ID = str(uuid.uuid4())
+
+        save_user_data(MY_ID, MY_NAME)
+
+        print(f"Host {MY_NAME} criado com o código: {MY_ID}")
+
     else:
         print("Bem-vindo")
 
@@ -466,16 +3965,85 @@ def setup_user():
         print("Guarde este código para compartilhar com seus amigos.")
 
 def main_menu():
+    CONSOLE.flush()
+    known_hosts = len(DISCOVERY_REGISTRY.active())
     print("\n--- Menu Principal ---")
     print("1. Iniciar um novo chat (você será o host)")
-    print("2. Conectar a um chat existente (busca automática)")
+    if known_hosts:
+        print(f"2. Conectar a um chat existente ({known_hosts} encontrado(s) na rede)")
+    else:
+        print("2. Conectar a um chat existente (busca automática)")
     print("3. Ver meu código de chat")
-    print("4. Sair")
+    print("4. Ver histórico de mensagens")
+    print("5. Sair")
     return input("Escolha uma opção: ").strip()
 
-def run_app():
+def run_headless(server):
+    # Relay sem terminal: roda até Ctrl+C ou SIGTERM (systemd, docker stop).
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    server.start()
+    try:
+        while server.running and not stop_requested.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        pass
+    if server.running:
+        server.stop()
+    CONSOLE.flush()
+
+def run_app(server_engine='threads', overflow_policy=OVERFLOW_POLICY,
+            discovery_hosts=DISCOVERY_EARLY_HOSTS, discovery_wait_ms=DISCOVERY_WAIT_MS, rooms=(DEFAULT_ROOM,),
+            metrics=METRICS_ENABLED, metrics_port=METRICS_PORT, metrics_dump=None,
+            history_limit=HISTORY_SYNC_SIZE, history_since=None, flush_delay=WRITE_FLUSH_DELAY,
+            workers=WORKER_COUNT, startup_report=None, exit_after_startup=False,
+            heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT, tcp_keepalive=TCP_KEEPALIVE,
+            client_rate=(CLIENT_MESSAGE_RATE, CLIENT_BYTE_RATE), room_rate=(ROOM_MESSAGE_RATE, ROOM_BYTE_RATE),
+            max_frame_size=CLIENT_MAX_FRAME_SIZE, headless=False):
     
-    setup_user()
+    setup_user(headless)
+    STARTUP.mark('usuario')
+
+    exporter = None
+    if metrics:
+        METRICS.enabled = True
+        exporter = MetricsExporter(METRICS, metrics_port, metrics_dump)
+        exporter.start()
+        STARTUP.mark('metricas')
+
+    my_ip = get_local_ip()
+    STARTUP.mark('ip_local')
+    if my_ip == LOOPBACK_IP:
+        print("Nenhuma rede ativa encontrada; por enquanto só este computador poderá entrar no seu chat.")
+
+    # O host sem terminal nunca procura outros chats.
+    if not headless and DISCOVERY_LISTENER.start():
+        DISCOVERY_LISTENER.probe(get_broadcast_ip(my_ip))
+    STARTUP.mark('descoberta')
+
+    if startup_report is not None:
+        STARTUP.report(startup_report)
+    if exit_after_startup:
+        DISCOVERY_LISTENER.stop()
+        return
+
+    server_class = SERVER_ENGINES[server_engine]
+    server_options = {'overflow_policy': overflow_policy, 'rooms': rooms, 'flush_delay': flush_delay,
+                      'heartbeat_interval': heartbeat_interval, 'heartbeat_timeout': heartbeat_timeout,
+                      'tcp_keepalive': tcp_keepalive, 'client_rate': client_rate, 'room_rate': room_rate,
+                      'max_frame_size': max_frame_size}
+    if server_class is MultiProcessChatServer:
+        if MultiProcessChatServer.supported() and workers > 1:
+            server_options['workers'] = workers
+        else:
+            print("Modo multiprocesso indisponível aqui (ou com 1 worker); o host vai usar um processo só.")
+            server_class = ChatServer
+
+    if headless:
+        run_headless(server_class(my_ip, CHAT_PORT, DISCOVERY_PORT, headless=True, **server_options))
+        if exporter is not None:
+            exporter.stop()
+        return
 
     current_chat_instance = None
 
@@ -484,15 +4052,15 @@ def run_app():
 
         if choice == '1':
             if current_chat_instance:
-                print("Você já está em um chat. Saia primeiro para iniciar um novo.")
+                print("Você já está em um chat. Saia primeiro, ou use /criar <sala> para abrir outra sala neste host.")
                 continue
 
             my_ip = get_local_ip()
-            if my_ip == "127.0.0.1":
-                print("Não foi possível detectar seu IP local. Verifique sua conexão Wi-Fi.")
-                continue
+            if my_ip == LOOPBACK_IP:
+                print("Não foi possível detectar seu IP local (Wi-Fi desligado?). O chat vai abrir só neste computador,")
+                print(f"em {LOOPBACK_IP}; saia e hospede de novo quando estiver conectado à rede.")
 
-            current_chat_instance = ChatServer(my_ip, CHAT_PORT, DISCOVERY_PORT)
+            current_chat_instance = server_class(my_ip, CHAT_PORT, DISCOVERY_PORT, **server_options)
             current_chat_instance.start()
             while current_chat_instance.running:
                 time.sleep(0.1)
@@ -503,8 +4071,8 @@ def run_app():
                 print("Você já está em um chat. Saia primeiro para conectar a outro.")
                 continue
 
-            client = ChatClient(CHAT_PORT)
-            connected = client.discover_and_connect()
+            client = ChatClient(CHAT_PORT, history_limit, history_since, tcp_keepalive)
+            connected = client.discover_and_connect(discovery_hosts, discovery_wait_ms)
             if connected:
                 current_chat_instance = client
                 while current_chat_instance.running:
@@ -521,12 +4089,81 @@ def run_app():
             input("Pressione Enter para continuar...")
 
         elif choice == '4':
+            browse_message_history()
+
+        elif choice == '5':
             if current_chat_instance:
                 current_chat_instance.stop()
+            DISCOVERY_LISTENER.stop()
+            if exporter is not None:
+                exporter.stop()
             print("Saindo do aplicativo. Adeus!")
             break
         else:
             print("Opção inválida. Por favor, tente novamente.")
 
 if __name__ == "__main__":
-    run_app()
\ No newline at end of file
+    STARTUP.mark('imports')
+    if getattr(sys, 'frozen', False):
+        multiprocessing.freeze_support()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Chat local via Wi-Fi")
+    parser.add_argument('--engine', choices=sorted(SERVER_ENGINES), default='threads',
+                        help="motor do servidor ao hospedar um chat")
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help="o que fazer quando a fila de saída de um amigo lento enche")
+    parser.add_argument('--discovery-hosts', type=int, default=DISCOVERY_EARLY_HOSTS,
+                        help="para a busca ao encontrar esta quantidade de hosts (0 espera o tempo todo)")
+    parser.add_argument('--discovery-wait-ms', type=int, default=DISCOVERY_WAIT_MS,
+                        help="tempo máximo de busca por chats, em milissegundos")
+    parser.add_argument('--rooms', default=DEFAULT_ROOM,
+                        help="salas criadas ao hospedar, separadas por vírgula (novas salas: /criar <sala>)")
+    parser.add_argument('--metrics', action='store_true',
+                        help=f"liga as métricas e o endpoint local em 127.0.0.1:{METRICS_PORT}")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="porta do endpoint de métricas (0 desativa)")
+    parser.add_argument('--metrics-dump', metavar='ARQUIVO',
+                        help=f"grava as métricas em JSON neste arquivo a cada {METRICS_DUMP_INTERVAL:g}s")
+    parser.add_argument('--history-sync', type=int, default=HISTORY_SYNC_SIZE,
+                        help=f"mensagens anteriores recebidas ao entrar numa sala (máximo {HISTORY_SYNC_SIZE}, 0 desativa)")
+    parser.add_argument('--history-since', metavar='DATA',
+                        help="só recebe mensagens anteriores a partir deste horário (ISO 8601, ex.: 2024-05-01T18:00)")
+    parser.add_argument('--flush-ms', type=float, default=WRITE_FLUSH_DELAY * 1000,
+                        help="espera até este tempo para juntar mensagens numa única escrita (0 escreve na hora)")
+    parser.add_argument('--workers', type=int, default=WORKER_COUNT,
+                        help="processos do host com --engine workers (padrão: um por núcleo)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, metavar='SEGUNDOS',
+                        help="ao hospedar, manda ping a quem ficar este tempo calado (0 desativa)")
+    parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_TIMEOUT, metavar='SEGUNDOS',
+                        help="ao hospedar, derruba quem ficar este tempo sem responder")
+    parser.add_argument('--tcp-keepalive', action='store_true',
+                        help=f"liga o keepalive do TCP (sonda após {KEEPALIVE_IDLE}s parado), útil com clientes antigos")
+    parser.add_argument('--rate', type=float, default=CLIENT_MESSAGE_RATE, metavar='MSG/S',
+                        help="ao hospedar, mensagens por segundo aceitas de cada amigo (0 desativa)")
+    parser.add_argument('--rate-kb', type=float, default=CLIENT_BYTE_RATE / 1024, metavar='KB/S',
+                        help="ao hospedar, KB por segundo de mensagens aceitos de cada amigo (0 desativa)")
+    parser.add_argument('--room-rate', type=float, default=ROOM_MESSAGE_RATE, metavar='MSG/S',
+                        help="ao hospedar, mensagens por segundo aceitas em cada sala, somando todos (0 desativa)")
+    parser.add_argument('--room-rate-kb', type=float, default=ROOM_BYTE_RATE / 1024, metavar='KB/S',
+                        help="ao hospedar, KB por segundo de mensagens aceitos em cada sala (0 desativa)")
+    parser.add_argument('--max-frame-kb', type=int, default=CLIENT_MAX_FRAME_SIZE // 1024, metavar='KB',
+                        help="ao hospedar, derruba quem mandar um frame maior que isto")
+    parser.add_argument('--headless', action='store_true',
+                        help="hospeda direto, sem menu nem terminal: só repassa mensagens até Ctrl+C ou SIGTERM")
+    parser.add_argument('--startup-report', nargs='?', const='', metavar='ARQUIVO',
+                        help=f"mostra o tempo de cada fase da abertura (orçamento: {STARTUP_BUDGET_MS} ms) e, se indicado, grava em JSON")
+    parser.add_argument('--exit-after-startup', action='store_true',
+                        help="sai assim que o menu estiver pronto (para medir a abertura)")
+    args = parser.parse_args()
+    STARTUP.mark('argumentos')
+    rooms = [room.strip() for room in args.rooms.split(',') if valid_room_name(room.strip())]
+    run_app(server_engine=args.engine, overflow_policy=args.overflow,
+            discovery_hosts=args.discovery_hosts, discovery_wait_ms=args.discovery_wait_ms, rooms=rooms,
+            metrics=args.metrics or bool(args.metrics_dump), metrics_port=args.metrics_port,
+            metrics_dump=args.metrics_dump, history_limit=args.history_sync, history_since=args.history_since,
+            flush_delay=args.flush_ms / 1000, workers=args.workers,
+            startup_report=args.startup_report, exit_after_startup=args.exit_after_startup,
+            heartbeat_interval=args.heartbeat, heartbeat_timeout=args.heartbeat_timeout, tcp_keepalive=args.tcp_keepalive,
+            client_rate=(args.rate, args.rate_kb * 1024), room_rate=(args.room_rate, args.room_rate_kb * 1024),
+            max_frame_size=args.max_frame_kb * 1024, headless=args.headless)
\ No newline at end of file
@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['asyncio', 'sqlite3', 'multiprocessing', 'uuid'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
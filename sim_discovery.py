@@ -0,0 +1,162 @@
+# coding=utf-8
+# Simulação local da descoberta com vários hosts em processos separados.
+#
+# Cada host roda o agendador de beacons do chat e responde consultas; cada
+# cliente entra depois de --join-delay segundos e mede quanto tempo leva para
+# conhecer todos os hosts. Como broadcast não funciona em loopback, o envio
+# para "todos" é emulado com um unicast por destino, mas cada broadcast conta
+# como um único pacote na rede.
+#
+#   python sim_discovery.py
+#   python sim_discovery.py --hosts 1,10,50 --clients 5 --duration 20 --json sim.json
+import argparse
+import json
+import multiprocessing
+import random
+import select
+import socket
+import statistics
+import time
+import uuid
+
+import chat
+
+MODES = ('fixed', 'adaptive', 'query')
+FIXED_INTERVAL = 2.0
+
+
+def host_main(query_port, client_ports, mode, start_at, stop_at, packets):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', query_port))
+    host_id = str(uuid.uuid4())
+    beacon = {
+        'type': 'discovery',
+        'host_ip': '127.0.0.1',
+        'chat_port': chat.CHAT_PORT,
+        'host_id': host_id,
+        'host_name': f"host-{query_port}"
+    }
+    payload = chat.encode_datagram(beacon, chat.BINARY_CODEC)
+    scheduler = chat.BeaconScheduler()
+    sent = 0
+
+    time.sleep(max(0.0, start_at - time.time()))
+    next_beacon = time.time()
+    while time.time() < stop_at:
+        now = time.time()
+        if now >= next_beacon:
+            for port in client_ports:
+                try:
+                    sock.sendto(payload, ('127.0.0.1', port))
+                except ConnectionRefusedError:
+                    pass
+            sent += 1
+            interval = FIXED_INTERVAL if mode == 'fixed' else scheduler.next_interval()
+            next_beacon = now + interval
+        timeout = max(0.0, min(next_beacon, stop_at) - time.time())
+        readable, _, _ = select.select([sock], [], [], timeout)
+        if readable:
+            data, addr = sock.recvfrom(chat.DATAGRAM_SIZE)
+            query = chat.decode_datagram(data)
+            if query.get('type') == 'discovery_query':
+                reply = dict(beacon, nonce=query.get('nonce'))
+                sock.sendto(chat.encode_datagram(reply, chat.BINARY_CODEC), addr)
+                sent += 1
+    sock.close()
+    with packets.get_lock():
+        packets.value += sent
+
+
+def client_main(port, query_ports, mode, join_at, stop_at, results, packets):
+    seen = set()
+    latency = None
+    sent = 0
+
+    # Só abre a porta na hora de entrar, para não ler beacons antigos do buffer.
+    # O atraso aleatório evita que todos entrem alinhados com o beacon fixo.
+    time.sleep(max(0.0, join_at + random.uniform(0, FIXED_INTERVAL) - time.time()))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', port))
+    joined = time.time()
+    if mode == 'query':
+        query = chat.encode_datagram({'type': 'discovery_query', 'client_id': str(uuid.uuid4()), 'nonce': port})
+        for query_port in query_ports:
+            sock.sendto(query, ('127.0.0.1', query_port))
+        sent += 1
+
+    while time.time() < stop_at:
+        readable, _, _ = select.select([sock], [], [], max(0.0, stop_at - time.time()))
+        if not readable:
+            continue
+        data, _ = sock.recvfrom(chat.DATAGRAM_SIZE)
+        message_obj = chat.decode_datagram(data)
+        if message_obj.get('type') == 'discovery' and message_obj['host_id'] not in seen:
+            seen.add(message_obj['host_id'])
+            if len(seen) == len(query_ports):
+                latency = time.time() - joined
+    sock.close()
+    with packets.get_lock():
+        packets.value += sent
+    results.put(latency)
+
+
+def run(mode, host_count, client_count, duration, join_delay, base_port):
+    query_ports = [base_port + i for i in range(host_count)]
+    client_ports = [base_port + host_count + i for i in range(client_count)]
+    start_at = time.time() + 1.0
+    join_at = start_at + join_delay
+    stop_at = join_at + duration
+    packets = multiprocessing.Value('q', 0)
+    results = multiprocessing.Queue()
+
+    processes = [multiprocessing.Process(target=host_main, args=(port, client_ports, mode, start_at, stop_at, packets))
+                 for port in query_ports]
+    processes += [multiprocessing.Process(target=client_main, args=(port, query_ports, mode, join_at, stop_at, results, packets))
+                  for port in client_ports]
+    for process in processes:
+        process.start()
+    latencies = [results.get() for _ in client_ports]
+    for process in processes:
+        process.join()
+
+    found = [latency for latency in latencies if latency is not None]
+    return {
+        'mode': mode,
+        'hosts': host_count,
+        'clients': client_count,
+        'complete': len(found),
+        'latency_p50_ms': statistics.median(found) * 1000 if found else None,
+        'latency_max_ms': max(found) * 1000 if found else None,
+        'packets_per_s': packets.value / (stop_at - start_at),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulação de descoberta com vários hosts")
+    parser.add_argument('--hosts', default='1,5,10,25', help="lista de quantidades de hosts")
+    parser.add_argument('--clients', type=int, default=3)
+    parser.add_argument('--modes', default=','.join(MODES), help=f"modos a comparar ({', '.join(MODES)})")
+    parser.add_argument('--duration', type=float, default=20.0, help="segundos medidos após a entrada dos clientes")
+    parser.add_argument('--join-delay', type=float, default=8.0, help="segundos entre o início dos hosts e a entrada dos clientes")
+    parser.add_argument('--base-port', type=int, default=30000)
+    parser.add_argument('--json', metavar='ARQUIVO', help="grava os resultados em JSON")
+    args = parser.parse_args()
+
+    rows = []
+    print(f"{'modo':<9} {'hosts':>5} {'completos':>9} {'p50 (ms)':>10} {'max (ms)':>10} {'pacotes/s':>10}")
+    for mode in args.modes.split(','):
+        for host_count in (int(n) for n in args.hosts.split(',')):
+            row = run(mode, host_count, args.clients, args.duration, args.join_delay, args.base_port)
+            rows.append(row)
+            p50 = f"{row['latency_p50_ms']:.1f}" if row['latency_p50_ms'] is not None else '-'
+            worst = f"{row['latency_max_ms']:.1f}" if row['latency_max_ms'] is not None else '-'
+            print(f"{mode:<9} {host_count:>5} {row['complete']:>4}/{row['clients']:<4} {p50:>10} {worst:>10} {row['packets_per_s']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+        print(f"Resultados gravados em {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,623 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from unittest import mock
+
+import chat
+
+
+def chat_message(content='oi', room=chat.DEFAULT_ROOM):
+    return {'type': 'chat_message', 'sender_id': str(uuid.uuid4()),
+            'timestamp': '2024-05-01T12:30:00.123456', 'room': room, 'content': content}
+
+
+def beacon(host_id=None, **fields):
+    message = {'type': 'discovery', 'host_ip': '192.168.0.10', 'chat_port': chat.CHAT_PORT,
+               'host_id': host_id or str(uuid.uuid4()), 'host_name': 'Ana', 'rooms': ['geral']}
+    message.update(fields)
+    return message
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class StalledSocket:
+    # Só aceita escrita quando o teste libera.
+    def __init__(self):
+        self.gate = threading.Event()
+        self.data = []
+
+    def sendall(self, data):
+        self.gate.wait(5.0)
+        self.data.append(bytes(data))
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_split_reads(self):
+        # Um frame chegando byte a byte só sai quando está completo.
+        message = chat_message()
+        frame = chat.encode_frame(message)
+        decoder = chat.FrameDecoder()
+        received = []
+        for i in range(len(frame)):
+            received += decoder.messages(frame[i:i + 1])
+        self.assertEqual(received, [message])
+        self.assertEqual(len(decoder.buffer), 0)
+
+    def test_coalesced_reads(self):
+        # Vários frames, de codecs diferentes, num recv só, mais o começo do próximo.
+        messages = [chat_message(str(i)) for i in range(3)]
+        codecs = (chat.JSON_CODEC, chat.BINARY_CODEC, chat.JSON_CODEC)
+        data = b''.join(chat.encode_frame(message, codec) for message, codec in zip(messages, codecs))
+        last = chat_message('resto')
+        tail = chat.encode_frame(last)
+        decoder = chat.FrameDecoder()
+        self.assertEqual(decoder.messages(data + tail[:7]), messages)
+        self.assertEqual(decoder.messages(tail[7:]), [last])
+
+    def test_sized_messages(self):
+        frame = chat.encode_frame(chat_message())
+        [(_, size)] = chat.FrameDecoder().sized_messages(frame)
+        self.assertEqual(size, len(frame) - chat.FRAME_HEADER.size)
+
+    def test_oversized_frame(self):
+        decoder = chat.FrameDecoder(max_frame_size=16)
+        with self.assertRaises(chat.FrameError):
+            decoder.messages(chat.encode_frame(chat_message('x' * 100)))
+
+
+class BinaryCodecTest(unittest.TestCase):
+    def round_trip(self, message):
+        codec_id, payload = chat.encode_payload(message, chat.BINARY_CODEC)
+        return codec_id, chat.decode_payload(codec_id, payload)
+
+    def test_round_trip(self):
+        message = dict(chat_message('olá, mundo'), seq=7)
+        self.assertEqual(self.round_trip(message), (chat.BINARY_CODEC.codec_id, message))
+
+    def test_discovery_round_trip(self):
+        message = beacon(rooms=['geral', 'jogos'])
+        self.assertEqual(chat.decode_datagram(chat.encode_datagram(message, chat.BINARY_CODEC)), message)
+
+    def test_fallback_to_json(self):
+        # Fora do esquema (UUID fora do padrão, campo de tipo errado, tipo
+        # desconhecido) a mensagem vai em JSON e volta igual.
+        for message in (dict(chat_message(), sender_id='Desconhecido'),
+                        dict(chat_message(), content=123),
+                        dict(chat_message(), timestamp='ontem'),
+                        {'type': 'ping', 'sent': 1.5}):
+            self.assertEqual(self.round_trip(message), (chat.JSON_CODEC.codec_id, message))
+
+    def test_truncated_payload(self):
+        _, payload = chat.encode_payload(chat_message(), chat.BINARY_CODEC)
+        with self.assertRaises(chat.CodecError):
+            chat.BINARY_CODEC.decode(payload[:10])
+
+    def test_appendix_must_be_an_object(self):
+        _, payload = chat.encode_payload({'type': 'request_name', 'data': str(uuid.uuid4())}, chat.BINARY_CODEC)
+        base = payload[:-4]
+        for appendix in (b'[1]', b'5', b'{'):
+            with self.assertRaises(chat.CodecError):
+                chat.BINARY_CODEC.decode(base + chat.BinaryCodec.LONG_LEN.pack(len(appendix)) + appendix)
+        with self.assertRaises(chat.CodecError):
+            chat.decode_datagram(b'[1]')
+
+
+class CompressionTest(unittest.TestCase):
+    def test_shared_stream_round_trip(self):
+        # Frames comprimidos, pequenos e de arquivo misturados num só fluxo,
+        # lido em pedaços que cortam os frames ao meio.
+        compressor = chat.FrameCompressor()
+        text = ' '.join(str(uuid.uuid4()) for _ in range(30))
+        messages = [chat_message(text), chat_message('curta'), chat_message(text + '!'), chat_message(text)]
+        frames = [compressor.compress_frame(chat.encode_frame(message, chat.BINARY_CODEC)) for message in messages]
+        transfer_id, data = str(uuid.uuid4()), bytes(range(256)) * 4
+        chunk = b''.join(chat.encode_file_chunk(transfer_id, str(uuid.uuid4()), 1024, data))
+        frames.insert(2, compressor.compress_frame(chunk))
+        flags = [chat.FRAME_HEADER.unpack_from(frame)[1] for frame in frames]
+        self.assertEqual([bool(flag & chat.FLAG_COMPRESSED) for flag in flags], [True, False, False, True, True])
+        # A janela é compartilhada: a repetição sai bem menor que a primeira.
+        self.assertLess(len(frames[4]), len(frames[0]) // 4)
+
+        stream = b''.join(frames)
+        decoder = chat.FrameDecoder()
+        received = []
+        for i in range(0, len(stream), 97):
+            received += decoder.messages(stream[i:i + 97])
+        file_chunk = received.pop(2)
+        self.assertEqual(received, messages)
+        self.assertEqual((file_chunk['transfer_id'], file_chunk['offset'], bytes(file_chunk['data'])),
+                         (transfer_id, 1024, data))
+
+    def test_decompressed_size_is_limited(self):
+        frame = chat.FrameCompressor().compress_frame(chat.encode_frame(chat_message('x' * 100000)))
+        self.assertLess(len(frame), 1000)
+        with self.assertRaises(chat.FrameError):
+            chat.FrameDecoder(max_frame_size=1000).messages(frame)
+
+
+class DiscoveryQueryTest(unittest.TestCase):
+    def test_bad_queries_do_not_stop_answering(self):
+        port = free_udp_port()
+        server = chat.ChatServer('127.0.0.1', 0, port, query_port=port)
+        self.addCleanup(setattr, server, 'running', False)
+        threading.Thread(target=server._answer_discovery_queries, daemon=True).start()
+        query = {'type': 'discovery_query', 'client_id': 'outro', 'nonce': 42}
+        _, payload = chat.encode_payload({'type': 'request_name', 'data': str(uuid.uuid4())}, chat.BINARY_CODEC)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(2.0)
+            time.sleep(0.1)
+            for data in (payload[:-4] + chat.BinaryCodec.LONG_LEN.pack(3) + b'[1]', b'[1]', b'\xff',
+                         json.dumps(dict(query, nonce=[1])).encode(), json.dumps(query).encode()):
+                sock.sendto(data, ('127.0.0.1', port))
+            replies = [chat.decode_datagram(sock.recvfrom(chat.DATAGRAM_SIZE)[0]) for _ in range(2)]
+        self.assertEqual([reply['nonce'] for reply in replies], [None, 42])
+
+
+class ClientWriterTest(unittest.TestCase):
+    def stalled_writer(self, policy):
+        # Um frame preso no envio e a fila (de 2) livre para o teste.
+        sock = StalledSocket()
+        self.addCleanup(sock.gate.set)
+        errors = []
+        writer = chat.ClientWriter(sock, errors.append, 2, policy, 0)
+        self.addCleanup(writer.close)
+        writer.enqueue(b'0')
+        self.assertTrue(wait_until(lambda: not writer.queue))
+        return writer, sock, errors
+
+    def test_drop_oldest(self):
+        writer, sock, errors = self.stalled_writer('drop_oldest')
+        self.assertTrue(all(writer.enqueue(frame) for frame in (b'1', b'2', b'3', b'4')))
+        self.assertEqual((list(writer.queue), writer.dropped), ([b'3', b'4'], 2))
+        sock.gate.set()
+        self.assertTrue(wait_until(lambda: b''.join(sock.data) == b'034'))
+        self.assertEqual(errors, [])
+
+    def test_disconnect(self):
+        writer, sock, errors = self.stalled_writer('disconnect')
+        self.assertTrue(writer.enqueue(b'1') and writer.enqueue(b'2'))
+        self.assertFalse(writer.enqueue(b'3'))
+        self.assertTrue(writer.closed)
+        self.assertIsInstance(errors[0], chat.SendQueueFull)
+        self.assertFalse(writer.enqueue(b'4'))
+
+    def test_backpressure_waits_outside_enqueue(self):
+        writer, sock, errors = self.stalled_writer('backpressure')
+        self.assertTrue(all(writer.enqueue(frame) for frame in (b'1', b'2', b'3')))
+        self.assertTrue(writer.full())
+        threading.Timer(0.2, sock.gate.set).start()
+        writer.wait_for_room()
+        self.assertEqual(errors, [])
+        self.assertFalse(writer.closed)
+
+    def test_backpressure_timeout_disconnects(self):
+        writer, sock, errors = self.stalled_writer('backpressure')
+        for frame in (b'1', b'2'):
+            writer.enqueue(frame)
+        with mock.patch.object(chat, 'BACKPRESSURE_TIMEOUT', 0.1):
+            writer.wait_for_room()
+        self.assertTrue(writer.closed)
+        self.assertIsInstance(errors[0], chat.SendQueueFull)
+
+
+class BackpressureFanOutTest(unittest.TestCase):
+    def test_waits_without_the_room_lock(self):
+        server = chat.ChatServer('127.0.0.1', 0, 0, query_port=0, overflow_policy='backpressure')
+        sock = StalledSocket()
+        self.addCleanup(sock.gate.set)
+        conn = chat.ClientConnection(sock, ('127.0.0.1', 1))
+        conn.writer = chat.ClientWriter(sock, lambda e: None, 2, 'backpressure', 0)
+        self.addCleanup(conn.writer.close)
+        server.registry.add(conn)
+        server.registry.subscribe(conn, chat.DEFAULT_ROOM)
+        server._fan_out(chat_message('0'), None, chat.DEFAULT_ROOM)
+        self.assertTrue(wait_until(lambda: not conn.writer.queue))
+        server._fan_out(chat_message('1'), None, chat.DEFAULT_ROOM)
+        sender = threading.Thread(target=server._fan_out, args=(chat_message('2'), None, chat.DEFAULT_ROOM))
+        sender.start()
+        time.sleep(0.1)
+        # Quem enviou está esperando a fila, mas a sala segue livre.
+        self.assertTrue(sender.is_alive())
+        log = server._room_log(chat.DEFAULT_ROOM)
+        self.assertTrue(log.lock.acquire(timeout=0.5))
+        log.lock.release()
+        sock.gate.set()
+        sender.join(2.0)
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(log.seq, 3)
+
+
+class BeaconActivityTest(unittest.TestCase):
+    def test_only_payload_changes_wake_the_sender(self):
+        server = chat.ChatServer('127.0.0.1', 0, 0, query_port=0)
+        server.beacon.next_interval()
+        server.beacon.next_interval()
+        # Entradas e saídas só encurtam o próximo intervalo.
+        server._discovery_activity()
+        self.assertFalse(server.beacon_wakeup.is_set())
+        self.assertEqual(server.beacon.next_interval(), chat.BEACON_MIN_INTERVAL)
+        server._add_room('jogos')
+        self.assertTrue(server.beacon_wakeup.is_set())
+        self.assertIn('jogos', chat.decode_datagram(server._discovery_payload())['rooms'])
+
+
+class DiscoveryRegistryTest(unittest.TestCase):
+    def test_repeated_beacon_updates_in_place(self):
+        registry = chat.DiscoveryRegistry()
+        first = registry.update(beacon('a' * 8))
+        second = registry.update(beacon('a' * 8, host_ip='192.168.0.11', rooms=['geral', 'jogos']), rtt=0.01)
+        self.assertIs(first, second)
+        self.assertEqual((second.ip, second.rooms, second.rtt), ('192.168.0.11', ('geral', 'jogos'), 0.01))
+        self.assertEqual(registry.active(), [first])
+
+    def test_expires_after_ttl(self):
+        registry = chat.DiscoveryRegistry(ttl=5)
+        old = registry.update(beacon())
+        fresh = registry.update(beacon())
+        old.last_seen -= 6
+        self.assertEqual(registry.active(), [fresh])
+
+    def test_rejects_bad_fields(self):
+        registry = chat.DiscoveryRegistry()
+        for message in (beacon(rooms=5), beacon(rooms=[1]), beacon(host_ip=None),
+                        beacon(chat_port='12345'), {'type': 'discovery'}):
+            self.assertIsNone(registry.update(message))
+        self.assertEqual(registry.active(), [])
+
+
+class DiscoveryListenerTest(unittest.TestCase):
+    def test_malformed_datagrams_do_not_stop_listening(self):
+        registry = chat.DiscoveryRegistry()
+        port = free_udp_port()
+        listener = chat.DiscoveryListener(registry, port=port)
+        self.assertTrue(listener.start())
+        self.addCleanup(listener.stop)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for data in (json.dumps(beacon(rooms=5)).encode(), b'[1]', b'{', b'\x04\x00',
+                         json.dumps(beacon('nonce', nonce=[1])).encode(), json.dumps(beacon('ok')).encode()):
+                sock.sendto(data, ('127.0.0.1', port))
+        # Só o nonce estranho não impede o beacon de valer.
+        hosts = registry.wait_for(2, 2.0)
+        self.assertEqual([host.host_id for host in hosts], ['nonce', 'ok'])
+        self.assertTrue(listener.running)
+
+
+class RoomLogTest(unittest.TestCase):
+    def fill(self, count, capacity=4):
+        log = chat.RoomLog(capacity)
+        for i in range(count):
+            log.append(chat_message(str(i)), {})
+        return log
+
+    def test_since(self):
+        log = self.fill(3)
+        self.assertEqual(log.since(1), (range(2, 4), 0))
+        self.assertEqual(log.since(3), (range(4, 4), 0))
+
+    def test_since_after_overwrite(self):
+        # Com 6 mensagens num anel de 4, quem viu só a 1 perdeu a 2.
+        log = self.fill(6)
+        self.assertEqual(log.since(1), (range(3, 7), 1))
+        self.assertEqual(log.messages[5 % 4]['content'], '4')
+
+    def test_recent(self):
+        log = self.fill(6)
+        self.assertEqual(log.recent(2), range(5, 7))
+        self.assertEqual(log.recent(50), range(3, 7))
+        self.assertEqual(log.recent(50, since_time=log.times[6 % 4] + 1), range(7, 7))
+
+    def test_frame_cache_and_fallback(self):
+        log = self.fill(1)
+        frame = log.frame(1, chat.BINARY_CODEC)
+        self.assertIs(log.frame(1, chat.BINARY_CODEC), frame)
+        # Entrada que o binário não codifica sai em JSON em vez de quebrar o replay.
+        log.append(dict(chat_message(), content=7), {})
+        self.assertEqual(chat.FrameDecoder().messages(log.frame(2, chat.BINARY_CODEC))[0]['content'], 7)
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_fires_after_delay(self):
+        wheel = chat.TimerWheel(tick=1.0, slots=8)
+        wheel.schedule('a', 1.0)
+        wheel.schedule('b', 2.5)
+        self.assertEqual(wheel.count, 2)
+        self.assertEqual(wheel.advance(), ['a'])
+        self.assertEqual(wheel.advance(), [])
+        self.assertEqual(wheel.advance(), ['b'])
+        self.assertEqual(wheel.count, 0)
+
+    def test_longer_than_one_turn(self):
+        wheel = chat.TimerWheel(tick=1.0, slots=4)
+        wheel.schedule('longe', 10)
+        fired = [tick for tick in range(1, 13) if wheel.advance()]
+        self.assertEqual(fired, [10])
+        self.assertEqual(wheel.count, 0)
+
+
+class ClientRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = chat.ClientRegistry(rooms=('geral', 'jogos'))
+        self.ana = chat.ClientConnection(None, ('10.0.0.1', 1))
+        self.bia = chat.ClientConnection(None, ('10.0.0.2', 2))
+        self.assertTrue(self.registry.add(self.ana) and self.registry.add(self.bia))
+
+    def test_add_and_remove(self):
+        self.assertFalse(self.registry.add(chat.ClientConnection(None, ('10.0.0.1', 1))))
+        self.assertEqual(self.registry.snapshot(), (self.ana, self.bia))
+        self.assertIs(self.registry.remove(self.ana.address), self.ana)
+        # Só a primeira remoção devolve a conexão.
+        self.assertIsNone(self.registry.remove(self.ana.address))
+        self.assertEqual((self.registry.snapshot(), len(self.registry)), ((self.bia,), 1))
+
+    def test_identify(self):
+        self.registry.identify(self.ana, 'id-ana')
+        self.assertIs(self.registry.find('id-ana'), self.ana)
+        # Quem se reapresenta com o mesmo código passa a ser o destino.
+        self.registry.identify(self.bia, 'id-ana')
+        self.assertIs(self.registry.find('id-ana'), self.bia)
+        self.registry.remove(self.ana.address)
+        self.assertIs(self.registry.find('id-ana'), self.bia)
+        self.registry.remove(self.bia.address)
+        self.assertIsNone(self.registry.find('id-ana'))
+        # Conexão que já saiu não volta para o índice.
+        self.registry.identify(self.ana, 'id-ana')
+        self.assertIsNone(self.registry.find('id-ana'))
+
+    def test_subscribe(self):
+        snapshot = self.registry.room_snapshot('jogos')
+        self.assertTrue(self.registry.subscribe(self.ana, 'jogos'))
+        self.assertFalse(self.registry.subscribe(self.ana, 'jogos'))
+        self.assertFalse(self.registry.subscribe(self.ana, 'inexistente'))
+        self.assertTrue(self.registry.subscribe(self.bia, 'jogos'))
+        # Quem já pegou a tupla da sala continua com a dela.
+        self.assertEqual(snapshot, ())
+        self.assertEqual(self.registry.room_snapshot('jogos'), (self.ana, self.bia))
+        self.assertTrue(self.registry.unsubscribe(self.ana, 'jogos'))
+        self.assertFalse(self.registry.unsubscribe(self.ana, 'jogos'))
+        self.registry.remove(self.bia.address)
+        self.assertEqual(self.registry.room_snapshot('jogos'), ())
+        self.assertFalse(self.registry.subscribe(self.bia, 'geral'))
+
+    def test_add_room(self):
+        rooms = self.registry.room_members
+        self.assertTrue(self.registry.add_room('musica'))
+        self.assertFalse(self.registry.add_room('musica'))
+        self.assertNotIn('musica', rooms)
+        self.assertEqual(self.registry.rooms(), ['geral', 'jogos', 'musica'])
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        # Cauda de 5 em memória e 12 mensagens: páginas mais antigas só no SQLite.
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = chat.HistoryStore(os.path.join(directory.name, 'historico.db'), tail_size=5)
+        self.addCleanup(self.store.close)
+        for i in range(12):
+            self.store.append({'sender_id': 'a' if i % 2 else 'b', 'receiver_id': 'c', 'content': str(i),
+                               'is_me': False, 'timestamp': f'2024-05-01T12:00:{i:02d}'})
+
+    def contents(self, records):
+        return [record['content'] for record in records]
+
+    def test_last_pages_across_the_tail(self):
+        self.assertEqual(self.contents(self.store.last(3)), ['9', '10', '11'])
+        self.assertEqual(self.contents(self.store.last(3, offset=3)), ['6', '7', '8'])
+        self.assertEqual(self.contents(self.store.last(5, offset=10)), ['0', '1'])
+        self.assertEqual(self.contents(self.store.last(3, offset=12)), [])
+        # A cauda e o banco devolvem os mesmos registros.
+        from_tail = self.store.last(5)
+        self.assertEqual(from_tail, self.store.last(5, receiver_id='c'))
+        self.assertIs(from_tail[0]['is_me'], False)
+
+    def test_last_filtered(self):
+        self.assertEqual(self.contents(self.store.last(2, sender_id='a')), ['9', '11'])
+        self.assertEqual(self.contents(self.store.last(2, offset=2, sender_id='a')), ['5', '7'])
+
+    def test_range(self):
+        page = self.store.range('2024-05-01T12:00:04', '2024-05-01T12:00:10', limit=4)
+        self.assertEqual(self.contents(page), ['4', '5', '6', '7'])
+        page = self.store.range('2024-05-01T12:00:04', '2024-05-01T12:00:10', limit=4, offset=4)
+        self.assertEqual(self.contents(page), ['8', '9'])
+        self.assertEqual(self.contents(self.store.range(start='2024-05-01T12:00:10')), ['10', '11'])
+
+
+class FileTransfersTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch.object(chat, 'MY_ID', str(uuid.uuid4()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.data = bytes(range(256)) + bytes(44)
+        self.offer = {'type': 'file_offer', 'transfer_id': str(uuid.uuid4()), 'sender_id': str(uuid.uuid4()),
+                      'name': 'foto.bin', 'size': len(self.data), 'room': chat.DEFAULT_ROOM}
+
+    def receiver(self):
+        sent = []
+        transfers = chat.FileTransfers(sent.append, None, os.path.join(self.directory, 'recebidos'))
+        self.addCleanup(transfers.close)
+        transfers.on_offer(self.offer)
+        transfers.accept(self.offer['transfer_id'][:8])
+        return transfers, sent
+
+    def chunk(self, offset, end, crc=None):
+        frame = b''.join(chat.encode_file_chunk(self.offer['transfer_id'], chat.MY_ID, offset, self.data[offset:end]))
+        chunk = chat.decode_file_chunk(frame[chat.FRAME_HEADER.size:])
+        if crc is not None:
+            chunk['crc'] = crc
+        return chunk
+
+    def replies(self, sent):
+        replies = [(message['type'], message['offset']) for message in sent]
+        sent.clear()
+        return replies
+
+    def test_gap_and_crc_retry(self):
+        transfers, sent = self.receiver()
+        self.assertEqual(self.replies(sent), [('file_accept', 0)])
+        transfers.on_chunk(self.chunk(0, 100))
+        # Pedaço fora de ordem: pede de novo a partir do último byte bom, uma vez só.
+        transfers.on_chunk(self.chunk(200, 300))
+        transfers.on_chunk(self.chunk(200, 300))
+        self.assertEqual(self.replies(sent), [('file_ack', 100), ('file_accept', 100)])
+        transfers.on_chunk(self.chunk(100, 200))
+        transfers.on_chunk(self.chunk(200, 300, crc=0))
+        self.assertEqual(self.replies(sent), [('file_ack', 200), ('file_accept', 200)])
+        transfers.on_chunk(self.chunk(200, 300))
+        self.assertEqual(self.replies(sent), [('file_ack', 300)])
+        with open(os.path.join(self.directory, 'recebidos', 'foto.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_resume_from_part_file(self):
+        transfers, sent = self.receiver()
+        transfers.on_chunk(self.chunk(0, 120))
+        transfers.close()
+        # Outra execução: o .part diz de onde continuar.
+        transfers, sent = self.receiver()
+        self.assertEqual(self.replies(sent), [('file_accept', 120)])
+        transfers.on_chunk(self.chunk(120, 300))
+        with open(os.path.join(self.directory, 'recebidos', 'foto.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_sender_starts_at_accepted_offset(self):
+        path = os.path.join(self.directory, 'foto.bin')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        chunks = []
+        sender = chat.FileTransfers(lambda message_obj: None,
+                                    lambda receiver_id, buffers: chunks.append(b''.join(buffers)) or True)
+        self.addCleanup(sender.close)
+        with mock.patch.object(chat, 'FILE_CHUNK_SIZE', 100):
+            offer = sender.offer(path, chat.DEFAULT_ROOM)
+            receiver_id = str(uuid.uuid4())
+            sender.on_accept({'transfer_id': offer['transfer_id'], 'receiver_id': receiver_id, 'offset': 100})
+            self.assertTrue(wait_until(lambda: len(chunks) == 2))
+            sender.on_ack({'transfer_id': offer['transfer_id'], 'receiver_id': receiver_id, 'offset': 300})
+            self.assertTrue(wait_until(lambda: not sender.streams))
+        received = [chat.decode_file_chunk(chunk[chat.FRAME_HEADER.size:]) for chunk in chunks]
+        self.assertEqual([(chunk['offset'], bytes(chunk['data'])) for chunk in received],
+                         [(100, self.data[100:200]), (200, self.data[200:])])
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_delay(self):
+        bucket = chat.TokenBucket(rate=2.0, burst=2.0)
+        now = bucket.updated
+        self.assertEqual(bucket.take(1, now), 0.0)
+        self.assertEqual(bucket.take(1, now), 0.0)
+        # Sem fichas: fica devendo e espera o tempo de pagar a dívida.
+        self.assertAlmostEqual(bucket.take(1, now), 0.5)
+        self.assertAlmostEqual(bucket.take(1, now), 1.0)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = chat.TokenBucket(rate=2.0, burst=2.0)
+        now = bucket.updated + 100
+        self.assertEqual(bucket.take(2, now), 0.0)
+        self.assertAlmostEqual(bucket.take(1, now), 0.5)
+
+    def test_zero_rate_disables(self):
+        bucket = chat.TokenBucket(rate=0, burst=0)
+        self.assertEqual(bucket.take(10 ** 6, bucket.updated), 0.0)
+
+
+class ClientSendFailureTest(unittest.TestCase):
+    def test_stalled_send_reconnects_before_resending(self):
+        # O host para de ler e o envio estoura o prazo no meio de um frame.
+        # Nada mais pode sair por esse socket; o que ficou pendente vai inteiro
+        # pela conexão nova.
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+        client = chat.ChatClient(listener.getsockname()[1])
+        self.addCleanup(client.stop)
+        client.connected_to_ip = '127.0.0.1'
+        client.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        client.client_socket.connect(('127.0.0.1', client.chat_port))
+        client.client_socket.settimeout(0.2)
+        first, _ = listener.accept()
+        self.addCleanup(first.close)
+        for i in range(100):
+            client._send(chat_message(f'{i}:' + 'x' * 65536))
+            if client.reconnecting:
+                break
+        self.assertTrue(client.reconnecting)
+        self.assertEqual(client.client_socket.recv(1), b'')
+        client._send(chat_message('depois'))
+        self.assertEqual([m['content'][:2] for m in client.pending], [f'{i}:', 'de'])
+
+        first.settimeout(1.0)
+        decoder = chat.FrameDecoder()
+        delivered = []
+        try:
+            while data := first.recv(1 << 20):
+                delivered += decoder.messages(data)
+        except socket.timeout:
+            pass
+        self.assertEqual([m['content'].split(':')[0] for m in delivered], [str(n) for n in range(i)])
+
+        def host():
+            conn, _ = listener.accept()
+            conn.sendall(chat.encode_frame({'type': 'request_name', 'data': str(uuid.uuid4())}))
+            decoder, received = chat.FrameDecoder(), []
+            conn.settimeout(5.0)
+            while len(received) < 3:
+                received += decoder.messages(conn.recv(1 << 20))
+            results.append(received)
+            conn.close()
+
+        results = []
+        thread = threading.Thread(target=host)
+        thread.start()
+        self.assertTrue(client._reconnect())
+        thread.join(10)
+        intro, resent, after = results[0]
+        self.assertEqual(intro['type'], 'name_intro')
+        self.assertEqual((resent['content'][:2], after['content']), (f'{i}:', 'depois'))
+
+
+class BusRouteTest(unittest.TestCase):
+    def test_route_round_trip(self):
+        message = chat_message('oi', room='jogos')
+        payload = chat.route_payload(message, 'jogos', ('10.0.0.7', 5123), 3, 'Ana')
+        self.assertEqual(chat.route_room(payload), b'jogos')
+        routed, room, sender, origin, name = chat.parse_route(payload)
+        self.assertEqual((room, sender, origin, name), ('jogos', ('10.0.0.7', 5123), 3, 'Ana'))
+        self.assertEqual(routed, dict(message, seq=0))
+
+    def test_hub_numbers_per_room_without_decoding(self):
+        class Writer:
+            def __init__(self):
+                self.frames = []
+
+            def enqueue(self, frame):
+                self.frames.append(frame)
+
+        hub = chat.MultiProcessChatServer('127.0.0.1', 0, 0, workers=2, headless=True)
+        hub.bus_writers = [Writer(), Writer()]
+        for room in ('geral', 'jogos', 'geral'):
+            hub._relay(chat.route_payload(chat_message(room=room), room))
+        for writer in hub.bus_writers:
+            frames = [payload for flags, payload in chat.FrameDecoder().feed(b''.join(writer.frames))]
+            self.assertEqual([chat.parse_route(payload)[0]['seq'] for payload in frames], [1, 1, 2])
+        self.assertEqual(len(hub.relayed), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()